@@ -0,0 +1,356 @@
+"""Time `groupby()` and `render_arrow_v1()` on synthetic tables.
+
+Run from the repository root:
+
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --baseline results.json
+
+Every case runs offline on a table generated from a fixed seed, so two runs
+on the same machine measure the same work. With `--baseline`, we compare each
+case's time to the baseline's and exit with status 1 if any is slower than
+`--max-ratio` times the baseline.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+import numpy as np
+import pyarrow as pa
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from groupby import (  # noqa: E402
+    Aggregation,
+    DateGranularity,
+    Group,
+    Operation,
+    groupby,
+    render_arrow_v1,
+)
+
+KEY_TYPES = ["int", "float", "utf8", "dictionary", "timestamp", "multi"]
+
+TIMESTAMP_START = np.datetime64("2020-01-01T00:00:00", "ns").astype(np.int64)
+TIMESTAMP_STEP = 3_600 * 1_000_000_000 + 1_234_567
+"""Nanoseconds between consecutive key values: a bit more than an hour."""
+
+
+class TableSpec(NamedTuple):
+    """Parameters of a synthetic table."""
+
+    n_rows: int
+    n_groups: int
+    key_type: str
+    null_fraction: float
+    n_chunks: int
+
+    @property
+    def name(self) -> str:
+        return "rows=%d/groups=%d/key=%s/nulls=%g/chunks=%d" % self
+
+
+class Case(NamedTuple):
+    """One thing to time."""
+
+    name: str
+    spec: TableSpec
+    run: Any
+    """Function of a table."""
+
+
+def make_key_codes(n_rows: int, n_groups: int, rng: np.random.Generator) -> np.array:
+    """Assign each row a group number in `range(n_groups)`, in random order.
+
+    Every group is used (so `n_groups` is exact) when `n_groups <= n_rows`.
+    """
+    codes = np.arange(n_rows) % n_groups
+    rng.shuffle(codes)
+    return codes
+
+
+def make_null_mask(
+    n_rows: int, null_fraction: float, rng: np.random.Generator
+) -> Optional[np.array]:
+    if not null_fraction:
+        return None
+    return rng.random(n_rows) < null_fraction
+
+
+def make_key_columns(
+    codes: np.array, n_groups: int, key_type: str, mask: Optional[np.array]
+) -> Dict[str, pa.Array]:
+    if key_type == "int":
+        return {"k": pa.array(codes, mask=mask)}
+    elif key_type == "float":
+        return {"k": pa.array(codes * 0.5, mask=mask)}
+    elif key_type in {"utf8", "dictionary"}:
+        dictionary = pa.array(["key-%d" % i for i in range(n_groups)])
+        indices = pa.array(codes.astype(np.int32), mask=mask)
+        array = pa.DictionaryArray.from_arrays(indices, dictionary)
+        if key_type == "utf8":
+            array = array.cast(pa.utf8())
+        return {"k": array}
+    elif key_type == "timestamp":
+        values = TIMESTAMP_START + codes * TIMESTAMP_STEP
+        return {"k": pa.array(values, pa.timestamp("ns"), mask=mask)}
+    elif key_type == "multi":
+        # Two int columns whose combinations make `n_groups` groups
+        width = int(np.ceil(np.sqrt(n_groups)))
+        return {
+            "k": pa.array(codes // width, mask=mask),
+            "k2": pa.array((codes % width).astype(np.int32)),
+        }
+    else:
+        raise ValueError("unknown key type %r" % key_type)
+
+
+def make_benchmark_table(spec: TableSpec, seed: int = 0) -> pa.Table:
+    """Build a table with key columns "k" (and "k2"), plus value columns.
+
+    "v" is float64 with a few hundred distinct values; "t" is low-cardinality
+    text. Both have `spec.null_fraction` nulls, as do the keys.
+    """
+    rng = np.random.default_rng(seed)
+    codes = make_key_codes(spec.n_rows, spec.n_groups, rng)
+    columns = make_key_columns(
+        codes,
+        spec.n_groups,
+        spec.key_type,
+        make_null_mask(spec.n_rows, spec.null_fraction, rng),
+    )
+    columns["v"] = pa.array(
+        rng.integers(0, 1000, spec.n_rows) / 4,
+        mask=make_null_mask(spec.n_rows, spec.null_fraction, rng),
+    )
+    words = pa.array(["alpha", "beta", "gamma", "delta", "epsilon"])
+    columns["t"] = pa.DictionaryArray.from_arrays(
+        pa.array(
+            rng.integers(0, len(words), spec.n_rows).astype(np.int32),
+            mask=make_null_mask(spec.n_rows, spec.null_fraction, rng),
+        ),
+        words,
+    ).cast(pa.utf8())
+    table = pa.table(columns)
+    if spec.n_chunks > 1:
+        bounds = np.linspace(0, spec.n_rows, spec.n_chunks + 1).astype(int)
+        table = pa.Table.from_batches(
+            [
+                batch
+                for start, stop in zip(bounds[:-1], bounds[1:])
+                for batch in table.slice(start, stop - start).to_batches()
+            ],
+            schema=table.schema,
+        )
+    return table
+
+
+def make_aggregation(operation: Operation) -> Aggregation:
+    colname = {
+        Operation.SIZE: "",
+        Operation.FIRST: "t",
+        Operation.MOST_FREQUENT: "t",
+    }.get(operation, "v")
+    percentile = 90.0 if operation == Operation.APPROX_PERCENTILE else None
+    return Aggregation(operation, colname, "out", percentile=percentile)
+
+
+def make_groups(spec: TableSpec, granularity: Optional[DateGranularity]):
+    if spec.key_type == "multi":
+        return [Group("k", None), Group("k2", None)]
+    return [Group("k", granularity)]
+
+
+def make_render_params(
+    spec: TableSpec, operation: Operation, granularity: Optional[DateGranularity]
+) -> Dict[str, Any]:
+    aggregation = make_aggregation(operation)
+    return {
+        "groups": {
+            "colnames": [group.colname for group in make_groups(spec, granularity)],
+            "group_dates": granularity is not None,
+            "date_granularities": {"k": granularity.value} if granularity else {},
+        },
+        "aggregations": [
+            {
+                "operation": operation.value,
+                "colname": aggregation.colname,
+                "outname": aggregation.outname,
+                "percentile": aggregation.percentile or 50.0,
+            }
+        ],
+    }
+
+
+def make_cases(specs: List[TableSpec], render: bool) -> Iterator[Case]:
+    """Time every `Operation`, and every `DateGranularity` of timestamp keys."""
+    for spec in specs:
+        granularities = [None]
+        if spec.key_type == "timestamp":
+            granularities.extend(DateGranularity)
+        for granularity in granularities:
+            suffix = "/granularity=%s" % granularity.value if granularity else ""
+            for operation in Operation:
+                aggregations = [make_aggregation(operation)]
+                groups = make_groups(spec, granularity)
+                yield Case(
+                    "groupby/%s/op=%s%s" % (spec.name, operation.value, suffix),
+                    spec,
+                    lambda table, groups=groups, aggregations=aggregations: groupby(
+                        table, groups, aggregations
+                    ),
+                )
+                if render:
+                    params = make_render_params(spec, operation, granularity)
+                    yield Case(
+                        "render/%s/op=%s%s" % (spec.name, operation.value, suffix),
+                        spec,
+                        lambda table, params=params: render_arrow_v1(table, params),
+                    )
+
+
+def time_case(case: Case, table: pa.Table, repeat: int) -> Dict[str, Any]:
+    """Run `case` `repeat` times; report the fastest and median wall times."""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case.run(table)
+        seconds.append(time.perf_counter() - start)
+    return {
+        "name": case.name,
+        **case.spec._asdict(),
+        "repeat": repeat,
+        "min_seconds": float(np.min(seconds)),
+        "median_seconds": float(np.median(seconds)),
+    }
+
+
+def run_benchmarks(
+    specs: List[TableSpec], repeat: int, render: bool, pattern: str
+) -> List[Dict[str, Any]]:
+    results = []
+    table_spec = None
+    for case in make_cases(specs, render):
+        if pattern not in case.name:
+            continue
+        if case.spec != table_spec:
+            table_spec = case.spec
+            table = make_benchmark_table(table_spec)
+        result = time_case(case, table, repeat)
+        print("%10.4fs  %s" % (result["min_seconds"], case.name), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def compare_to_baseline(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], max_ratio: float
+) -> List[Dict[str, Any]]:
+    """List results slower than `max_ratio` times their baseline.
+
+    We compare `min_seconds`, the least noisy measure. Cases missing from
+    either side are ignored.
+    """
+    baseline_seconds = {result["name"]: result["min_seconds"] for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline_seconds.get(result["name"])
+        if old and result["min_seconds"] > old * max_ratio:
+            regressions.append(
+                dict(result, baseline_seconds=old, ratio=result["min_seconds"] / old)
+            )
+    return regressions
+
+
+def parse_n_groups(value: str, n_rows: int) -> int:
+    """Parse "100" as 100 groups; "n" as one group per row; "0.1" as n/10."""
+    if value == "n":
+        return n_rows
+    elif "." in value:
+        return max(1, int(n_rows * float(value)))
+    else:
+        return min(int(value), n_rows)
+
+
+def comma_list(parse):
+    return lambda value: [parse(item) for item in value.split(",") if item]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--rows", type=comma_list(int), default=[1_000, 100_000, 1_000_000]
+    )
+    parser.add_argument(
+        "--groups",
+        type=comma_list(str),
+        default=["1", "100", "0.1", "n"],
+        help='group counts: "100", a fraction of rows like "0.1", or "n"',
+    )
+    parser.add_argument(
+        "--keys", type=comma_list(str), default=KEY_TYPES, help=",".join(KEY_TYPES)
+    )
+    parser.add_argument("--nulls", type=comma_list(float), default=[0.0, 0.1])
+    parser.add_argument("--chunks", type=comma_list(int), default=[1, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-render", dest="render", action="store_false")
+    parser.add_argument(
+        "--filter", default="", help="only run cases whose name contains this"
+    )
+    parser.add_argument("--output", type=Path, help="write JSON results here")
+    parser.add_argument("--baseline", type=Path, help="JSON results to compare to")
+    parser.add_argument("--max-ratio", type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    specs = []
+    for n_rows in args.rows:
+        n_groups_list = sorted(set(parse_n_groups(g, n_rows) for g in args.groups))
+        for n_groups in n_groups_list:
+            for key_type in args.keys:
+                if key_type not in KEY_TYPES:
+                    parser.error("unknown key type %r" % key_type)
+                for null_fraction in args.nulls:
+                    for n_chunks in args.chunks:
+                        specs.append(
+                            TableSpec(
+                                n_rows, n_groups, key_type, null_fraction, n_chunks
+                            )
+                        )
+
+    results = run_benchmarks(specs, args.repeat, args.render, args.filter)
+    output = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pyarrow": pa.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(output, indent=2))
+    else:
+        json.dump(output, sys.stdout, indent=2)
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        regressions = compare_to_baseline(results, baseline, args.max_ratio)
+        for regression in regressions:
+            print(
+                "REGRESSION %.2fx (%.4fs vs %.4fs)  %s"
+                % (
+                    regression["ratio"],
+                    regression["min_seconds"],
+                    regression["baseline_seconds"],
+                    regression["name"],
+                ),
+                file=sys.stderr,
+            )
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
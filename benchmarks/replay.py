@@ -0,0 +1,170 @@
+"""Replay captured render workloads and report their latency distribution.
+
+Capture workloads with GROUPBY_CAPTURE_DIR (see `capture_workload()` in
+groupby.py), then run from the repository root:
+
+    python benchmarks/replay.py /path/to/captures --output replay.json
+
+A workload captured with data replays on its (hashed) data. Otherwise -- or
+with `--synthesize` -- we generate a table with the captured schema, row
+count, chunk count, null counts and distinct-value counts.
+"""
+
+import argparse
+import base64
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmark import TIMESTAMP_START, TIMESTAMP_STEP, make_key_codes  # noqa: E402
+
+from groupby import render_arrow_v1  # noqa: E402
+
+
+def synthesize_array(
+    field: pa.Field, stats: Dict[str, Any], n_rows: int, rng: np.random.Generator
+) -> pa.Array:
+    """Generate `n_rows` values of `field.type` that match `stats`."""
+    n_distinct = np.clip(stats["n_distinct"], 1, max(n_rows, 1))
+    codes = make_key_codes(n_rows, n_distinct, rng)
+    if stats["is_sorted"]:
+        codes.sort()
+    mask = np.zeros(n_rows, np.bool_)
+    mask[rng.choice(n_rows, stats["null_count"], replace=False)] = True
+
+    value_type = field.type
+    if pa.types.is_dictionary(value_type):
+        value_type = value_type.value_type
+    if pa.types.is_string(value_type):
+        dictionary = pa.array(["v%d" % i for i in range(n_distinct)])
+        array = pa.DictionaryArray.from_arrays(
+            pa.array(codes.astype(np.int32), mask=mask), dictionary
+        )
+        return array if pa.types.is_dictionary(field.type) else array.cast(pa.utf8())
+    elif pa.types.is_timestamp(value_type):
+        values = TIMESTAMP_START + codes * TIMESTAMP_STEP
+        return pa.array(values, pa.timestamp("ns"), mask=mask).cast(value_type)
+    elif pa.types.is_date(value_type):
+        values = codes.astype(np.int32) + 18262  # 2020-01-01
+        return pa.array(values, mask=mask).view(pa.date32()).cast(value_type)
+    elif pa.types.is_floating(value_type):
+        return pa.array(codes * 0.5, mask=mask).cast(value_type)
+    else:
+        # Spread codes over the captured range, so Engine.DIRECT sees it too
+        step = max(1, (stats["max_codes"] or 1) // n_distinct)
+        return pa.array(codes * step, mask=mask).cast(value_type, safe=False)
+
+
+def synthesize_table(
+    workload: Dict[str, Any], schema: pa.Schema, seed: int = 0
+) -> pa.Table:
+    rng = np.random.default_rng(seed)
+    n_rows = workload["n_rows"]
+    table = pa.Table.from_arrays(
+        [
+            synthesize_array(field, stats, n_rows, rng)
+            for field, stats in zip(schema, workload["columns"])
+        ],
+        schema=schema,
+    )
+    if workload["n_chunks"] > 1:
+        bounds = np.linspace(0, n_rows, workload["n_chunks"] + 1).astype(int)
+        table = pa.Table.from_batches(
+            [
+                batch
+                for start, stop in zip(bounds[:-1], bounds[1:])
+                for batch in table.slice(start, stop - start).to_batches()
+            ],
+            schema=schema,
+        )
+    return table
+
+
+def load_workload(path: Path, synthesize: bool) -> Tuple[Dict[str, Any], pa.Table]:
+    workload = json.loads(path.read_text())
+    schema = pa.ipc.read_schema(pa.py_buffer(base64.b64decode(workload["schema"])))
+    if workload["data"] and not synthesize:
+        with pa.OSFile(str(path.parent / workload["data"])) as f:
+            return workload, pa.ipc.open_file(f).read_all()
+    return workload, synthesize_table(workload, schema)
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    return {
+        "n": len(seconds),
+        "mean": float(np.mean(seconds)),
+        "p50": float(np.percentile(seconds, 50)),
+        "p90": float(np.percentile(seconds, 90)),
+        "p99": float(np.percentile(seconds, 99)),
+        "max": float(np.max(seconds)),
+    }
+
+
+def replay(paths: List[Path], repeat: int, synthesize: bool) -> Dict[str, Any]:
+    """Render each workload `repeat` times; report per-workload and overall."""
+    workloads = []
+    all_seconds = []
+    for path in paths:
+        workload, table = load_workload(path, synthesize)
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            render_arrow_v1(table, workload["params"])
+            seconds.append(time.perf_counter() - start)
+        all_seconds.extend(seconds)
+        workloads.append(
+            {
+                "path": path.name,
+                "params_digest": workload["params_digest"],
+                "n_rows": workload["n_rows"],
+                "captured_seconds": workload["seconds"],
+                "seconds": percentiles(seconds),
+            }
+        )
+        print(
+            "%10.4fs (captured %.4fs)  %s"
+            % (np.median(seconds), workload["seconds"], path.name),
+            file=sys.stderr,
+        )
+    return {
+        "workloads": workloads,
+        "seconds": percentiles(all_seconds) if all_seconds else None,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory", type=Path, help="GROUPBY_CAPTURE_DIR")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--synthesize", action="store_true", help="ignore captured data"
+    )
+    parser.add_argument("--output", type=Path, help="write JSON results here")
+    args = parser.parse_args(argv)
+
+    paths = sorted(args.directory.glob("workload-*.json"))
+    if not paths:
+        parser.error("no workload-*.json files in %s" % args.directory)
+    result = replay(paths, args.repeat, args.synthesize)
+    print(
+        "%d renders: p50 %.4fs, p90 %.4fs, p99 %.4fs, max %.4fs"
+        % tuple(result["seconds"][k] for k in ("n", "p50", "p90", "p99", "max")),
+        file=sys.stderr,
+    )
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2))
+    else:
+        json.dump(result, sys.stdout, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,23 @@
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import hashlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
 from enum import Enum
+from pathlib import Path
 from typing import (
     Any,
     Callable,
+    ContextManager,
     Dict,
     FrozenSet,
     Iterator,
@@ -9,11 +25,13 @@ from typing import (
     NamedTuple,
     Optional,
     Tuple,
+    Union,
 )
 
 import numpy as np
 import pyarrow as pa
 import pyarrow.compute
+import pyarrow.ipc
 from cjwmodule import i18n
 from cjwmodule.arrow.types import ArrowRenderResult
 from cjwmodule.types import QuickFix, QuickFixAction, RenderError
@@ -43,6 +61,8 @@ def migrate_params(params):
         params = _migrate_params_v1_to_v2(params)
     if isinstance(params["groups"]["colnames"], str):
         params = _migrate_params_v2_to_v3(params)
+    if any("percentile" not in agg for agg in params["aggregations"]):
+        params = _migrate_params_v3_to_v4(params)
 
     return params
 
@@ -172,6 +192,19 @@ def _migrate_params_v2_to_v3(params):
     }
 
 
+def _migrate_params_v3_to_v4(params):
+    """
+    v4 adds params['aggregations'][i]['percentile'], for "approx_percentile".
+    """
+    return {
+        "groups": params["groups"],
+        "aggregations": [
+            {"percentile": 50.0, **aggregation}
+            for aggregation in params["aggregations"]
+        ],
+    }
+
+
 class DateGranularity(Enum):
     # Frequencies are as in pandas. See
     # http://pandas.pydata.org/pandas-docs/stable/timeseries.html#offset-aliases
@@ -213,6 +246,18 @@ class DateGranularity(Enum):
             self.SECOND: "second",
         }[self]
 
+    def nests_in(self, other: "DateGranularity") -> bool:
+        """Return True if every `self` bucket lies within one `other` bucket.
+
+        Weeks are the odd ones out: a week can straddle two months.
+        """
+        order = list(DateGranularity)
+        if self == self.WEEK:
+            return other == self.WEEK
+        if other == self.WEEK:
+            return order.index(self) <= order.index(self.DAY)
+        return order.index(self) <= order.index(other)
+
 
 def nonnull_group_splits(array: pa.Array, group_splits: np.array) -> np.array:
     # in an array [null, 1, null, 2, null]
@@ -234,17 +279,6 @@ def size(*, num_rows: int, group_splits: np.array, **kwargs) -> pa.Array:
     return pa.array(ends - starts, pa.int64())
 
 
-def nunique(*, array: pa.Array, group_splits: np.array, **kwargs) -> pa.Array:
-    nonnull_splits = nonnull_group_splits(array, group_splits)
-    nonnull_values = array.filter(array.is_valid()).to_numpy(zero_copy_only=False)
-    counts = np.fromiter(
-        (np.unique(subarr).size for subarr in np.split(nonnull_values, nonnull_splits)),
-        dtype=np.int64,
-        count=len(nonnull_splits) + 1,
-    )
-    return pa.array(counts)
-
-
 def first(*, array: pa.Array, group_splits: np.array, **kwargs) -> pa.Array:
     nonnull_values = array.filter(array.is_valid())
     nonnull_splits = nonnull_group_splits(array, group_splits)
@@ -255,75 +289,873 @@ def first(*, array: pa.Array, group_splits: np.array, **kwargs) -> pa.Array:
     return nonnull_values.take(indices)  # taking index NULL gives NULL
 
 
-def iter_splits(splits: np.array, limit: int) -> Iterator[Tuple[int, int]]:
-    if len(splits):
-        yield (0, splits[0])
-        yield from zip(splits[0:], splits[1:])
-        yield (splits[-1], limit)
-    else:
-        yield (0, limit)
-
-
 def sum(*, array: pa.Array, group_splits: np.array, **kwargs) -> pa.Array:
     if pa.types.is_integer(array.type):
         array = array.cast(pa.int64())
-        zero = 0
+        dtype = np.int64
     else:
-        zero = 0.0
-
-    def arrow_sum_never_none(scalar: pa.Scalar):
-        if scalar.is_valid:
-            return scalar.as_py()
-        else:
-            return zero
-
-    return pa.array(
-        (
-            arrow_sum_never_none(pa.compute.sum(array[begin:end]))
-            for begin, end in iter_splits(group_splits, len(array))
-        ),
-        array.type,
-    )
+        dtype = np.float64
+    if array.null_count:
+        array = pa.compute.fill_null(array, pa.scalar(0, array.type))
+    values = array.to_numpy(zero_copy_only=False)
+    if len(values):
+        # Sorted groups are never empty, so every start is a valid index
+        sums = np.add.reduceat(values, np.insert(group_splits, 0, 0), dtype=dtype)
+    else:
+        sums = np.zeros(len(group_splits) + 1, dtype)
+    return pa.array(sums.astype(array.type.to_pandas_dtype()), array.type)
 
 
 def build_ufunc_wrapper(
-    np_func: Callable[[Any], np.array], force_otype=None
+    np_ufunc: np.ufunc, mean: bool = False
 ) -> Callable[..., pa.Array]:
-    def call_ufunc(
-        values: np.array, group_splits: np.array, otype, zero
-    ) -> Tuple[np.array, np.array]:
-        starts = np.append([0], group_splits)
-        ends = np.append(group_splits, len(values))
-        values = [
-            zero if start == end else np_func(values[start:end])
-            for start, end in zip(starts, ends)
-        ]
-        empty_indices = starts == ends
-        return np.array(values, dtype=otype), empty_indices
+    """Build a kernel that reduces each group's non-null values with `np_ufunc`.
+
+    One `np_ufunc.reduceat()` call handles all groups. Groups with no values
+    are null. With `mean=True`, divide each group's result by its size.
+    """
 
     def ufunc_caller(*, array: pa.Array, group_splits: np.array, **kwargs) -> pa.Array:
         nonnull_splits = nonnull_group_splits(array, group_splits)
         nonnull_values = array.filter(array.is_valid()).to_numpy(zero_copy_only=False)
-        if force_otype:
-            otype = force_otype
-        else:
-            otype = nonnull_values.dtype
+        if mean:
+            nonnull_values = nonnull_values.astype(np.float64)
+        starts = np.insert(nonnull_splits, 0, 0)
+        counts = np.diff(np.append(starts, len(nonnull_values)))
+        empty = counts == 0
         if pa.types.is_unicode(array.type):
-            zero = ""
+            result = np.full(len(starts), "", object)
         else:
-            zero = otype.type()
-        np_result, np_empty_indices = call_ufunc(
-            nonnull_values, nonnull_splits, otype, zero
-        )
-        return pa.array(np_result, mask=np_empty_indices)
+            result = np.zeros(len(starts), nonnull_values.dtype)
+        if len(nonnull_values):
+            # Empty groups' starts repeat a neighbor's: reduce only the others
+            result[~empty] = np_ufunc.reduceat(nonnull_values, starts[~empty])
+        if mean:
+            with np.errstate(invalid="ignore"):
+                result = result / counts
+        return pa.array(result, mask=empty)
 
     return ufunc_caller
 
 
-mean = build_ufunc_wrapper(np.mean, force_otype=np.dtype("float64"))
-median = build_ufunc_wrapper(np.median, force_otype=np.dtype("float64"))
-min = build_ufunc_wrapper(np.amin)
-max = build_ufunc_wrapper(np.amax)
+mean = build_ufunc_wrapper(np.add, mean=True)
+min = build_ufunc_wrapper(np.minimum)
+max = build_ufunc_wrapper(np.maximum)
+
+
+# "By-id" aggregations read the _unsorted_ input. Each row has a group id
+# (-1 means "not in any group"); we scatter values into per-group slots.
+
+
+def dictionary_ranks(dictionary: pa.Array) -> Tuple[np.array, int]:
+    """Return `(ranks, n_ranks)`: each value's position in sort order.
+
+    Equal values share a rank, so ranks are dense: 0, 1, ..., n_ranks - 1.
+    """
+    if len(dictionary) == 0:
+        return np.array([], np.int64), 0
+    order = pa.compute.sort_indices(dictionary).to_numpy()
+    sorted_values = dictionary.take(order)
+    is_new = ~pa.compute.equal(sorted_values[:-1], sorted_values[1:]).to_numpy(
+        zero_copy_only=False
+    )
+    dense_ranks = np.insert(np.cumsum(is_new), 0, 0)
+    ranks = np.empty(len(dictionary), np.int64)
+    ranks[order] = dense_ranks
+    return ranks, int(dense_ranks[-1]) + 1
+
+
+def valid_row_mask(array: pa.Array, group_ids: np.array) -> np.array:
+    """Find rows that are in a group and are not null."""
+    mask = group_ids >= 0
+    if array.null_count:
+        mask &= array.is_valid().to_numpy(zero_copy_only=False)
+    return mask
+
+
+def nonnull_values_by_id(
+    array: pa.Array, group_ids: np.array
+) -> Tuple[np.array, np.array]:
+    """Return `(ids, values)` for rows that are in a group and are not null."""
+    mask = valid_row_mask(array, group_ids)
+    if array.null_count:
+        array = pa.compute.fill_null(array, pa.scalar(0, array.type))
+    return group_ids[mask], array.to_numpy(zero_copy_only=False)[mask]
+
+
+def nonnull_codes_by_id(
+    array: pa.Array, group_ids: np.array
+) -> Tuple[np.array, np.array, pa.Array]:
+    """Return `(ids, codes, dictionary)` for rows in a group and not null.
+
+    `dictionary.take(codes)` gives the values. Codes are dense and in sort
+    order: comparing codes is the same as comparing values.
+    """
+    mask = valid_row_mask(array, group_ids)
+    if not pa.types.is_dictionary(array.type):
+        array = array.dictionary_encode()
+    ranks, n_ranks = dictionary_ranks(array.dictionary)
+    # Invert `ranks` to make a dictionary with no duplicates, in rank order
+    rank_indices = np.empty(n_ranks, np.int64)
+    rank_indices[ranks] = np.arange(len(ranks))
+    indices = array.indices
+    if indices.null_count:
+        indices = pa.compute.fill_null(indices, pa.scalar(0, indices.type))
+    codes = ranks[indices.to_numpy(zero_copy_only=False)[mask]]
+    return group_ids[mask], codes, array.dictionary.take(rank_indices)
+
+
+def size_by_id(*, group_ids: np.array, n_groups: int, **kwargs) -> pa.Array:
+    return pa.array(
+        np.bincount(group_ids[group_ids >= 0], minlength=n_groups), pa.int64()
+    )
+
+
+def first_rows_by_id(
+    *, array: pa.Array, group_ids: np.array, n_groups: int, **kwargs
+) -> pa.Array:
+    """Return the index of each group's first non-null value (or null)."""
+    rows = np.flatnonzero(valid_row_mask(array, group_ids))
+    first_rows = np.full(n_groups, len(array), np.int64)
+    np.minimum.at(first_rows, group_ids[rows], rows)
+    return pa.array(first_rows, pa.int64(), mask=first_rows == len(array))
+
+
+def sum_by_id(
+    *, array: pa.Array, group_ids: np.array, n_groups: int, **kwargs
+) -> pa.Array:
+    ids, values = nonnull_values_by_id(array, group_ids)
+    if pa.types.is_integer(array.type):
+        values = values.astype(np.int64)
+        if (
+            len(values)
+            and np.maximum(-float(values.min()), float(values.max())) * len(values)
+            >= 2**53
+        ):
+            # np.bincount() sums float64, which loses precision past 2^53
+            sums = np.zeros(n_groups, np.int64)
+            np.add.at(sums, ids, values)
+        else:
+            sums = np.bincount(ids, weights=values, minlength=n_groups).astype(np.int64)
+        return pa.array(sums, pa.int64())
+    else:
+        sums = np.bincount(ids, weights=values, minlength=n_groups)
+        return pa.array(sums.astype(array.type.to_pandas_dtype()), array.type)
+
+
+def build_extreme_by_id(np_ufunc: np.ufunc) -> Callable[..., pa.Array]:
+    def extreme_number_by_id(
+        array: pa.Array, group_ids: np.array, n_groups: int
+    ) -> pa.Array:
+        ids, values = nonnull_values_by_id(array, group_ids)
+        result = np.zeros(n_groups, values.dtype)
+        result[ids] = values  # seed each slot with one of its own values
+        np_ufunc.at(result, ids, values)
+        empty = np.bincount(ids, minlength=n_groups) == 0
+        return pa.array(result, array.type, mask=empty)
+
+    def extreme_by_id(
+        *, array: pa.Array, group_ids: np.array, n_groups: int, **kwargs
+    ) -> pa.Array:
+        if pa.types.is_integer(array.type) or pa.types.is_floating(array.type):
+            return extreme_number_by_id(array, group_ids, n_groups)
+        elif pa.types.is_timestamp(array.type) or pa.types.is_date(array.type):
+            int_type = pa.int64() if array.type.bit_width == 64 else pa.int32()
+            return extreme_number_by_id(array.view(int_type), group_ids, n_groups).view(
+                array.type
+            )
+        else:
+            # Text: compare codes, then look up the values they stand for
+            ids, codes, dictionary = nonnull_codes_by_id(array, group_ids)
+            result = np.zeros(n_groups, np.int64)
+            result[ids] = codes
+            np_ufunc.at(result, ids, codes)
+            empty = np.bincount(ids, minlength=n_groups) == 0
+            return dictionary.take(pa.array(result, pa.int64(), mask=empty))
+
+    return extreme_by_id
+
+
+min_by_id = build_extreme_by_id(np.minimum)
+max_by_id = build_extreme_by_id(np.maximum)
+
+
+# A "partial" is the mergeable state of one aggregation over some groups.
+#
+# `partial.merge(group_ids, n_groups)` combines groups into bigger groups:
+# partial group `i` goes into new group `group_ids[i]` (or nowhere, if -1).
+# `partial.finish()` computes the aggregation's values, one per group.
+
+
+class SumPartial(NamedTuple):
+    sums: pa.Array
+
+    @classmethod
+    def start(cls, array: pa.Array, group_ids: np.array, n_groups: int):
+        return cls(sum_by_id(array=array, group_ids=group_ids, n_groups=n_groups))
+
+    def merge(self, group_ids: np.array, n_groups: int) -> "SumPartial":
+        return SumPartial(
+            sum_by_id(array=self.sums, group_ids=group_ids, n_groups=n_groups)
+        )
+
+    def finish(self) -> pa.Array:
+        return self.sums
+
+
+class MeanPartial(NamedTuple):
+    sums: np.array
+    counts: np.array
+
+    @classmethod
+    def start(cls, array: pa.Array, group_ids: np.array, n_groups: int):
+        ids, values = nonnull_values_by_id(array, group_ids)
+        return cls(
+            np.bincount(ids, weights=values.astype(np.float64), minlength=n_groups),
+            np.bincount(ids, minlength=n_groups),
+        )
+
+    def merge(self, group_ids: np.array, n_groups: int) -> "MeanPartial":
+        mask = group_ids >= 0
+        ids = group_ids[mask]
+        return MeanPartial(
+            np.bincount(ids, weights=self.sums[mask], minlength=n_groups),
+            np.bincount(ids, weights=self.counts[mask], minlength=n_groups).astype(
+                np.int64
+            ),
+        )
+
+    def finish(self) -> pa.Array:
+        with np.errstate(invalid="ignore"):
+            means = self.sums / self.counts
+        return pa.array(means, pa.float64(), mask=self.counts == 0)
+
+
+class ExtremePartial(NamedTuple):
+    values: pa.Array
+    extreme_by_id: Callable[..., pa.Array]
+    """`min_by_id` or `max_by_id`."""
+
+    @classmethod
+    def start(
+        cls,
+        array: pa.Array,
+        group_ids: np.array,
+        n_groups: int,
+        extreme_by_id: Callable[..., pa.Array],
+    ):
+        return cls(
+            extreme_by_id(array=array, group_ids=group_ids, n_groups=n_groups),
+            extreme_by_id,
+        )
+
+    def merge(self, group_ids: np.array, n_groups: int) -> "ExtremePartial":
+        return self._replace(
+            values=self.extreme_by_id(
+                array=self.values, group_ids=group_ids, n_groups=n_groups
+            )
+        )
+
+    def finish(self) -> pa.Array:
+        return self.values
+
+
+class FirstPartial(NamedTuple):
+    array: pa.Array
+    """All input values."""
+
+    rows: pa.Array
+    """Index into `array` of each group's first non-null value (or null)."""
+
+    @classmethod
+    def start(cls, array: pa.Array, group_ids: np.array, n_groups: int):
+        return cls(
+            array,
+            first_rows_by_id(array=array, group_ids=group_ids, n_groups=n_groups),
+        )
+
+    def merge(self, group_ids: np.array, n_groups: int) -> "FirstPartial":
+        return self._replace(
+            rows=min_by_id(array=self.rows, group_ids=group_ids, n_groups=n_groups)
+        )
+
+    def finish(self) -> pa.Array:
+        return self.array.take(self.rows)  # taking index NULL gives NULL
+
+
+class NuniquePartial(NamedTuple):
+    ids: np.array
+    codes: np.array
+    """Distinct `(ids[i], codes[i])` pairs: one per unique value per group."""
+
+    n_codes: int
+    n_groups: int
+
+    @classmethod
+    def start(cls, array: pa.Array, group_ids: np.array, n_groups: int):
+        ids, codes, dictionary = nonnull_codes_by_id(array, group_ids)
+        return cls(ids, codes, len(dictionary), n_groups).deduplicate()
+
+    def deduplicate(self) -> "NuniquePartial":
+        if not len(self.ids):
+            return self
+        pairs = self.ids * self.n_codes + self.codes
+        unique_pairs = pa.compute.unique(pa.array(pairs)).to_numpy()
+        return self._replace(
+            ids=unique_pairs // self.n_codes, codes=unique_pairs % self.n_codes
+        )
+
+    def merge(self, group_ids: np.array, n_groups: int) -> "NuniquePartial":
+        ids = group_ids[self.ids]
+        mask = ids >= 0
+        return NuniquePartial(
+            ids[mask], self.codes[mask], self.n_codes, n_groups
+        ).deduplicate()
+
+    def finish(self) -> pa.Array:
+        return pa.array(np.bincount(self.ids, minlength=self.n_groups), pa.int64())
+
+
+class MedianPartial(NamedTuple):
+    ids: np.array
+    values: np.array
+    """Every non-null value, with its group id. (Medians can't be combined.)"""
+
+    n_groups: int
+
+    @classmethod
+    def start(cls, array: pa.Array, group_ids: np.array, n_groups: int):
+        ids, values = nonnull_values_by_id(array, group_ids)
+        return cls(ids, values, n_groups)
+
+    def merge(self, group_ids: np.array, n_groups: int) -> "MedianPartial":
+        ids = group_ids[self.ids]
+        mask = ids >= 0
+        return MedianPartial(ids[mask], self.values[mask], n_groups)
+
+    def finish(self) -> pa.Array:
+        order = np.lexsort((self.values, self.ids))  # sort by id, then by value
+        sorted_values = self.values[order].astype(np.float64)
+        counts = np.bincount(self.ids, minlength=self.n_groups)
+        empty = counts == 0
+        if len(sorted_values):
+            starts = np.cumsum(counts) - counts
+            lows = np.where(empty, 0, starts + (counts - 1) // 2)
+            highs = np.where(empty, 0, starts + counts // 2)
+            medians = (sorted_values[lows] + sorted_values[highs]) / 2
+        else:
+            medians = np.zeros(self.n_groups, np.float64)
+        return pa.array(medians, pa.float64(), mask=empty)
+
+
+def splitmix64(x: np.array) -> np.array:
+    """Scramble uint64 values (in place): a fast, high-quality 64-bit hash."""
+    x += np.uint64(0x9E3779B97F4A7C15)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+
+HASH_TEXT_BATCH_BYTES = 1 << 24
+"""Bytes of text to hash at a time, to bound temporary memory."""
+
+
+def hash_text(array: pa.Array) -> np.array:
+    """Hash each utf8 value to uint64, without a Python loop.
+
+    Each byte is hashed with its position; a value's hash is the XOR of its
+    bytes' hashes, mixed with its length. Null values' hashes are garbage.
+    """
+    _, offsets_buffer, data_buffer = array.buffers()
+    offsets = np.frombuffer(offsets_buffer, np.int32)[
+        array.offset : array.offset + len(array) + 1
+    ].astype(np.int64)
+    if data_buffer is None:
+        data = np.zeros(0, np.uint8)
+    else:
+        data = np.frombuffer(data_buffer, np.uint8)
+    lengths = np.diff(offsets)
+    hashes = np.zeros(len(array), np.uint64)
+    batch_start = 0
+    while batch_start < len(array):
+        batch_end = int(
+            np.searchsorted(
+                offsets, offsets[batch_start] + HASH_TEXT_BATCH_BYTES, side="right"
+            )
+        )
+        batch_end = np.clip(batch_end - 1, batch_start + 1, len(array))
+        batch_lengths = lengths[batch_start:batch_end]
+        byte_values = data[offsets[batch_start] : offsets[batch_end]].astype(np.uint64)
+        value_starts = offsets[batch_start:batch_end] - offsets[batch_start]
+        positions = np.arange(len(byte_values)) - np.repeat(value_starts, batch_lengths)
+        byte_hashes = splitmix64(
+            byte_values | (positions.astype(np.uint64) << np.uint64(8))
+        )
+        nonempty = np.flatnonzero(batch_lengths)
+        if len(nonempty):
+            hashes[batch_start + nonempty] = np.bitwise_xor.reduceat(
+                byte_hashes, value_starts[nonempty]
+            )
+        batch_start = batch_end
+    return splitmix64(hashes ^ splitmix64(lengths.astype(np.uint64)))
+
+
+def hash_values(array: pa.Array) -> np.array:
+    """Hash each value to uint64. Equal values get equal hashes.
+
+    Null values' hashes are garbage.
+    """
+    if pa.types.is_dictionary(array.type):
+        dictionary_hashes = hash_values(array.dictionary)
+        indices = pa.compute.fill_null(array.indices, pa.scalar(0, array.indices.type))
+        return dictionary_hashes[indices.to_numpy(zero_copy_only=False)]
+    elif pa.types.is_string(array.type):
+        return hash_text(array)
+    elif pa.types.is_timestamp(array.type) or pa.types.is_date(array.type):
+        int_type = pa.int64() if array.type.bit_width == 64 else pa.int32()
+        return hash_values(array.view(int_type))
+    else:
+        values = pa.compute.fill_null(array, pa.scalar(0, array.type))
+        values = values.to_numpy(zero_copy_only=False)
+        if values.dtype.kind == "f":
+            values = values.astype(np.float64) + 0.0  # -0.0 => 0.0
+        else:
+            values = values.astype(np.int64)
+        return splitmix64(values.view(np.uint64).copy())
+
+
+def leading_zeros64(x: np.array) -> np.array:
+    """Count leading zero bits of each uint64 (64 for 0)."""
+    counts = np.zeros(len(x), np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        top_is_zero = (x >> np.uint64(64 - shift)) == 0
+        counts += np.where(top_is_zero, shift, 0)
+        x = np.where(top_is_zero, x << np.uint64(shift), x)
+    return counts + (x == 0)
+
+
+HLL_PRECISION = 14
+"""HyperLogLog uses 2^14 registers per group: about 0.8% standard error."""
+
+
+class HyperLogLogPartial(NamedTuple):
+    keys: np.array
+    """Sorted, distinct `group_id * 2^HLL_PRECISION + register` of each
+    nonzero register. (Sparse: small groups cost little.)"""
+
+    ranks: np.array
+    """Each register's value: max over its hashes of leading zeros plus one."""
+
+    n_groups: int
+
+    @classmethod
+    def start(cls, array: pa.Array, group_ids: np.array, n_groups: int):
+        mask = valid_row_mask(array, group_ids)
+        hashes = hash_values(array)[mask]
+        registers = (hashes >> np.uint64(64 - HLL_PRECISION)).astype(np.int64)
+        ranks = (
+            np.minimum(
+                leading_zeros64(hashes << np.uint64(HLL_PRECISION)),
+                64 - HLL_PRECISION,
+            )
+            + 1
+        )
+        keys = (group_ids[mask] << HLL_PRECISION) + registers
+        return cls.from_unsorted(keys, ranks, n_groups)
+
+    @classmethod
+    def from_unsorted(cls, keys: np.array, ranks: np.array, n_groups: int):
+        """Keep the max rank of each key."""
+        # Rank fits in 6 bits; so sorting (key << 6 | rank) sorts by key, rank
+        key_ranks = np.sort((keys << 6) | ranks)
+        is_last = np.append(key_ranks[1:] >> 6 != key_ranks[:-1] >> 6, True)
+        key_ranks = key_ranks[is_last]
+        return cls(key_ranks >> 6, (key_ranks & 63).astype(np.int8), n_groups)
+
+    def merge(self, group_ids: np.array, n_groups: int) -> "HyperLogLogPartial":
+        ids = group_ids[self.keys >> HLL_PRECISION]
+        mask = ids >= 0
+        registers = self.keys[mask] & ((1 << HLL_PRECISION) - 1)
+        keys = (ids[mask] << HLL_PRECISION) + registers
+        return HyperLogLogPartial.from_unsorted(keys, self.ranks[mask], n_groups)
+
+    def union(self, other: "HyperLogLogPartial") -> "HyperLogLogPartial":
+        """Combine sketches of different rows (say, chunks) in the same groups."""
+        return HyperLogLogPartial.from_unsorted(
+            np.concatenate([self.keys, other.keys]),
+            np.concatenate([self.ranks, other.ranks]).astype(np.int64),
+            self.n_groups,
+        )
+
+    def finish(self) -> pa.Array:
+        estimates = np.zeros(self.n_groups, np.int64)
+        ids = self.keys >> HLL_PRECISION
+        # Estimate a batch of groups at a time, to bound histograms' memory
+        for start in range(0, self.n_groups, HLL_FINISH_BATCH_SIZE):
+            end = np.clip(start + HLL_FINISH_BATCH_SIZE, 0, self.n_groups)
+            begin_key, end_key = np.searchsorted(ids, [start, end])
+            estimates[start:end] = estimate_hyperloglog_cardinalities(
+                ids[begin_key:end_key] - start,
+                self.ranks[begin_key:end_key],
+                end - start,
+            )
+        return pa.array(estimates, pa.int64())
+
+
+HLL_FINISH_BATCH_SIZE = 1 << 16
+"""Groups per batch when estimating HyperLogLog cardinalities."""
+
+
+def estimate_hyperloglog_cardinalities(
+    ids: np.array, ranks: np.array, n_groups: int
+) -> np.array:
+    """Estimate each group's cardinality from its nonzero registers' ranks.
+
+    This is Ertl's improved estimator ("New cardinality estimation algorithms
+    for HyperLogLog sketches", 2017): unbiased from 0 to huge cardinalities,
+    with no empirical bias tables. It reads a histogram of register values.
+    """
+    n_registers = 1 << HLL_PRECISION
+    max_rank = 64 - HLL_PRECISION + 1
+    histograms = np.bincount(
+        ids * (max_rank + 1) + ranks, minlength=n_groups * (max_rank + 1)
+    ).reshape(n_groups, max_rank + 1)
+    histograms[:, 0] = n_registers - histograms[:, 1:].sum(axis=1)
+    empty = histograms[:, 0] == n_registers
+
+    def sigma(x: np.array) -> np.array:
+        y = 1.0
+        z = x.copy()
+        for _ in range(64):
+            x = x * x
+            z += x * y
+            y += y
+        return z
+
+    def tau(x: np.array) -> np.array:
+        y = 1.0
+        z = 1 - x
+        for _ in range(64):
+            x = np.sqrt(x)
+            y *= 0.5
+            z -= (1 - x) ** 2 * y
+        return z / 3
+
+    fractions = histograms / n_registers
+    z = n_registers * tau(1 - fractions[:, max_rank])
+    for rank in range(max_rank - 1, 0, -1):
+        z = 0.5 * (z + histograms[:, rank])
+    z += n_registers * sigma(np.where(empty, 0.0, fractions[:, 0]))
+    z = np.where(empty, np.inf, z)
+    return np.round(n_registers * n_registers / (2 * np.log(2)) / z).astype(np.int64)
+
+
+MOST_FREQUENT_COUNTERS = 1024
+"""Counters per group when counting values that aren't dictionary-encoded."""
+
+MOST_FREQUENT_BATCH_SIZE = 1 << 20
+"""Values to count at a time, to bound memory."""
+
+
+class MostFrequentPartial(NamedTuple):
+    array: pa.Array
+    """All input values."""
+
+    ids: np.array
+    keys: np.array
+    """Each counter's group and value: a dictionary code or a 64-bit hash."""
+
+    counts: np.array
+    rows: np.array
+    """Each counter's count, and the first row (in `array`) with its value."""
+
+    n_groups: int
+    n_codes: Optional[int]
+    """Dictionary size when counting exactly, or `None` when keys are hashes."""
+
+    @classmethod
+    def start(cls, array: pa.Array, group_ids: np.array, n_groups: int):
+        """Count dictionary codes exactly; otherwise, count hashes in a sketch.
+
+        The sketch keeps MOST_FREQUENT_COUNTERS counters per group and merges
+        them the Misra-Gries way (equivalent to Space-Saving). It finds any
+        value that fills over 1/1024 of its group.
+        """
+        rows = np.flatnonzero(valid_row_mask(array, group_ids))
+        if pa.types.is_dictionary(array.type):
+            # Exact counters need no pruning: count every (group, code) pair
+            # in one pass, rather than re-sorting all counters per batch
+            ids, codes, dictionary = nonnull_codes_by_id(array, group_ids)
+            n_codes = len(dictionary)
+            pairs, first_indices, counts = np.unique(
+                ids * n_codes + codes, return_index=True, return_counts=True
+            )
+            return cls(
+                array,
+                pairs // n_codes if n_codes else pairs,
+                pairs % n_codes if n_codes else pairs,
+                counts,
+                rows[first_indices],
+                n_groups,
+                n_codes,
+            )
+
+        ids = group_ids[rows]
+        keys = hash_values(array)[rows].view(np.int64)
+        partial = cls(
+            array,
+            np.array([], np.int64),
+            np.array([], np.int64),
+            np.array([], np.int64),
+            np.array([], np.int64),
+            n_groups,
+            None,
+        )
+        for begin in range(0, len(rows), MOST_FREQUENT_BATCH_SIZE):
+            end = begin + MOST_FREQUENT_BATCH_SIZE
+            partial = partial.count(
+                ids[begin:end],
+                keys[begin:end],
+                np.ones(len(ids[begin:end]), np.int64),
+                rows[begin:end],
+            )
+        return partial
+
+    def count(
+        self, ids: np.array, keys: np.array, counts: np.array, rows: np.array
+    ) -> "MostFrequentPartial":
+        """Add counters; then, if there are too many, drop the smallest."""
+        ids = np.concatenate([self.ids, ids])
+        keys = np.concatenate([self.keys, keys])
+        counts = np.concatenate([self.counts, counts])
+        rows = np.concatenate([self.rows, rows])
+        if not len(ids):
+            return self._replace(ids=ids, keys=keys, counts=counts, rows=rows)
+
+        # Sort by one int64 per (id, key) pair: faster than np.lexsort
+        if self.n_codes is None:
+            pairs = splitmix64(keys.view(np.uint64) + ids.astype(np.uint64))
+        else:
+            pairs = ids * self.n_codes + keys
+        order = np.argsort(pairs)
+        pairs = pairs[order]
+        starts = np.flatnonzero(np.insert(pairs[1:] != pairs[:-1], 0, True))
+        ids = ids[order][starts]
+        keys = keys[order][starts]
+        counts = np.add.reduceat(counts[order], starts)
+        rows = np.minimum.reduceat(rows[order], starts)
+
+        n_counters = np.bincount(ids, minlength=self.n_groups)
+        if self.n_codes is None and n_counters.max() > MOST_FREQUENT_COUNTERS:
+            # Rank each group's counters, biggest first; subtract the first
+            # dropped counter's count from the kept ones (Misra-Gries).
+            order = np.argsort(ids * (counts.max() + 1) - counts)
+            ids, keys, counts, rows = (
+                ids[order],
+                keys[order],
+                counts[order],
+                rows[order],
+            )
+            group_starts = np.cumsum(n_counters) - n_counters
+            ranks = np.arange(len(ids)) - group_starts[ids]
+            thresholds = np.zeros(self.n_groups, np.int64)
+            overflowing = np.flatnonzero(n_counters > MOST_FREQUENT_COUNTERS)
+            thresholds[overflowing] = counts[
+                group_starts[overflowing] + MOST_FREQUENT_COUNTERS
+            ]
+            counts = counts - thresholds[ids]
+            keep = (ranks < MOST_FREQUENT_COUNTERS) & (counts > 0)
+            ids, keys, counts, rows = ids[keep], keys[keep], counts[keep], rows[keep]
+
+        return self._replace(ids=ids, keys=keys, counts=counts, rows=rows)
+
+    def merge(self, group_ids: np.array, n_groups: int) -> "MostFrequentPartial":
+        ids = group_ids[self.ids]
+        mask = ids >= 0
+        empty = np.array([], np.int64)
+        return self._replace(
+            ids=empty, keys=empty, counts=empty, rows=empty, n_groups=n_groups
+        ).count(ids[mask], self.keys[mask], self.counts[mask], self.rows[mask])
+
+    def finish(self) -> pa.Array:
+        """Pick each group's most frequent value; break ties by first row."""
+        best_rows = np.full(self.n_groups, -1, np.int64)
+        if len(self.ids):
+            # One int64 per counter, biggest for the most frequent and then
+            # the earliest row. (counts <= n, so it can't overflow.)
+            n = len(self.array)
+            scores = self.counts * (n + 1) + (n - self.rows)
+            ids = self.ids
+            if np.any(ids[1:] < ids[:-1]):
+                order = np.argsort(ids, kind="stable")
+                ids = ids[order]
+                scores = scores[order]
+            starts = np.flatnonzero(np.insert(ids[1:] != ids[:-1], 0, True))
+            best_scores = np.maximum.reduceat(scores, starts)
+            best_rows[ids[starts]] = n - best_scores % (n + 1)
+        return self.array.take(pa.array(best_rows, pa.int64(), mask=best_rows < 0))
+
+
+TDIGEST_COMPRESSION = 200
+"""t-digest size: at most about 100 centroids per group."""
+
+TDIGEST_BATCH_SIZE = 1 << 20
+"""Values to sort at a time when building t-digests, to bound memory."""
+
+
+class TDigestPartial(NamedTuple):
+    ids: np.array
+    means: np.array
+    weights: np.array
+    """Centroids, sorted by group id and then mean. Each group has at most
+    about TDIGEST_COMPRESSION / 2: small near its tails, big in the middle."""
+
+    mins: np.array
+    maxs: np.array
+    """Each group's extremes (NaN when empty), for accurate tails."""
+
+    n_groups: int
+    quantile: float
+    """What `finish()` computes: 0.5 means median."""
+
+    @classmethod
+    def start(
+        cls, array: pa.Array, group_ids: np.array, n_groups: int, quantile: float
+    ):
+        ids, values = nonnull_values_by_id(array, group_ids)
+        values = values.astype(np.float64)
+        digest = cls.empty(n_groups, quantile)
+        for begin in range(0, len(ids), TDIGEST_BATCH_SIZE):
+            batch_ids = ids[begin : begin + TDIGEST_BATCH_SIZE]
+            batch_values = values[begin : begin + TDIGEST_BATCH_SIZE]
+            digest = digest.union(
+                cls.from_centroids(
+                    batch_ids,
+                    batch_values,
+                    np.ones(len(batch_ids), np.float64),
+                    n_groups,
+                    quantile,
+                )
+            )
+        return digest
+
+    @classmethod
+    def empty(cls, n_groups: int, quantile: float):
+        nans = np.full(n_groups, np.nan)
+        empty = np.array([], np.float64)
+        return cls(np.array([], np.int64), empty, empty, nans, nans, n_groups, quantile)
+
+    @classmethod
+    def from_centroids(
+        cls,
+        ids: np.array,
+        means: np.array,
+        weights: np.array,
+        n_groups: int,
+        quantile: float,
+        mins: Optional[np.array] = None,
+        maxs: Optional[np.array] = None,
+    ):
+        """Sort and compress unsorted centroids.
+
+        `mins` and `maxs` default to the centroids' extremes.
+        """
+        order = np.lexsort((means, ids))
+        ids = ids[order]
+        means = means[order]
+        weights = weights[order]
+        if mins is None:
+            mins = np.full(n_groups, np.nan)
+            maxs = np.full(n_groups, np.nan)
+            if len(ids):
+                is_first = np.insert(ids[1:] != ids[:-1], 0, True)
+                is_last = np.append(ids[1:] != ids[:-1], True)
+                mins[ids[is_first]] = means[is_first]
+                maxs[ids[is_last]] = means[is_last]
+        if not len(ids):
+            return cls(ids, means, weights, mins, maxs, n_groups, quantile)
+
+        # Each centroid's position in its group, as a quantile, via the "k1"
+        # scale function. Centroids in the same unit of k merge.
+        totals = np.bincount(ids, weights=weights, minlength=n_groups)
+        cumulative = np.cumsum(weights)
+        group_starts = np.cumsum(totals) - totals  # weight before each group
+        quantiles = (cumulative - weights / 2 - group_starts[ids]) / totals[ids]
+        ks = TDIGEST_COMPRESSION / (2 * np.pi) * np.arcsin(2 * quantiles - 1)
+        buckets = ids * (TDIGEST_COMPRESSION + 1) + np.floor(
+            ks + TDIGEST_COMPRESSION / 4
+        ).astype(np.int64)
+        starts = np.flatnonzero(np.insert(buckets[1:] != buckets[:-1], 0, True))
+        merged_weights = np.add.reduceat(weights, starts)
+        merged_means = np.add.reduceat(weights * means, starts) / merged_weights
+        return cls(
+            ids[starts], merged_means, merged_weights, mins, maxs, n_groups, quantile
+        )
+
+    def union(self, other: "TDigestPartial") -> "TDigestPartial":
+        """Combine digests of different rows (say, chunks) in the same groups."""
+        return TDigestPartial.from_centroids(
+            np.concatenate([self.ids, other.ids]),
+            np.concatenate([self.means, other.means]),
+            np.concatenate([self.weights, other.weights]),
+            self.n_groups,
+            self.quantile,
+            np.fmin(self.mins, other.mins),
+            np.fmax(self.maxs, other.maxs),
+        )
+
+    def merge(self, group_ids: np.array, n_groups: int) -> "TDigestPartial":
+        ids = group_ids[self.ids]
+        mask = ids >= 0
+        mins = np.full(n_groups, np.nan)
+        maxs = np.full(n_groups, np.nan)
+        old_ids = np.flatnonzero(group_ids >= 0)
+        np.fmin.at(mins, group_ids[old_ids], self.mins[old_ids])
+        np.fmax.at(maxs, group_ids[old_ids], self.maxs[old_ids])
+        return TDigestPartial.from_centroids(
+            ids[mask],
+            self.means[mask],
+            self.weights[mask],
+            n_groups,
+            self.quantile,
+            mins,
+            maxs,
+        )
+
+    def finish(self) -> pa.Array:
+        """Interpolate between centroid centers (and the group's extremes)."""
+        empty = np.isnan(self.mins)
+        if not len(self.ids):
+            return pa.nulls(self.n_groups, pa.float64())
+        totals = np.bincount(self.ids, weights=self.weights, minlength=self.n_groups)
+        group_starts = np.cumsum(totals) - totals
+        # Centers and targets are positions on one axis: all groups' weights
+        centers = np.cumsum(self.weights) - self.weights / 2
+        targets = group_starts + self.quantile * totals
+        n_centroids = np.bincount(self.ids, minlength=self.n_groups)
+        first = np.cumsum(n_centroids) - n_centroids
+        last = first + n_centroids - 1
+        # Empty groups index any valid centroid; their results are masked
+        first = np.clip(first, 0, len(self.ids) - 1)
+        last = np.clip(last, first, len(self.ids) - 1)
+        right = np.clip(np.searchsorted(centers, targets, side="right"), first, last)
+        left = np.clip(right - 1, first, last)
+        # Left of the first center, interpolate from the min; right of the
+        # last center, interpolate to the max.
+        before_first = (targets < centers[right]) & (right == first)
+        after_last = targets >= centers[right]
+        left_positions = np.where(before_first, group_starts, centers[left])
+        right_positions = np.where(after_last, group_starts + totals, centers[right])
+        left_values = np.where(before_first, self.mins, self.means[left])
+        right_values = np.where(after_last, self.maxs, self.means[right])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fractions = (targets - left_positions) / (right_positions - left_positions)
+        fractions = np.where(np.isfinite(fractions), np.clip(fractions, 0, 1), 0.5)
+        results = left_values + (right_values - left_values) * fractions
+        return pa.array(np.where(empty, 0.0, results), pa.float64(), mask=empty)
 
 
 class Operation(Enum):
@@ -337,13 +1169,47 @@ class Operation(Enum):
     MIN = "min"
     MAX = "max"
     FIRST = "first"
+    APPROX_NUNIQUE = "approx_nunique"
+    APPROX_MEDIAN = "approx_median"
+    APPROX_PERCENTILE = "approx_percentile"
+    MOST_FREQUENT = "most_frequent"
 
     def needs_numeric_column(self):
-        return self in {self.SUM, self.MEAN, self.MEDIAN}
+        return self in {
+            self.SUM,
+            self.MEAN,
+            self.MEDIAN,
+            self.APPROX_MEDIAN,
+            self.APPROX_PERCENTILE,
+        }
+
+    def outputs_count(self):
+        return self in {self.SIZE, self.NUNIQUE, self.APPROX_NUNIQUE}
+
+    def outputs_float(self):
+        return self in {
+            self.MEAN,
+            self.MEDIAN,
+            self.APPROX_MEDIAN,
+            self.APPROX_PERCENTILE,
+        }
+
+    def has_sorted_kernel(self):
+        """Return True if `aggregate_sorted()` can use `group_splits`."""
+        return self in {
+            self.SIZE,
+            self.SUM,
+            self.MEAN,
+            self.MIN,
+            self.MAX,
+            self.FIRST,
+        }
 
-    def default_outname(self, colname):
+    def default_outname(self, colname, percentile=None):
         if self == self.SIZE:
             return "Group Size"
+        if self == self.APPROX_PERCENTILE and percentile is not None:
+            return "Approximate percentile %g of %s" % (percentile, colname)
 
         verb = {
             self.NUNIQUE: "Unique count",
@@ -353,6 +1219,10 @@ class Operation(Enum):
             self.MIN: "Minimum",
             self.MAX: "Maximum",
             self.FIRST: "First",
+            self.APPROX_NUNIQUE: "Approximate unique count",
+            self.APPROX_MEDIAN: "Approximate median",
+            self.APPROX_PERCENTILE: "Approximate percentile",
+            self.MOST_FREQUENT: "Most frequent",
         }[self]
 
         return "%s of %s" % (verb, colname)
@@ -363,10 +1233,100 @@ class Group(NamedTuple):
     date_granularity: Optional[DateGranularity]
 
 
+class Predicate(NamedTuple):
+    """Select rows whose `colname` value compares True with `value`."""
+
+    colname: str
+    comparison: "Comparison"
+    value: Any
+
+
 class Aggregation(NamedTuple):
     operation: Operation
     colname: str
     outname: str
+    where: Optional[Predicate] = None
+    """If set, aggregate only rows that match (e.g., "SUM WHERE status = paid")."""
+
+    percentile: Optional[float] = None
+    """For APPROX_PERCENTILE: which percentile, from 0 to 100."""
+
+
+def needed_colnames(aggregations: List[Aggregation]) -> FrozenSet[str]:
+    """List input columns that `aggregations` read."""
+    colnames = set(agg.colname for agg in aggregations if agg.colname)
+    colnames.update(agg.where.colname for agg in aggregations if agg.where)
+    return frozenset(colnames)
+
+
+class Comparison(Enum):
+    EQ = "=="
+    NE = "!="
+    LT = "<"
+    LE = "<="
+    GT = ">"
+    GE = ">="
+
+    def compare(self, array: pa.Array, value: Any) -> np.array:
+        """Return a numpy mask: True where `array` compares True with `value`.
+
+        Null compares False.
+        """
+        if pa.types.is_dictionary(array.type):
+            # Compare each distinct value once
+            dictionary_mask = np.append(self.compare(array.dictionary, value), False)
+            indices = pa.compute.fill_null(
+                array.indices, pa.scalar(len(array.dictionary), array.indices.type)
+            )
+            return dictionary_mask[indices.to_numpy(zero_copy_only=False)]
+
+        if pa.types.is_integer(array.type) and isinstance(value, float):
+            array = array.cast(pa.float64())
+        compare = {
+            self.EQ: pa.compute.equal,
+            self.NE: pa.compute.not_equal,
+            self.LT: pa.compute.less,
+            self.LE: pa.compute.less_equal,
+            self.GT: pa.compute.greater,
+            self.GE: pa.compute.greater_equal,
+        }[self]
+        result = compare(array, pa.scalar(value, array.type))
+        return pa.compute.fill_null(result, False).to_numpy(zero_copy_only=False)
+
+
+class Having(NamedTuple):
+    """Keep only groups whose aggregation `outname` compares True with `value`."""
+
+    outname: str
+    comparison: Comparison
+    value: Any
+
+
+class TopN(NamedTuple):
+    """Keep the `n` groups with the largest (or smallest) aggregation `outname`.
+
+    Output is ordered by that aggregation, best first; ties keep group order.
+    Nulls rank last.
+    """
+
+    outname: str
+    n: int
+    descending: bool = True
+
+
+class WindowOperation(Enum):
+    # Running values within each group, in input-row order
+    ROW_NUMBER = "row_number"
+    CUMCOUNT = "cumcount"
+    CUMSUM = "cumsum"
+    CUMMIN = "cummin"
+    CUMMAX = "cummax"
+
+
+class WindowAggregation(NamedTuple):
+    operation: WindowOperation
+    colname: str  # "" for ROW_NUMBER
+    outname: str
 
 
 def parse_groups(
@@ -388,22 +1348,61 @@ def parse_groups(
 
 
 def parse_aggregation(
-    *, operation: str, colname: str, outname: str
+    *, operation: str, colname: str, outname: str, percentile: float = 50.0
 ) -> Optional[Aggregation]:
     operation = Operation(operation)
     if not colname and operation != Operation.SIZE:
         # Workbench clears empty colnames. Nix the entire Aggregation.
         return None
+    if operation == Operation.APPROX_PERCENTILE:
+        percentile = float(np.clip(percentile, 0.0, 100.0))
+    else:
+        percentile = None  # so equal aggregations compare equal
     if not outname:
-        outname = operation.default_outname(colname)
-    return Aggregation(operation, colname, outname)
+        outname = operation.default_outname(colname, percentile)
+    return Aggregation(operation, colname, outname, percentile=percentile)
 
 
-def parse_aggregations(aggregations: List[Dict[str, str]]) -> List[Aggregation]:
+def parse_aggregations(aggregations: List[Dict[str, Any]]) -> List[Aggregation]:
     aggregations = [parse_aggregation(**kwargs) for kwargs in aggregations]
     return [a for a in aggregations if a is not None]
 
 
+NS_PER_SECOND = 1_000_000_000
+NS_PER_DAY = NS_PER_SECOND * 60 * 60 * 24
+NS_PER_WEEK = NS_PER_DAY * 7
+MIN_DAY = np.iinfo(np.int64).min // NS_PER_DAY
+"""Day number of the earliest timestamp[ns]: 1677-09-21."""
+MAX_DAY = np.iinfo(np.int64).max // NS_PER_DAY
+"""Day number of the latest timestamp[ns]: 2262-04-11."""
+
+
+@functools.lru_cache(maxsize=None)
+def calendar_bucket_starts(date_granularity: DateGranularity) -> np.array:
+    """Map `day_number - MIN_DAY` to the nanosecond its month/quarter/year starts.
+
+    There are ~210k possible days, so this is ~1.7MB per granularity. (The
+    first few days' months would start before 1677-09-21; we clamp those.)
+    """
+    days = np.arange(MIN_DAY, MAX_DAY + 1).astype("datetime64[D]")
+    months = days.astype("datetime64[M]").astype(np.int64)
+    if date_granularity == DateGranularity.QUARTER:
+        months = np.floor_divide(months, 3) * 3
+    elif date_granularity == DateGranularity.YEAR:
+        months = np.floor_divide(months, 12) * 12
+    start_days = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    return np.maximum(start_days, MIN_DAY + 1) * NS_PER_DAY
+
+
+def validity_bitmap(array: pa.Array) -> Optional[pa.Buffer]:
+    """Return `array`'s validity bitmap, starting at bit 0, without copying."""
+    if array.null_count == 0:
+        return None
+    if array.offset % 8 == 0:
+        return array.buffers()[0].slice(array.offset // 8)
+    return array.is_valid().buffers()[1]  # rare: copy
+
+
 def make_groupable_array(
     array: pa.Array, date_granularity: Optional[DateGranularity]
 ) -> pa.Array:
@@ -412,53 +1411,190 @@ def make_groupable_array(
     This is for handling DEPRECATED date conversions. The idea is: with input
     value "2021-03-01T21:12:21.231212312Z", a "year" group should be
     "2021-01-01Z".
+
+    We do integer math on a zero-copy int64 view of the timestamps, and we
+    reuse the input's validity bitmap. Values under nulls are garbage; we
+    bucket them anyway (integer math can't fail) and they stay null.
     """
     if date_granularity is None:
         return array
 
-    if date_granularity == DateGranularity.QUARTER:
-        np_datetime_ns = array.to_numpy(zero_copy_only=False)
-        np_datetime_m = np_datetime_ns.astype("datetime64[M]").astype(int)
-        rounded_month_numbers = np.floor_divide(np_datetime_m, 3) * 3
-        np_rounded_ns = rounded_month_numbers.astype("datetime64[M]").astype(
-            "datetime64[ns]"
-        )
-        # converting to int made nulls into ... not-null. Make them null again
-        np_rounded_ns[np.isnan(np_datetime_ns)] = "NaT"
-        return pa.array(np_rounded_ns)
-
-    if date_granularity == DateGranularity.WEEK:
-        # numpy "week" is counted from the Epoch -- which happens to be a
-        # Thursday. But ISO weeks start Monday, not Thursday -- and so Numpy's
-        # "W" type is useless.
-        #
-        # We do integer math: add 3 to each date and then floor-divide by 7.
-        # That makes "1970-01-01 [Thursday] + 3" => Sunday -- so when we
-        # floor-divide, everything from Monday to Sunday falls in the same
-        # bucket. We could group by this ... but we convert back to day and
-        # subtract the 3, so the group can be formatted.
-        np_datetime_ns = array.to_numpy(zero_copy_only=False)
-        np_datetime_d = np_datetime_ns.astype("datetime64[D]").astype(int)
-        rounded_day_numbers = np.floor_divide(np_datetime_d + 3, 7) * 7 - 3
-        np_rounded_ns = rounded_day_numbers.astype("datetime64[D]").astype(
-            "datetime64[ns]"
-        )
-        # converting to int made nulls into ... not-null. Make them null again
-        np_rounded_ns[np.isnan(np_datetime_ns)] = "NaT"
-        return pa.array(np_rounded_ns)
-
-    freq = date_granularity.numpy_unit
-    np_rounded_ns = (
-        array.to_numpy(zero_copy_only=False)
-        .astype(f"datetime64[{freq}]")
-        .astype("datetime64[ns]")
-    )
-    return pa.array(np_rounded_ns)
+    if array.type.unit != "ns":
+        array = array.cast(pa.timestamp("ns", array.type.tz))
+    if len(array) == 0:
+        return array
 
+    values = np.frombuffer(
+        array.buffers()[1], np.int64, count=len(array), offset=array.offset * 8
+    )
 
-def make_sorting_table(table: pa.Table, groups: List[Group]) -> pa.Table:
-    """Make the "sorting table": the table we'll sort to detect groups."""
-    assert table.columns, "zero-column input cannot use a sorting table"
+    if date_granularity in {
+        DateGranularity.MONTH,
+        DateGranularity.QUARTER,
+        DateGranularity.YEAR,
+    }:
+        result = np.floor_divide(values, NS_PER_DAY)
+        result -= MIN_DAY
+        np.take(
+            calendar_bucket_starts(date_granularity), result, out=result, mode="clip"
+        )
+    elif date_granularity == DateGranularity.WEEK:
+        # "1970-01-01 [Thursday] + 3 days" is Sunday. So after adding three
+        # days, everything from Monday to Sunday floor-divides into the same
+        # bucket. (numpy's "W" counts from Thursday; ISO weeks start Monday.)
+        result = values + 3 * NS_PER_DAY
+        np.floor_divide(result, NS_PER_WEEK, out=result)
+        result *= NS_PER_WEEK
+        result -= 3 * NS_PER_DAY
+    else:
+        unit_ns = {
+            DateGranularity.SECOND: NS_PER_SECOND,
+            DateGranularity.MINUTE: NS_PER_SECOND * 60,
+            DateGranularity.HOUR: NS_PER_SECOND * 60 * 60,
+            DateGranularity.DAY: NS_PER_DAY,
+        }[date_granularity]
+        result = np.floor_divide(values, unit_ns)
+        result *= unit_ns
+
+    return pa.Array.from_buffers(
+        array.type,
+        len(array),
+        [validity_bitmap(array), pa.py_buffer(result)],
+        array.null_count,
+    )
+
+
+class Stage(Enum):
+    """A step of `groupby()`, between which we check for cancellation.
+
+    A few stages are only timed (see `timing()`), never reported to
+    `Progress`: they're small parts of bigger stages.
+    """
+
+    ONE_CHUNK = "one_chunk"
+    """Combine the input table's chunks. (Timed only.)"""
+
+    SORTING_TABLE = "sorting_table"
+    """Build the table of group keys (e.g., truncate dates)."""
+
+    PLAN = "plan"
+    """Gather input statistics and choose an `Engine`."""
+
+    GROUP_IDS = "group_ids"
+    """Assign rows to groups without sorting (`Engine.DIRECT`)."""
+
+    SORT = "sort"
+    NULL_FILTER = "null_filter"
+    """Drop rows with null group keys."""
+
+    DEDUP = "dedup"
+    """Find where each group starts among the sorted keys."""
+
+    SELECT_GROUPS = "select_groups"
+    """Compute the `having` or `top_n` aggregation, and drop other groups."""
+
+    AGGREGATE = "aggregate"
+    """Compute one aggregation's output column."""
+
+    MERGE = "merge"
+    """Regroup partial aggregations for one grouping set."""
+
+    REENCODE_DICTIONARIES = "reencode_dictionaries"
+    """Drop unused dictionary values from group keys. (Timed only.)"""
+
+    DATE_GRANULARITY_CHECK = "date_granularity_check"
+    """Warn about DEPRECATED date granularities. (Timed only.)"""
+
+
+class Timing(NamedTuple):
+    """How long one `Stage` took: what timing sinks receive.
+
+    Stages can nest: for instance, `Stage.PLAN` includes sorting a sample.
+    """
+
+    stage: Stage
+    seconds: float
+    details: Optional[Dict[str, Any]] = None
+    """E.g., `{"outname": ...}` for `Stage.AGGREGATE`."""
+
+
+TIMING_SINKS: List[Callable[[Timing], None]] = []
+"""Functions to call with each `Timing`: a logger, a metrics counter, a list.
+
+When this is empty (the default), we don't even read the clock. Sinks are
+called from whichever thread runs `groupby()`; they must not raise.
+"""
+
+
+def add_timing_sink(sink: Callable[[Timing], None]) -> None:
+    TIMING_SINKS.append(sink)
+
+
+def remove_timing_sink(sink: Callable[[Timing], None]) -> None:
+    TIMING_SINKS.remove(sink)
+
+
+@contextlib.contextmanager
+def report_timing(stage: Stage, details: Dict[str, Any]) -> Iterator[None]:
+    start = time.perf_counter()
+    yield
+    result = Timing(stage, time.perf_counter() - start, details or None)
+    for sink in TIMING_SINKS:
+        sink(result)
+
+
+NO_TIMING = contextlib.nullcontext()
+
+UNTIMED = threading.local()
+"""`UNTIMED.active` is True while this thread runs `untimed()` code."""
+
+
+@contextlib.contextmanager
+def untimed() -> Iterator[None]:
+    """Report no timings from the `with` block; its caller times it as a whole.
+
+    The planner sorts a sample: its SORT, NULL_FILTER and DEDUP timings would
+    double-count time that `Stage.PLAN` already reports.
+    """
+    was_active = getattr(UNTIMED, "active", False)
+    UNTIMED.active = True
+    try:
+        yield
+    finally:
+        UNTIMED.active = was_active
+
+
+def is_timing() -> bool:
+    return bool(TIMING_SINKS) and not getattr(UNTIMED, "active", False)
+
+
+def timing(stage: Stage, **details: Any) -> ContextManager[None]:
+    """Report how long the `with` block takes to each of `TIMING_SINKS`."""
+    if not is_timing():
+        return NO_TIMING
+    return report_timing(stage, details)
+
+
+def timed(stage: Stage) -> Callable[[Callable], Callable]:
+    """Decorate a function, so each call reports a `Timing` of `stage`."""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_timing():
+                return func(*args, **kwargs)
+            with report_timing(stage, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@timed(Stage.SORTING_TABLE)
+def make_sorting_table(table: pa.Table, groups: List[Group]) -> pa.Table:
+    """Make the "sorting table": the table we'll sort to detect groups."""
+    assert table.columns, "zero-column input cannot use a sorting table"
     assert table.columns[0].num_chunks == 1, "must combine_chunks() before sorting"
 
     return pa.table(
@@ -493,6 +1629,7 @@ class SortedGroups(NamedTuple):
     """
 
 
+@timed(Stage.NULL_FILTER)
 def find_nonnull_table_mask(table: pa.Table) -> pa.Array:
     mask = pa.array(np.ones(table.num_rows), pa.bool_())
 
@@ -508,14 +1645,18 @@ def reencode_dictionary_array(array: pa.Array) -> pa.Array:
         # away from dictionary when it gives us literally nothing.
         return array.cast(pa.utf8())
 
+    indices = array.indices
+    if indices.null_count:
+        indices = indices.filter(indices.is_valid())
     used = np.zeros(len(array.dictionary), np.bool_)
-    used[array.indices] = True
+    used[indices] = True
     if np.all(used):
         return array  # no edit
 
     return array.cast(pa.utf8()).dictionary_encode()  # TODO optimize
 
 
+@timed(Stage.REENCODE_DICTIONARIES)
 def reencode_dictionaries(table: pa.Table) -> pa.Table:
     for i in range(table.num_columns):
         column = table.columns[i]
@@ -526,14 +1667,88 @@ def reencode_dictionaries(table: pa.Table) -> pa.Table:
     return table
 
 
-def make_sorted_groups(sorting_table: pa.Table, input_table: pa.Table) -> SortedGroups:
-    if not sorting_table.num_columns:
-        # Exactly one output group, even for empty-table input
-        return SortedGroups(
-            sorted_groups=pa.table({"A": [None]}).select([]),  # 1-row, 0-col table
-            sorted_input_table=input_table,  # everything is one group (maybe 0-row)
-            group_splits=np.array([], np.int64()),
-        )
+class Progress(NamedTuple):
+    """What `groupby()` has done, reported after each `Stage`."""
+
+    stage: Stage
+    """The stage that just finished."""
+
+    n_rows: int
+    """Input rows: the stage processed all of them."""
+
+    n_aggregations_done: int
+    n_aggregations: int
+
+    details: Optional[Dict[str, Any]] = None
+    """JSON-serializable facts about the stage (e.g., `n_groups`), if any."""
+
+
+class Cancelled(Exception):
+    """`groupby()` stopped early because its caller cancelled it."""
+
+
+class DeadlineExceeded(Cancelled):
+    """`groupby()` stopped early because its deadline passed."""
+
+
+class Checkpoint(NamedTuple):
+    """What to do after each `Stage` of `groupby()`."""
+
+    cancel: Optional[threading.Event] = None
+    """Event the caller sets to stop `groupby()`."""
+
+    deadline: Optional[float] = None
+    """`time.monotonic()` value after which to stop."""
+
+    progress: Optional[Callable[[Progress], None]] = None
+    """Function to call once per stage (never per row or per group)."""
+
+    n_rows: int = 0
+    n_aggregations: int = 0
+    """Totals for `Progress`."""
+
+    def __call__(
+        self, stage: Stage, n_aggregations_done: int = 0, **details: Any
+    ) -> None:
+        """Report `stage`; raise `Cancelled` if `groupby()` should stop."""
+        if self.progress is not None:
+            self.progress(
+                Progress(
+                    stage,
+                    self.n_rows,
+                    n_aggregations_done,
+                    self.n_aggregations,
+                    details or None,
+                )
+            )
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled("cancelled after %s" % stage.value)
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise DeadlineExceeded("deadline passed after %s" % stage.value)
+
+
+class SortedKeys(NamedTuple):
+    sorted_indices: pa.Array
+    """Indices of input rows, in sorted order. Rows with null groups are omitted."""
+
+    sorted_keys: pa.Table
+    """`sorting_table.take(sorted_indices)`: duplicate groups are adjacent."""
+
+    group_splits: np.array
+    """List of indices of "new groups" within `sorted_keys`."""
+
+
+def sort_keys(
+    sorting_table: pa.Table,
+    keep_null_groups: bool = False,
+    checkpoint: Checkpoint = Checkpoint(),
+) -> SortedKeys:
+    """Sort `sorting_table` and find groups.
+
+    With `keep_null_groups=True`, null is a group value (sorted last) instead
+    of a reason to drop the row.
+    """
+    assert sorting_table.num_columns, "zero-column table is one group; don't sort"
 
     # pyarrow 3.0.0 can't sort dictionary columns.
     # TODO make sort-dictionary work; nix this conversion
@@ -554,12 +1769,14 @@ def make_sorted_groups(sorting_table: pa.Table, input_table: pa.Table) -> Sorted
             ]
         ),
     )
-    indices = pa.compute.sort_indices(
-        sorting_table_without_dictionary,
-        sort_keys=[
-            (c, "ascending") for c in sorting_table_without_dictionary.column_names
-        ],
-    )
+    with timing(Stage.SORT):
+        indices = pa.compute.sort_indices(
+            sorting_table_without_dictionary,
+            sort_keys=[
+                (c, "ascending") for c in sorting_table_without_dictionary.column_names
+            ],
+        )
+    checkpoint(Stage.SORT)
 
     sorted_groups_with_dups_and_nulls = sorting_table.take(indices)
     # Behavior we ought to DEPRECATE: to mimic Pandas, we drop all groups that
@@ -570,158 +1787,1778 @@ def make_sorted_groups(sorting_table: pa.Table, input_table: pa.Table) -> Sorted
     #
     # This null-dropping is for backwards compat. TODO make it optional ... and
     # eventually nix the option and always output NULL groups.
-    nonnull_indices = indices.filter(
-        find_nonnull_table_mask(sorted_groups_with_dups_and_nulls)
+    if keep_null_groups:
+        nonnull_indices = indices
+    else:
+        nonnull_indices = indices.filter(
+            find_nonnull_table_mask(sorted_groups_with_dups_and_nulls)
+        )
+
+    sorted_groups_with_dups = sorting_table.take(nonnull_indices)
+    checkpoint(Stage.NULL_FILTER, n_rows_dropped=len(indices) - len(nonnull_indices))
+
+    group_splits = find_group_splits(sorted_groups_with_dups)
+    checkpoint(
+        Stage.DEDUP,
+        n_groups=len(group_splits) + 1 if len(sorted_groups_with_dups) else 0,
+    )
+
+    return SortedKeys(
+        sorted_indices=nonnull_indices,
+        sorted_keys=sorted_groups_with_dups,
+        group_splits=group_splits,
+    )
+
+
+@timed(Stage.DEDUP)
+def find_group_splits(sorted_keys: pa.Table) -> np.array:
+    """List indices of "new groups" within `sorted_keys`.
+
+    Equal keys must be adjacent. Null equals null.
+    """
+    # "is_dup": find each row in sorted_keys that is _equal_ to the row before
+    # it. (The first value compares the first and second row.)
+    #
+    # We start assuming all are equal; then we search for inequality
+    if len(sorted_keys):
+        is_dup = pa.array(np.ones(len(sorted_keys) - 1), pa.bool_())
+        for column in sorted_keys.itercolumns():
+            chunk = column.chunks[0]
+            if pa.types.is_dictionary(chunk.type):
+                chunk = chunk.indices
+            first = chunk.slice(0, len(column) - 1)
+            second = chunk.slice(1)
+            if chunk.null_count:
+                both_null = pa.compute.and_(first.is_null(), second.is_null())
+                both_equal_if_not_null = pa.compute.equal(first, second)
+                both_equal = pa.compute.fill_null(both_equal_if_not_null, False)
+                value_is_dup = pa.compute.or_(both_null, both_equal)
+            else:
+                value_is_dup = pa.compute.equal(first, second)
+            is_dup = pa.compute.and_(is_dup, value_is_dup)
+
+        return np.where(~(is_dup.to_numpy(zero_copy_only=False)))[0] + 1
+    else:
+        return np.array([], np.int64())
+
+
+def make_sorted_groups(
+    sorting_table: pa.Table,
+    input_table: pa.Table,
+    checkpoint: Checkpoint = Checkpoint(),
+) -> SortedGroups:
+    if not sorting_table.num_columns:
+        # Exactly one output group, even for empty-table input
+        return SortedGroups(
+            sorted_groups=pa.table({"A": [None]}).select([]),  # 1-row, 0-col table
+            sorted_input_table=input_table,  # everything is one group (maybe 0-row)
+            group_splits=np.array([], np.int64()),
+        )
+
+    nonnull_indices, sorted_groups_with_dups, group_splits = sort_keys(
+        sorting_table, checkpoint=checkpoint
+    )
+
+    if input_table.num_columns:
+        sorted_input_table = input_table.take(nonnull_indices)
+    else:
+        # Don't .take() on a zero-column Arrow table: its .num_rows would change
+        #
+        # All rows are identical, so .slice() gives the table we want
+        sorted_input_table = input_table.slice(0, len(nonnull_indices))
+
+    if len(sorted_groups_with_dups):
+        sorted_groups = reencode_dictionaries(
+            sorted_groups_with_dups.take(np.insert(group_splits, 0, 0))
+        )
+    else:
+        sorted_groups = sorted_groups_with_dups
+
+    return SortedGroups(
+        sorted_groups=sorted_groups,
+        sorted_input_table=sorted_input_table,
+        group_splits=group_splits,
+    )
+
+
+class Engine(Enum):
+    """Strategy `groupby()` uses to assign rows to groups."""
+
+    SORT = "sort"
+    """Sort the input table by its groups; aggregate contiguous slices."""
+
+    GROUP_ID = "group_id"
+    """Sort only the groups; aggregate unsorted input by each row's group id."""
+
+    DIRECT = "direct"
+    """Compute each row's group id arithmetically, without sorting.
+
+    Only possible when every group column is dictionary, boolean or a narrow
+    range of integers.
+    """
+
+    PRESORTED = "presorted"
+    """Number groups in input order, without sorting.
+
+    Only possible when the input is already sorted by its groups.
+    """
+
+
+class GroupIds(NamedTuple):
+    group_ids: np.array
+    """For each input row, the index of its group (or -1 if it's in none)."""
+
+    group_rows: np.array
+    """For each group, the index of one input row that belongs to it."""
+
+
+MAX_DIRECT_SLOTS = 1 << 16
+"""Largest number of slots (empty or not) the DIRECT engine will allocate."""
+
+
+def make_direct_codes(array: pa.Array) -> Optional[Tuple[np.array, int]]:
+    """Return `(codes, n_codes)`, or `None` if `array` has too many values.
+
+    Codes are dense, in sort order, and -1 for null.
+    """
+    if pa.types.is_dictionary(array.type):
+        ranks, n_codes = dictionary_ranks(array.dictionary)
+        if n_codes == 0:
+            return np.full(len(array), -1, np.int64), 0
+        indices = array.indices
+        if indices.null_count:
+            indices = pa.compute.fill_null(indices, pa.scalar(0, indices.type))
+        codes = ranks[indices.to_numpy(zero_copy_only=False)]
+    elif pa.types.is_boolean(array.type):
+        n_codes = 2
+        codes = (
+            pa.compute.fill_null(array, False)
+            .to_numpy(zero_copy_only=False)
+            .astype(np.int64)
+        )
+    elif pa.types.is_integer(array.type):
+        min_max = pa.compute.min_max(array).as_py()
+        if min_max["min"] is None:
+            return np.full(len(array), -1, np.int64), 0
+        n_codes = min_max["max"] - min_max["min"] + 1
+        if n_codes > MAX_DIRECT_SLOTS:
+            return None
+        np_min = np.array(min_max["min"], array.type.to_pandas_dtype())
+        values = pa.compute.fill_null(array, pa.scalar(min_max["min"], array.type))
+        # int64 math wraps around for uint64, but the differences are small
+        np_values = values.to_numpy(zero_copy_only=False)
+        codes = np_values.astype(np.int64) - np_min.astype(np.int64)
+    else:
+        return None
+
+    if array.null_count:
+        codes[~array.is_valid().to_numpy(zero_copy_only=False)] = -1
+    return codes, n_codes
+
+
+@timed(Stage.GROUP_IDS)
+def make_direct_group_ids(
+    sorting_table: pa.Table, keep_null_groups: bool = False
+) -> Optional[GroupIds]:
+    """Find groups without sorting, or return `None` if that isn't possible.
+
+    Each combination of group values gets a "slot" -- like a mixed-radix
+    number, with the first group column being the most significant digit. Slot
+    order is sort order; so once we drop empty slots, we have sorted groups.
+
+    With `keep_null_groups=True`, null gets its own code, after all values.
+    """
+    n_rows = sorting_table.num_rows
+    slots = np.zeros(n_rows, np.int64)
+    n_slots = 1
+    for column in sorting_table.itercolumns():
+        codes_and_n = make_direct_codes(column.chunks[0])
+        if codes_and_n is None:
+            return None
+        codes, n_codes = codes_and_n
+        if keep_null_groups and column.null_count:
+            codes[codes < 0] = n_codes
+            n_codes += 1
+        n_slots *= n_codes
+        if n_slots > MAX_DIRECT_SLOTS:
+            return None
+        slots = np.where((slots >= 0) & (codes >= 0), slots * n_codes + codes, -1)
+
+    valid = slots >= 0
+    valid_slots = slots[valid]
+    nonempty = np.bincount(valid_slots, minlength=n_slots) > 0
+    slot_group_ids = np.cumsum(nonempty) - 1
+    group_ids = np.full(n_rows, -1, np.int64)
+    group_ids[valid] = slot_group_ids[valid_slots]
+    slot_rows = np.zeros(n_slots, np.int64)
+    # When a slot has many rows, any one of them is fine: they're all equal
+    slot_rows[valid_slots] = np.flatnonzero(valid)
+    return GroupIds(group_ids=group_ids, group_rows=slot_rows[nonempty])
+
+
+def make_sorted_group_ids(
+    sorting_table: pa.Table,
+    num_rows: int,
+    keep_null_groups: bool = False,
+    checkpoint: Checkpoint = Checkpoint(),
+) -> GroupIds:
+    """Find groups by sorting `sorting_table` -- and nothing else.
+
+    Unlike `make_sorted_groups()`, this never reorders the input table. A
+    group's id is the number of group boundaries before it in sort order (a
+    cumulative sum); we scatter ids back to input order via `sorted_indices`.
+
+    `num_rows` is the input table's length. (A zero-column `sorting_table` has
+    zero rows, but it still means "every input row is in one group".)
+    """
+    if not sorting_table.num_columns:
+        # Exactly one output group, even for empty-table input
+        return GroupIds(
+            group_ids=np.zeros(num_rows, np.int64), group_rows=np.array([0], np.int64)
+        )
+
+    sorted_indices, _, group_splits = sort_keys(
+        sorting_table, keep_null_groups, checkpoint
+    )
+    sorted_indices = sorted_indices.to_numpy()
+    is_group_start = np.zeros(len(sorted_indices), np.int64)
+    is_group_start[group_splits] = 1
+    group_ids = np.full(num_rows, -1, np.int64)
+    group_ids[sorted_indices] = np.cumsum(is_group_start)
+    if len(sorted_indices):
+        group_rows = sorted_indices[np.insert(group_splits, 0, 0)]
+    else:
+        group_rows = np.array([], np.int64)
+    return GroupIds(group_ids=group_ids, group_rows=group_rows)
+
+
+def make_presorted_group_ids(
+    sorting_table: pa.Table,
+    keep_null_groups: bool = False,
+    checkpoint: Checkpoint = Checkpoint(),
+) -> GroupIds:
+    """Find groups in a `sorting_table` that is already sorted: no sort needed.
+
+    A group's id is the number of group boundaries before it.
+    """
+    n_rows = sorting_table.num_rows
+    if keep_null_groups or not any(c.null_count for c in sorting_table.columns):
+        rows = np.arange(n_rows)
+        keys = sorting_table
+    else:
+        mask = find_nonnull_table_mask(sorting_table)
+        rows = np.flatnonzero(mask.to_numpy(zero_copy_only=False))
+        keys = sorting_table.filter(mask)
+        checkpoint(Stage.NULL_FILTER, n_rows_dropped=n_rows - len(rows))
+    group_splits = find_group_splits(keys)
+    checkpoint(Stage.DEDUP, n_groups=len(group_splits) + 1 if len(rows) else 0)
+    is_group_start = np.zeros(len(rows), np.int64)
+    is_group_start[group_splits] = 1
+    group_ids = np.full(n_rows, -1, np.int64)
+    group_ids[rows] = np.cumsum(is_group_start)
+    if len(rows):
+        group_rows = rows[np.insert(group_splits, 0, 0)]
+    else:
+        group_rows = np.array([], np.int64)
+    return GroupIds(group_ids=group_ids, group_rows=group_rows)
+
+
+PLANNER_SAMPLE_ROWS = 10_000
+"""Rows `estimate_n_groups()` samples."""
+
+SORT_ENGINE_MAX_GROUPS = 100_000
+"""`Engine.SORT` beats `Engine.GROUP_ID` up to about this many groups."""
+
+
+class KeyStats(NamedTuple):
+    type: pa.DataType
+    null_count: int
+    max_codes: Optional[int]
+    """Upper bound on distinct non-null values, or `None` if there's no cheap
+    bound. (Dictionary size; 2 for boolean; range of integers.)"""
+
+
+class InputStats(NamedTuple):
+    """Cheap facts about group keys, for `choose_engine()`."""
+
+    n_rows: int
+    keys: List[KeyStats]
+    estimated_n_groups: int
+    """Estimated from a sample. (Exact for small tables.)"""
+
+    is_sorted: bool
+    """True if rows are already sorted by group."""
+
+
+def gather_key_stats(array: pa.Array) -> KeyStats:
+    if pa.types.is_dictionary(array.type):
+        max_codes = len(array.dictionary)
+    elif pa.types.is_boolean(array.type):
+        max_codes = 2
+    elif pa.types.is_integer(array.type):
+        min_max = pa.compute.min_max(array).as_py()
+        if min_max["min"] is None:
+            max_codes = 0
+        else:
+            max_codes = min_max["max"] - min_max["min"] + 1
+    else:
+        max_codes = None
+    return KeyStats(array.type, array.null_count, max_codes)
+
+
+def compare_adjacent(array: pa.Array) -> Tuple[np.array, np.array]:
+    """Return `(less, equal)`: how each value but the last compares to the next.
+
+    Values compare the way `sort_keys()` sorts them: nulls last.
+    """
+    if pa.types.is_dictionary(array.type):
+        ranks, n_ranks = dictionary_ranks(array.dictionary)
+        indices = array.indices
+        if indices.null_count:
+            indices = pa.compute.fill_null(indices, pa.scalar(0, indices.type))
+        if n_ranks == 0:
+            values = pa.array(np.zeros(len(array), np.int64))  # all null
+        else:
+            values = pa.array(ranks[indices.to_numpy(zero_copy_only=False)])
+    else:
+        values = array
+    first, second = values[:-1], values[1:]
+    valid = array.is_valid().to_numpy(zero_copy_only=False)
+    first_valid, second_valid = valid[:-1], valid[1:]
+    both_valid = first_valid & second_valid
+    less = pa.compute.fill_null(pa.compute.less(first, second), False)
+    equal = pa.compute.fill_null(pa.compute.equal(first, second), False)
+    return (
+        (both_valid & less.to_numpy(zero_copy_only=False))
+        | (first_valid & ~second_valid),
+        (both_valid & equal.to_numpy(zero_copy_only=False))
+        | (~first_valid & ~second_valid),
+    )
+
+
+def find_unsorted_pairs(sorting_table: pa.Table) -> np.array:
+    """Return, for each row but the last, whether the next row sorts before it."""
+    n_pairs = sorting_table.num_rows - 1
+    if n_pairs < 1:
+        return np.zeros(0, np.bool_)
+    unsorted = np.zeros(n_pairs, np.bool_)
+    undecided = np.ones(n_pairs, np.bool_)  # all previous columns are equal
+    for column in sorting_table.itercolumns():
+        less, equal = compare_adjacent(column.chunks[0])
+        unsorted |= undecided & ~less & ~equal
+        undecided &= equal
+    return unsorted
+
+
+def is_sorted_table(sorting_table: pa.Table) -> bool:
+    """Return True if `sorting_table` is sorted by all its columns."""
+    n_rows = sorting_table.num_rows
+    if n_rows > PLANNER_SAMPLE_ROWS:
+        # Most unsorted tables are unsorted everywhere: check a sample of pairs
+        starts = np.sort(
+            np.random.default_rng(0).integers(0, n_rows - 1, PLANNER_SAMPLE_ROWS // 2)
+        )
+        pair_rows = np.stack([starts, starts + 1], axis=1).reshape(-1)
+        sample = sorting_table.take(pa.array(pair_rows))
+        if find_unsorted_pairs(sample)[::2].any():
+            return False
+    return not find_unsorted_pairs(sorting_table).any()
+
+
+def estimate_n_groups(sorting_table: pa.Table) -> int:
+    """Estimate the number of non-null groups, from a sample.
+
+    This uses the bias-corrected Chao1 estimator: it adds
+    `f1 * (f1 - 1) / (2 * (f2 + 1))` unseen groups, where `f1` and `f2` count
+    groups seen once and twice in the sample. (The "GEE" estimator can't
+    exceed sqrt(n_rows * n_sample_rows) -- 100,000 groups for a million rows
+    -- so it can't spot high-cardinality input.)
+    """
+    n_rows = sorting_table.num_rows
+    if n_rows > PLANNER_SAMPLE_ROWS:
+        sample = sample_table(sorting_table, PLANNER_SAMPLE_ROWS)
+    else:
+        sample = sorting_table
+    group_ids = make_sorted_group_ids(sample, sample.num_rows).group_ids
+    counts = np.bincount(group_ids[group_ids >= 0])
+    if sample.num_rows == n_rows:
+        return len(counts)
+    n_once = np.count_nonzero(counts == 1)
+    n_twice = np.count_nonzero(counts == 2)
+    estimate = len(counts) + n_once * (n_once - 1) / (2 * (n_twice + 1))
+    return int(np.clip(np.rint(estimate), 0, n_rows))
+
+
+@timed(Stage.PLAN)
+def gather_input_stats(sorting_table: pa.Table, num_rows: int) -> InputStats:
+    if not sorting_table.num_columns:
+        return InputStats(num_rows, [], 1, True)
+    with untimed():
+        return InputStats(
+            num_rows,
+            [gather_key_stats(column.chunks[0]) for column in sorting_table.columns],
+            estimate_n_groups(sorting_table),
+            is_sorted_table(sorting_table),
+        )
+
+
+def choose_engine(stats: InputStats, allow_sort: bool = True) -> Engine:
+    """Pick the fastest `Engine` for input with `stats`.
+
+    In order of preference: DIRECT if there are few possible groups; PRESORTED
+    if rows are sorted; SORT if there are few groups (and `allow_sort`); and
+    otherwise GROUP_ID.
+    """
+    if not stats.keys:
+        return Engine.GROUP_ID
+    n_slots = 1
+    for key in stats.keys:
+        if key.max_codes is None:
+            n_slots = None
+            break
+        n_slots *= key.max_codes + (1 if key.null_count else 0)
+    if n_slots is not None and n_slots <= MAX_DIRECT_SLOTS:
+        return Engine.DIRECT
+    if stats.is_sorted:
+        return Engine.PRESORTED
+    if allow_sort and stats.estimated_n_groups <= SORT_ENGINE_MAX_GROUPS:
+        return Engine.SORT
+    return Engine.GROUP_ID
+
+
+def compact_groups(
+    group_ids: GroupIds, selected: np.array, input_table: pa.Table
+) -> Tuple[GroupIds, pa.Table]:
+    """Renumber groups: group `selected[i]` becomes group `i`.
+
+    Rows of unselected groups get group id -1. When few rows remain, we drop
+    them from `input_table` too, so later aggregations needn't scan them.
+    """
+    new_ids = np.full(len(group_ids.group_rows), -1, np.int64)
+    new_ids[selected] = np.arange(len(selected))
+    row_ids = group_ids.group_ids
+    in_group = row_ids >= 0
+    new_row_ids = np.full(len(row_ids), -1, np.int64)
+    new_row_ids[in_group] = new_ids[row_ids[in_group]]
+    group_rows = group_ids.group_rows[selected]
+    if input_table.num_columns:
+        rows = np.flatnonzero(new_row_ids >= 0)
+        if len(rows) < len(new_row_ids) // 2:
+            input_table = input_table.take(pa.array(rows))
+            new_row_ids = new_row_ids[rows]
+    return GroupIds(group_ids=new_row_ids, group_rows=group_rows), input_table
+
+
+def take_groups(array: pa.Array, selected: np.array) -> pa.Array:
+    """Pick aggregation values for `selected` groups (see `compact_groups()`)."""
+    array = array.take(pa.array(selected, pa.int64()))
+    if pa.types.is_dictionary(array.type):
+        array = array.cast(pa.utf8()).dictionary_encode()  # nix unused values
+    return array
+
+
+def ranking_keys(array: pa.Array, descending: bool) -> Tuple[np.array, np.array]:
+    """Return `(keys, valid)`: sorting `keys` ascending sorts `array`.
+
+    Keys of null values are garbage; `valid` is False for them.
+    """
+    valid = array.is_valid().to_numpy(zero_copy_only=False)
+    if pa.types.is_timestamp(array.type) or pa.types.is_date(array.type):
+        int_type = pa.int64() if array.type.bit_width == 64 else pa.int32()
+        array = array.view(int_type)
+    if pa.types.is_integer(array.type) or pa.types.is_floating(array.type):
+        keys = pa.compute.fill_null(array, pa.scalar(0, array.type))
+        keys = keys.to_numpy(zero_copy_only=False)
+    else:
+        # Text: rank codes
+        _, codes, _ = nonnull_codes_by_id(array, np.zeros(len(array), np.int64))
+        keys = np.zeros(len(array), np.int64)
+        keys[valid] = codes
+    if descending:
+        # ~x == -x - 1 reverses integer order without overflowing
+        keys = -keys if keys.dtype.kind == "f" else ~keys
+    return keys, valid
+
+
+def select_top_groups(values: pa.Array, top_n: TopN) -> np.array:
+    """Find the best `top_n.n` groups by `values`, best first.
+
+    This is a partial selection -- O(n_groups) -- plus a sort of the winners.
+    """
+    n = int(np.clip(top_n.n, 0, len(values)))
+    if n == 0:
+        return np.array([], np.int64)
+    keys, valid = ranking_keys(values, top_n.descending)
+    candidates = np.flatnonzero(valid)
+    if n < len(candidates):
+        candidate_keys = keys[candidates]
+        threshold = np.partition(candidate_keys, n - 1)[n - 1]
+        better = candidates[candidate_keys < threshold]
+        tied = candidates[candidate_keys == threshold][: n - len(better)]
+        candidates = np.concatenate([better, tied])
+    winners = candidates[np.lexsort((candidates, keys[candidates]))]
+    if len(winners) < n:
+        winners = np.concatenate([winners, np.flatnonzero(~valid)[: n - len(winners)]])
+    return winners
+
+
+def make_groups_table(sorting_table: pa.Table, group_rows: np.array) -> pa.Table:
+    """Pick one row of `sorting_table` per group."""
+    if not sorting_table.num_columns:
+        # Don't .take() on a zero-column Arrow table: its .num_rows would change
+        return pa.table({"A": pa.nulls(len(group_rows))}).select([])
+    if len(group_rows) == 0:
+        return sorting_table.slice(0, 0)
+    return reencode_dictionaries(sorting_table.take(group_rows))
+
+
+def aggregate_sorted(
+    agg: Aggregation, sorted_input_table: pa.Table, group_splits: np.array
+) -> pa.Array:
+    if agg.where is not None or not agg.operation.has_sorted_kernel():
+        # Sorted rows' group ids are easy; the by-id kernels handle masks
+        n_rows = sorted_input_table.num_rows
+        group_starts = np.insert(group_splits, 0, 0)
+        group_ids = np.repeat(
+            np.arange(len(group_starts)), np.diff(np.append(group_starts, n_rows))
+        )
+        return aggregate_by_id(agg, sorted_input_table, group_ids, len(group_starts))
+
+    if agg.operation == Operation.SIZE:
+        return size(num_rows=sorted_input_table.num_rows, group_splits=group_splits)
+    else:
+        ufunc = dict(
+            sum=sum,
+            first=first,
+            mean=mean,
+            min=min,
+            max=max,
+        )[agg.operation.value]
+        array = sorted_input_table[agg.colname].chunks[0]
+        if pa.types.is_dictionary(sorted_input_table[agg.colname].type):
+            array = array.cast(pa.utf8())
+        array = ufunc(array=array, group_splits=group_splits)
+        if pa.types.is_dictionary(sorted_input_table[agg.colname].type):
+            array = array.cast(pa.utf8()).dictionary_encode()
+        if pa.types.is_null(array.type):
+            # Zero-length table => this is how we choose the type
+            array = array.cast(sorted_input_table.schema.field(agg.colname).type)
+        return array
+
+
+def partial_type(operation: Operation) -> type:
+    """Mergeable partial class that computes `operation` by group id."""
+    return {
+        Operation.SIZE: SumPartial,
+        Operation.NUNIQUE: NuniquePartial,
+        Operation.APPROX_NUNIQUE: HyperLogLogPartial,
+        Operation.SUM: SumPartial,
+        Operation.MEAN: MeanPartial,
+        Operation.MEDIAN: MedianPartial,
+        Operation.APPROX_MEDIAN: TDigestPartial,
+        Operation.APPROX_PERCENTILE: TDigestPartial,
+        Operation.MIN: ExtremePartial,
+        Operation.MAX: ExtremePartial,
+        Operation.FIRST: FirstPartial,
+        Operation.MOST_FREQUENT: MostFrequentPartial,
+    }[operation]
+
+
+def describe_kernel(agg: Aggregation, engine: Engine) -> str:
+    """Name the code that computes `agg` with `engine`, for `explain_groupby()`.
+
+    This mirrors `aggregate_sorted()`: "sorted:<operation>" for a kernel over
+    sorted group splits; "by_id:<partial class>" otherwise.
+    """
+    if (
+        engine == Engine.SORT
+        and agg.where is None
+        and agg.operation.has_sorted_kernel()
+    ):
+        return "sorted:" + agg.operation.value
+    return "by_id:" + partial_type(agg.operation).__name__
+
+
+def start_partial(
+    agg: Aggregation, input_table: pa.Table, group_ids: np.array, n_groups: int
+):
+    if agg.where is not None:
+        # Rows that don't match get no group, just like rows with null groups
+        matches = agg.where.comparison.compare(
+            input_table[agg.where.colname].chunks[0], agg.where.value
+        )
+        group_ids = np.where(matches, group_ids, -1)
+
+    if agg.operation == Operation.SIZE:
+        return SumPartial(size_by_id(group_ids=group_ids, n_groups=n_groups))
+
+    array = input_table[agg.colname].chunks[0]
+    if agg.operation in {Operation.APPROX_MEDIAN, Operation.APPROX_PERCENTILE}:
+        if agg.operation == Operation.APPROX_MEDIAN:
+            percentile = 50.0
+        elif agg.percentile is None or not 0 <= agg.percentile <= 100:
+            raise ValueError("APPROX_PERCENTILE needs a percentile from 0 to 100")
+        else:
+            percentile = agg.percentile
+        return TDigestPartial.start(array, group_ids, n_groups, percentile / 100)
+    elif agg.operation == Operation.MIN:
+        return ExtremePartial.start(array, group_ids, n_groups, min_by_id)
+    elif agg.operation == Operation.MAX:
+        return ExtremePartial.start(array, group_ids, n_groups, max_by_id)
+    else:
+        return partial_type(agg.operation).start(array, group_ids, n_groups)
+
+
+def restore_dictionary(
+    agg: Aggregation, input_schema: pa.Schema, result: pa.Array
+) -> pa.Array:
+    if not agg.operation.outputs_count() and pa.types.is_dictionary(
+        input_schema.field(agg.colname).type
+    ):
+        result = result.cast(pa.utf8()).dictionary_encode()
+    return result
+
+
+def finish_partial(agg: Aggregation, input_schema: pa.Schema, partial) -> pa.Array:
+    return restore_dictionary(agg, input_schema, partial.finish())
+
+
+def aggregate_by_id(
+    agg: Aggregation, input_table: pa.Table, group_ids: np.array, n_groups: int
+) -> pa.Array:
+    partial = start_partial(agg, input_table, group_ids, n_groups)
+    return finish_partial(agg, input_table.schema, partial)
+
+
+@timed(Stage.ONE_CHUNK)
+def make_table_one_chunk(table: pa.Table) -> pa.Table:
+    assert len(table.columns), "Workbench must not give a zero-column table"
+
+    if table.columns[0].num_chunks == 0:
+        return pa.table(
+            {
+                field.name: pa.array([], field.type)
+                for field in (
+                    table.schema.field(i) for i in range(len(table.schema.names))
+                )
+            },
+            schema=table.schema,
+        )
+
+    if table.columns[0].num_chunks == 1:
+        return table
+
+    return table.combine_chunks()
+
+
+def unique_aggregations(aggregations: List[Aggregation]) -> List[Aggregation]:
+    # Pick the "last" of each aggregation for each outname. There will only be
+    # one output column with each name.
+    return list(reversed({agg.outname: agg for agg in reversed(aggregations)}.values()))
+
+
+def find_group_ids(
+    sorting_table: pa.Table,
+    num_rows: int,
+    engine: Optional[Engine],
+    keep_null_groups: bool = False,
+    checkpoint: Checkpoint = Checkpoint(),
+    allow_sort: bool = False,
+) -> Optional[GroupIds]:
+    """Assign rows to groups using `engine`; or return `None` for `Engine.SORT`.
+
+    `engine=None` asks `choose_engine()`, which only picks `Engine.SORT` if
+    `allow_sort`. Forcing `Engine.DIRECT` or `Engine.PRESORTED` when it isn't
+    possible raises `ValueError`.
+    """
+    planned = engine is None
+    if planned:
+        stats = gather_input_stats(sorting_table, num_rows)
+        engine = choose_engine(stats, allow_sort)
+    checkpoint(
+        Stage.PLAN,
+        engine=engine.value,
+        planned=planned,
+        estimated_n_groups=stats.estimated_n_groups if planned else None,
+    )
+    if engine == Engine.SORT:
+        return None
+    if engine == Engine.DIRECT and sorting_table.num_columns:
+        group_ids = make_direct_group_ids(sorting_table, keep_null_groups)
+        if group_ids is not None:
+            checkpoint(
+                Stage.GROUP_IDS,
+                n_groups=len(group_ids.group_rows),
+                n_rows_dropped=int((group_ids.group_ids < 0).sum()),
+            )
+            return group_ids
+    if engine == Engine.DIRECT:
+        raise ValueError("Engine.DIRECT cannot handle these groups")
+    if engine == Engine.PRESORTED and sorting_table.num_columns:
+        if not planned and not is_sorted_table(sorting_table):
+            raise ValueError("Engine.PRESORTED needs input sorted by groups")
+        return make_presorted_group_ids(sorting_table, keep_null_groups, checkpoint)
+    return make_sorted_group_ids(sorting_table, num_rows, keep_null_groups, checkpoint)
+
+
+def make_result_table(
+    groups_table: pa.Table,
+    aggregations: List[Aggregation],
+    input_schema: pa.Schema,
+    aggregate: Callable[[Aggregation], pa.Array],
+    checkpoint: Checkpoint = Checkpoint(),
+) -> pa.Table:
+    """Append to `groups_table` one column per aggregation.
+
+    `aggregate(agg)` must return an Array with one value per group. We won't
+    call it when there are no groups.
+    """
+    agg_outnames = frozenset((agg.outname for agg in aggregations))
+    retval = groups_table.select(
+        (
+            colname
+            for colname in groups_table.column_names
+            if colname not in agg_outnames
+        )
+    )
+    for i, agg in enumerate(aggregations):
+        if len(retval) == 0:
+            if agg.operation.outputs_count():
+                field = pa.field(agg.outname, pa.int64(), metadata={"format": "{:,d}"})
+            elif agg.operation.outputs_float():
+                field = pa.field(agg.outname, pa.float64(), metadata={"format": "{:,}"})
+            else:
+                input_field = input_schema.field(agg.colname)
+                field = pa.field(
+                    agg.outname, input_field.type, metadata=input_field.metadata
+                )
+            retval = retval.append_column(field, pa.array([], field.type))
+        else:
+            with timing(Stage.AGGREGATE, outname=agg.outname):
+                array = aggregate(agg)
+            checkpoint(Stage.AGGREGATE, i + 1, outname=agg.outname)
+            if agg.operation.outputs_count():
+                metadata = {"format": "{:,d}"}
+            else:
+                input_field = input_schema.field(agg.colname)
+                if agg.operation.outputs_float() and not pa.types.is_floating(
+                    input_field.type
+                ):
+                    metadata = {"format": "{:,}"}  # float default
+                else:
+                    metadata = input_field.metadata
+            field = pa.field(agg.outname, array.type, metadata=metadata)
+            retval = retval.append_column(field, array)
+
+    return retval
+
+
+def groupby(
+    table: pa.Table,
+    groups: List[Group],
+    aggregations: List[Aggregation],
+    *,
+    engine: Optional[Engine] = None,
+    grouping_sets: Optional[List[List[Group]]] = None,
+    pivot: Optional[Group] = None,
+    transform: bool = False,
+    having: Optional[Having] = None,
+    top_n: Optional[TopN] = None,
+    cancel: Optional[threading.Event] = None,
+    deadline: Optional[float] = None,
+    progress: Optional[Callable[[Progress], None]] = None,
+) -> pa.Table:
+    """Compute one row per group, with one column per group and aggregation.
+
+    See `find_group_ids()` for how `engine` is chosen.
+
+    After each stage (see `Stage`), call `progress`; and raise `Cancelled` if
+    `cancel` is set, or `DeadlineExceeded` once `time.monotonic()` passes
+    `deadline`.
+
+    With `having`, output only groups whose `having.outname` aggregation
+    passes the test. We compute that aggregation first, and then we compute
+    other aggregations only for the groups that pass.
+
+    With `top_n`, output only the best groups, ordered by `top_n.outname`.
+    We compute that aggregation first (after `having`), and then we compute
+    other aggregations -- and pick group keys -- only for the top groups.
+
+    With `grouping_sets` (for instance, `rollup(groups)` or `cube(groups)`),
+    output one block of rows per grouping set, as in SQL `GROUPING SETS`. See
+    `groupby_grouping_sets()`.
+
+    With `pivot`, spread that group's values into columns. See
+    `groupby_pivot()`.
+
+    With `transform=True`, output every input row, with each of its group's
+    aggregations appended. See `groupby_transform()`.
+    """
+    if (grouping_sets is not None) + (pivot is not None) + transform > 1:
+        raise ValueError("pick at most one of grouping_sets, pivot and transform")
+    if (having is not None or top_n is not None) and (
+        grouping_sets is not None or pivot or transform
+    ):
+        raise ValueError(
+            "having and top_n cannot be combined with grouping_sets, pivot or transform"
+        )
+    checkpoint = Checkpoint(cancel, deadline, progress)
+    if transform:
+        return groupby_transform(
+            table, groups, aggregations, engine=engine, checkpoint=checkpoint
+        )
+    if pivot is not None:
+        return groupby_pivot(
+            table, groups, pivot, aggregations, engine=engine, checkpoint=checkpoint
+        )
+
+    if grouping_sets is not None:
+        if engine == Engine.SORT:
+            raise ValueError("grouping_sets cannot use Engine.SORT")
+        return groupby_grouping_sets(
+            table,
+            groups,
+            aggregations,
+            grouping_sets,
+            engine=engine,
+            checkpoint=checkpoint,
+        )
+
+    simple_table = make_table_one_chunk(table)
+    aggregations = unique_aggregations(aggregations)
+    checkpoint = checkpoint._replace(
+        n_rows=simple_table.num_rows, n_aggregations=len(aggregations)
+    )
+    needed_columns = needed_colnames(aggregations)
+    sorting_table = make_sorting_table(simple_table, groups)
+    checkpoint(Stage.SORTING_TABLE)
+    input_table = simple_table.select(needed_columns)
+    # Group selections: (outname, function from values to selected groups)
+    selections = []
+    if having is not None:
+        selections.append(
+            (
+                having.outname,
+                lambda values: np.flatnonzero(
+                    having.comparison.compare(values, having.value)
+                ),
+            )
+        )
+    if top_n is not None:
+        selections.append(
+            (top_n.outname, lambda values: select_top_groups(values, top_n))
+        )
+    aggregations_by_outname = {agg.outname: agg for agg in aggregations}
+    for outname, _ in selections:
+        if outname not in aggregations_by_outname:
+            raise ValueError("%r must name an aggregation" % outname)
+
+    group_ids = find_group_ids(
+        sorting_table,
+        simple_table.num_rows,
+        engine,
+        checkpoint=checkpoint,
+        # Selections aggregate only selected groups by id: SORT can't
+        allow_sort=not selections,
+    )
+    if group_ids is None:
+        sorted_groups, sorted_input_table, group_splits = make_sorted_groups(
+            sorting_table, input_table, checkpoint
+        )
+        retval = make_result_table(
+            sorted_groups,
+            aggregations,
+            input_table.schema,
+            lambda agg: aggregate_sorted(agg, sorted_input_table, group_splits),
+            checkpoint,
+        )
+        for outname, select in selections:
+            # The SORT engine doesn't compact groups; it just filters output
+            if retval.num_rows:
+                selected = select(retval[outname].chunks[0])
+                fields = []
+                arrays = []
+                for field, column in zip(retval.schema, retval.columns):
+                    if field.name in aggregations_by_outname:
+                        array = take_groups(column.chunks[0], selected)
+                    else:
+                        array = column.chunks[0].take(pa.array(selected, pa.int64()))
+                        if pa.types.is_dictionary(array.type):
+                            array = reencode_dictionary_array(array)
+                    fields.append(field.with_type(array.type))
+                    arrays.append(array)
+                retval = pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+                checkpoint(Stage.SELECT_GROUPS, n_groups=len(selected))
+        return retval
+    else:
+        computed = {}
+        for outname, select in selections:
+            if not len(group_ids.group_rows):
+                break
+            if outname in computed:
+                values = computed[outname]
+            else:
+                with timing(Stage.AGGREGATE, outname=outname):
+                    values = aggregate_by_id(
+                        aggregations_by_outname[outname],
+                        input_table,
+                        group_ids.group_ids,
+                        len(group_ids.group_rows),
+                    )
+            selected = select(values)
+            group_ids, input_table = compact_groups(group_ids, selected, input_table)
+            checkpoint(Stage.SELECT_GROUPS, n_groups=len(selected))
+            computed[outname] = values
+            computed = {
+                name: take_groups(array, selected) for name, array in computed.items()
+            }
+        groups_table = make_groups_table(sorting_table, group_ids.group_rows)
+        return make_result_table(
+            groups_table,
+            aggregations,
+            input_table.schema,
+            lambda agg: (
+                computed[agg.outname]
+                if agg.outname in computed
+                else aggregate_by_id(
+                    agg, input_table, group_ids.group_ids, groups_table.num_rows
+                )
+            ),
+            checkpoint,
+        )
+
+
+class StageStats(NamedTuple):
+    """What one `Stage` cost, measured by `explain_groupby()`."""
+
+    stage: Stage
+    seconds: float
+    """Wall time since the previous stage finished."""
+
+    arrow_peak_bytes: int
+    """Most Arrow memory held during the stage, beyond what it started with.
+
+    Arrow's pool can't reset its peak. If an earlier peak was higher, this
+    uses the larger of the stage's starting and ending memory instead."""
+
+    traced_peak_bytes: int
+    """Most `tracemalloc`-traced memory (NumPy and Python objects) held during
+    the stage, beyond what it started with. (Before Python 3.9, which can't
+    reset the peak, this is the peak since `explain_groupby()` started.)"""
+
+    details: Optional[Dict[str, Any]]
+    """`Progress.details`."""
+
+
+class Explanation(NamedTuple):
+    """How `groupby()` computed its result, from `explain_groupby()`."""
+
+    engine: Engine
+    planned: bool
+    """True if `choose_engine()` picked `engine`; False if the caller forced it."""
+
+    kernels: Dict[str, str]
+    """`describe_kernel()` for each aggregation, keyed by outname."""
+
+    n_rows: int
+    estimated_n_groups: Optional[int]
+    """The planner's estimate, or `None` if the caller forced `engine`."""
+
+    n_groups: Optional[int]
+    """Groups found, before `having` and `top_n`; `None` if there are no keys."""
+
+    n_output_rows: int
+    n_rows_dropped: int
+    """Input rows with null group keys, which are in no group."""
+
+    stages: List[StageStats]
+    seconds: float
+
+    def to_json(self) -> Dict[str, Any]:
+        """Convert to a dict that `json.dumps()` accepts."""
+        return dict(
+            self._asdict(),
+            engine=self.engine.value,
+            stages=[
+                dict(stage._asdict(), stage=stage.stage.value) for stage in self.stages
+            ],
+        )
+
+
+def explain_groupby(
+    table: pa.Table, groups: List[Group], aggregations: List[Aggregation], **kwargs
+) -> Tuple[pa.Table, Explanation]:
+    """Run `groupby()`, and explain its plan and what each stage cost.
+
+    `kwargs` are passed to `groupby()` (except `progress`, which we use).
+
+    Measuring memory uses `tracemalloc`, which slows Python allocations: this
+    is for diagnosis, not for every render.
+    """
+    stages = []
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    pool = pa.default_memory_pool()
+    start = last = time.perf_counter()
+    last_arrow_bytes = pool.bytes_allocated()
+    last_arrow_max = pool.max_memory()
+    if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+
+        tracemalloc.reset_peak()
+    last_traced_bytes = tracemalloc.get_traced_memory()[0]
+
+    def record(progress: Progress) -> None:
+        nonlocal last, last_arrow_bytes, last_arrow_max, last_traced_bytes
+        now = time.perf_counter()
+        arrow_bytes = pool.bytes_allocated()
+        arrow_max = pool.max_memory()
+        if arrow_max > last_arrow_max:
+            arrow_peak = arrow_max  # this stage set a new record
+        else:
+            arrow_peak = np.maximum(arrow_bytes, last_arrow_bytes)
+        traced_bytes, traced_peak = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        stages.append(
+            StageStats(
+                progress.stage,
+                now - last,
+                int(arrow_peak - last_arrow_bytes),
+                traced_peak - last_traced_bytes,
+                progress.details,
+            )
+        )
+        last, last_arrow_bytes, last_arrow_max = now, arrow_bytes, arrow_max
+        last_traced_bytes = traced_bytes
+
+    try:
+        result = groupby(table, groups, aggregations, progress=record, **kwargs)
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    seconds = time.perf_counter() - start
+
+    def first_detail(name: str, stage_set: FrozenSet[Stage]) -> Any:
+        for stage in stages:
+            if stage.stage in stage_set and stage.details and name in stage.details:
+                return stage.details[name]
+        return None
+
+    plan = first_detail("engine", frozenset([Stage.PLAN]))
+    # Without group keys, there's no plan: one group, no sort
+    engine = Engine.SORT if plan is None else Engine(plan)
+    return result, Explanation(
+        engine=engine,
+        planned=bool(first_detail("planned", frozenset([Stage.PLAN]))),
+        kernels={
+            agg.outname: describe_kernel(agg, engine)
+            for agg in unique_aggregations(aggregations)
+        },
+        n_rows=table.num_rows,
+        estimated_n_groups=first_detail("estimated_n_groups", frozenset([Stage.PLAN])),
+        n_groups=first_detail("n_groups", frozenset([Stage.DEDUP, Stage.GROUP_IDS])),
+        n_output_rows=result.num_rows,
+        n_rows_dropped=first_detail(
+            "n_rows_dropped", frozenset([Stage.NULL_FILTER, Stage.GROUP_IDS])
+        )
+        or 0,
+        stages=stages,
+        seconds=seconds,
+    )
+
+
+class PartialGroups(NamedTuple):
+    groups_table: pa.Table
+    """Groups: one row per group, sorted."""
+
+    partials: Dict[str, Any]
+    """Partial aggregation per output column name: one value per group."""
+
+
+def make_partial_groups(
+    simple_table: pa.Table,
+    groups: List[Group],
+    aggregations: List[Aggregation],
+    engine: Optional[Engine],
+    keep_null_groups: bool = False,
+    checkpoint: Checkpoint = Checkpoint(),
+) -> PartialGroups:
+    """Group `simple_table` and start a mergeable partial per aggregation."""
+    needed_columns = needed_colnames(aggregations)
+    sorting_table = make_sorting_table(simple_table, groups)
+    checkpoint(Stage.SORTING_TABLE)
+    input_table = simple_table.select(needed_columns)
+    group_ids = find_group_ids(
+        sorting_table, simple_table.num_rows, engine, keep_null_groups, checkpoint
+    )
+    groups_table = make_groups_table(sorting_table, group_ids.group_rows)
+    partials = {}
+    for i, agg in enumerate(aggregations):
+        with timing(Stage.AGGREGATE, outname=agg.outname):
+            partials[agg.outname] = start_partial(
+                agg, input_table, group_ids.group_ids, groups_table.num_rows
+            )
+        checkpoint(Stage.AGGREGATE, i + 1, outname=agg.outname)
+    return PartialGroups(groups_table, partials)
+
+
+def merge_partial_groups(
+    partial_groups: PartialGroups, groups: List[Group]
+) -> PartialGroups:
+    """Regroup `partial_groups` by coarser `groups`, merging partials.
+
+    Each of `groups` must nest a group of `partial_groups`: either the same
+    column, or the same column at a coarser date granularity.
+    """
+    fine_table = partial_groups.groups_table
+    sorting_table = make_sorting_table(fine_table, groups)
+    group_ids = find_group_ids(sorting_table, fine_table.num_rows, None)
+    groups_table = make_groups_table(sorting_table, group_ids.group_rows)
+    return PartialGroups(
+        groups_table,
+        {
+            outname: partial.merge(group_ids.group_ids, groups_table.num_rows)
+            for outname, partial in partial_groups.partials.items()
+        },
+    )
+
+
+def finish_partial_groups(
+    partial_groups: PartialGroups,
+    aggregations: List[Aggregation],
+    input_schema: pa.Schema,
+) -> pa.Table:
+    return make_result_table(
+        partial_groups.groups_table,
+        aggregations,
+        input_schema,
+        lambda agg: finish_partial(
+            agg, input_schema, partial_groups.partials[agg.outname]
+        ),
+    )
+
+
+def groupby_date_granularities(
+    table: pa.Table,
+    groups: List[Group],
+    aggregations: List[Aggregation],
+    date_granularities: List[DateGranularity],
+) -> List[pa.Table]:
+    """Compute `groupby()` at several date granularities, reading rows once.
+
+    Result `i` is what `groupby()` would return if every `Group` with a
+    `date_granularity` had `date_granularities[i]` instead.
+
+    We group rows once, at the coarsest granularity that nests within all of
+    `date_granularities`. Then we merge those groups' partial aggregations into
+    coarser groups -- without sorting or re-bucketing the input again.
+    """
+    if not date_granularities:
+        return []
+
+    finest = [
+        granularity
+        for granularity in DateGranularity
+        if all(granularity.nests_in(other) for other in date_granularities)
+    ][-1]
+
+    def groups_at(granularity: DateGranularity) -> List[Group]:
+        return [
+            (
+                group
+                if group.date_granularity is None
+                else group._replace(date_granularity=granularity)
+            )
+            for group in groups
+        ]
+
+    simple_table = make_table_one_chunk(table)
+    aggregations = unique_aggregations(aggregations)
+    fine = make_partial_groups(simple_table, groups_at(finest), aggregations, None)
+    has_dates = any(group.date_granularity is not None for group in groups)
+
+    return [
+        finish_partial_groups(
+            (
+                fine
+                if granularity == finest or not has_dates
+                else merge_partial_groups(fine, groups_at(granularity))
+            ),
+            aggregations,
+            simple_table.schema,
+        )
+        for granularity in date_granularities
+    ]
+
+
+def rollup(groups: List[Group]) -> List[List[Group]]:
+    """List grouping sets for SQL `ROLLUP`: every prefix of `groups`, longest first."""
+    return [groups[:n] for n in range(len(groups), -1, -1)]
+
+
+def cube(groups: List[Group]) -> List[List[Group]]:
+    """List grouping sets for SQL `CUBE`: every subset of `groups`, largest first."""
+    return [
+        list(subset)
+        for n in range(len(groups), -1, -1)
+        for subset in itertools.combinations(groups, n)
+    ]
+
+
+def groupby_grouping_sets(
+    table: pa.Table,
+    groups: List[Group],
+    aggregations: List[Aggregation],
+    grouping_sets: List[List[Group]],
+    *,
+    engine: Optional[Engine] = None,
+    checkpoint: Checkpoint = Checkpoint(),
+) -> pa.Table:
+    """Compute one block of rows per grouping set, like SQL `GROUPING SETS`.
+
+    Every grouping set must be a subset of `groups`. The output has one column
+    per group and aggregation. Block `i` holds `groupby()` over
+    `grouping_sets[i]`, with null in the group columns that aren't in the set.
+
+    We group input rows once, by all `groups` -- keeping null groups, because
+    a grouping set without a null's column must still count its row. Every
+    grouping set merges those groups' partial aggregations (dropping groups
+    with nulls in its own columns) -- it never reads the input rows.
+    """
+    for grouping_set in grouping_sets:
+        for group in grouping_set:
+            if group not in groups:
+                raise ValueError("Grouping set %r is not in groups" % (group,))
+
+    simple_table = make_table_one_chunk(table)
+    aggregations = unique_aggregations(aggregations)
+    checkpoint = checkpoint._replace(
+        n_rows=simple_table.num_rows, n_aggregations=len(aggregations)
+    )
+    fine = make_partial_groups(
+        simple_table, groups, aggregations, engine, True, checkpoint
+    )
+    blocks = []
+    for grouping_set in grouping_sets:
+        blocks.append(merge_partial_groups(fine, grouping_set))
+        checkpoint(
+            Stage.MERGE,
+            len(aggregations),
+            n_groups=blocks[-1].groups_table.num_rows,
+        )
+
+    def group_column(field: pa.Field) -> pa.Array:
+        value_type = (
+            field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+        )
+        array = pa.concat_arrays(
+            [
+                (
+                    block.groups_table[field.name].chunks[0].cast(value_type)
+                    if field.name in block.groups_table.column_names
+                    else pa.nulls(block.groups_table.num_rows, value_type)
+                )
+                for block in blocks
+            ]
+        )
+        return array.dictionary_encode() if value_type != field.type else array
+
+    fine_schema = fine.groups_table.schema
+    groups_table = pa.table(
+        [group_column(field) for field in fine_schema], schema=fine_schema
+    )
+    return make_result_table(
+        groups_table,
+        aggregations,
+        simple_table.schema,
+        lambda agg: restore_dictionary(
+            agg,
+            simple_table.schema,
+            pa.concat_arrays(
+                [block.partials[agg.outname].finish() for block in blocks]
+            ),
+        ),
+    )
+
+
+def groupby_transform(
+    table: pa.Table,
+    groups: List[Group],
+    aggregations: List[Aggregation],
+    *,
+    engine: Optional[Engine] = None,
+    checkpoint: Checkpoint = Checkpoint(),
+) -> pa.Table:
+    """Append each row's group's aggregations to every input row.
+
+    Output has the same rows as `table`, in the same order. An aggregation
+    replaces any input column with its `outname`. Rows with a null group get
+    null aggregations.
+
+    We aggregate once per group, then `take()` by each row's group id: O(n),
+    with no join.
+    """
+    if engine == Engine.SORT:
+        raise ValueError("transform cannot use Engine.SORT")
+
+    simple_table = make_table_one_chunk(table)
+    aggregations = unique_aggregations(aggregations)
+    checkpoint = checkpoint._replace(
+        n_rows=simple_table.num_rows, n_aggregations=len(aggregations)
+    )
+    needed_columns = needed_colnames(aggregations)
+    sorting_table = make_sorting_table(simple_table, groups)
+    checkpoint(Stage.SORTING_TABLE)
+    input_table = simple_table.select(needed_columns)
+    group_ids = find_group_ids(
+        sorting_table, simple_table.num_rows, engine, checkpoint=checkpoint
+    )
+    groups_table = make_groups_table(sorting_table, group_ids.group_rows)
+    result = make_result_table(
+        groups_table.select([]),
+        aggregations,
+        input_table.schema,
+        lambda agg: aggregate_by_id(
+            agg, input_table, group_ids.group_ids, groups_table.num_rows
+        ),
+        checkpoint,
+    )
+
+    row_groups = pa.array(group_ids.group_ids, mask=group_ids.group_ids < 0)
+    agg_outnames = frozenset((agg.outname for agg in aggregations))
+    retval = simple_table.select(
+        [
+            colname
+            for colname in simple_table.column_names
+            if colname not in agg_outnames
+        ]
     )
+    for agg in aggregations:
+        retval = retval.append_column(
+            result.schema.field(agg.outname),
+            result[agg.outname].chunks[0].take(row_groups),
+        )
+    return retval
 
-    if input_table.num_columns:
-        sorted_input_table = input_table.take(nonnull_indices)
-    else:
-        # Don't .take() on a zero-column Arrow table: its .num_rows would change
-        #
-        # All rows are identical, so .slice() gives the table we want
-        sorted_input_table = input_table.slice(0, len(nonnull_indices))
 
-    sorted_groups_with_dups = sorting_table.take(nonnull_indices)
+def segmented_scan(np_ufunc: np.ufunc, values: np.array, offsets: np.array):
+    """Compute a running `np_ufunc` over segments of `values`.
 
-    # "is_dup": find each row in sorted_groups_with_dups that is _equal_ to
-    # the row before it. (The first value compares the first and second row.)
-    #
-    # We start assuming all are equal; then we search for inequality
-    if len(sorted_groups_with_dups):
-        is_dup = pa.array(np.ones(len(sorted_groups_with_dups) - 1), pa.bool_())
-        for column in sorted_groups_with_dups.itercolumns():
-            chunk = column.chunks[0]
-            if pa.types.is_dictionary(chunk.type):
-                chunk = chunk.indices
-            first = chunk.slice(0, len(column) - 1)
-            second = chunk.slice(1)
-            # TODO when we support NULL groups:
-            # both_null = pa.compute.and_(first.is_null(), second.is_null())
-            # both_equal_if_not_null = pa.compute.equal(first, second)
-            # both_equal = pa.compute.fill_null(both_equal_if_not_null, False)
-            # value_is_dup = pa.compute.or_(both_null, both_equal)
-            # ... and for now, it's simply:
-            value_is_dup = pa.compute.equal(first, second)
-            is_dup = pa.compute.and_(is_dup, value_is_dup)
+    `offsets[i]` is row `i`'s position within its segment (0 for a segment's
+    first row). This is a Hillis-Steele scan: O(n log L) for longest segment
+    L, with no per-segment Python.
+    """
+    result = values.copy()
+    shift = 1
+    max_offset = offsets.max() if len(offsets) else 0
+    while shift <= max_offset:
+        rows = np.flatnonzero(offsets >= shift)
+        result[rows] = np_ufunc(result[rows], result[rows - shift])
+        shift *= 2
+    return result
 
-        group_splits = np.where(~(is_dup.to_numpy(zero_copy_only=False)))[0] + 1
 
-        sorted_groups = reencode_dictionaries(
-            sorted_groups_with_dups.take(np.insert(group_splits, 0, 0))
+def window_sorted(
+    operation: WindowOperation, sorted_array: pa.Array, offsets: np.array
+) -> pa.Array:
+    """Compute `operation` over sorted rows; `offsets` count rows since group start."""
+    if operation == WindowOperation.ROW_NUMBER:
+        return pa.array(offsets + 1, pa.int64())
+
+    valid = sorted_array.is_valid().to_numpy(zero_copy_only=False)
+    if operation == WindowOperation.CUMCOUNT:
+        counts = np.cumsum(valid, dtype=np.int64)
+        starts = np.arange(len(offsets)) - offsets
+        return pa.array(counts - counts[starts] + valid[starts], pa.int64())
+
+    null_mask = None if sorted_array.null_count == 0 else ~valid
+    array_type = sorted_array.type
+    if pa.types.is_timestamp(array_type) or pa.types.is_date(array_type):
+        int_type = pa.int64() if array_type.bit_width == 64 else pa.int32()
+        return window_sorted(operation, sorted_array.view(int_type), offsets).view(
+            array_type
+        )
+
+    if operation == WindowOperation.CUMSUM:
+        values = pa.compute.fill_null(sorted_array, pa.scalar(0, array_type))
+        values = values.to_numpy(zero_copy_only=False)
+        if pa.types.is_integer(array_type):
+            # Subtracting each group's starting total is exact, even past 2^63
+            totals = np.cumsum(values.astype(np.int64))
+            starts = np.arange(len(offsets)) - offsets
+            sums = totals - totals[starts] + values[starts]
+            return pa.array(sums, pa.int64(), mask=null_mask)
+        else:
+            # A global cumsum would make floats lose precision; scan per group
+            sums = segmented_scan(np.add, values, offsets)
+            return pa.array(sums, array_type, mask=null_mask)
+
+    np_ufunc = np.minimum if operation == WindowOperation.CUMMIN else np.maximum
+    if pa.types.is_integer(array_type) or pa.types.is_floating(array_type):
+        dtype = array_type.to_pandas_dtype()
+        if pa.types.is_floating(array_type):
+            identity = np.inf if np_ufunc == np.minimum else -np.inf
+        elif np_ufunc == np.minimum:
+            identity = np.iinfo(dtype).max
+        else:
+            identity = np.iinfo(dtype).min
+        values = pa.compute.fill_null(sorted_array, pa.scalar(identity, array_type))
+        extremes = segmented_scan(
+            np_ufunc, values.to_numpy(zero_copy_only=False), offsets
         )
+        return pa.array(extremes, array_type, mask=null_mask)
     else:
-        sorted_groups = sorted_groups_with_dups
-        group_splits = np.array([], np.int64())
+        # Text: scan codes, then look up the values they stand for
+        _, codes, dictionary = nonnull_codes_by_id(
+            sorted_array, np.zeros(len(sorted_array), np.int64)
+        )
+        all_codes = np.full(
+            len(sorted_array), len(dictionary) if np_ufunc == np.minimum else -1
+        )
+        all_codes[valid] = codes
+        extremes = segmented_scan(np_ufunc, all_codes, offsets)
+        return dictionary.take(pa.array(extremes, pa.int64(), mask=null_mask))
 
-    return SortedGroups(
-        sorted_groups=sorted_groups,
-        sorted_input_table=sorted_input_table,
-        group_splits=group_splits,
-    )
 
+def groupby_window(
+    table: pa.Table,
+    groups: List[Group],
+    window_aggregations: List[WindowAggregation],
+) -> pa.Table:
+    """Append running per-group values to every input row.
 
-def make_table_one_chunk(table: pa.Table) -> pa.Table:
-    assert len(table.columns), "Workbench must not give a zero-column table"
+    Output has the same rows as `table`, in the same order. Within a group,
+    "running" follows input order. Each window aggregation replaces any input
+    column with its `outname`. Rows with a null group get null results; null
+    input values get null results and are skipped in the running value.
 
-    if table.columns[0].num_chunks == 0:
-        return pa.table(
-            {
-                field.name: pa.array([], field.type)
-                for field in (
-                    table.schema.field(i) for i in range(len(table.schema.names))
-                )
-            },
-            schema=table.schema,
+    We sort the groups once, then scan each column with vectorized segmented
+    scans using `group_splits`: no per-group Python.
+    """
+    simple_table = make_table_one_chunk(table)
+    window_aggregations = list(
+        reversed({agg.outname: agg for agg in reversed(window_aggregations)}.values())
+    )
+    sorting_table = make_sorting_table(simple_table, groups)
+    if sorting_table.num_columns:
+        sorted_indices, _, group_splits = sort_keys(sorting_table)
+    else:
+        sorted_indices = pa.array(np.arange(simple_table.num_rows))
+        group_splits = np.array([], np.int64)
+    n_sorted = len(sorted_indices)
+    group_starts = np.insert(group_splits, 0, 0)
+    group_lengths = np.diff(np.append(group_starts, n_sorted))
+    offsets = np.arange(n_sorted) - np.repeat(group_starts, group_lengths)
+
+    # For each input row, its position in sorted order (or null)
+    positions = np.full(simple_table.num_rows, -1, np.int64)
+    positions[sorted_indices.to_numpy()] = np.arange(n_sorted)
+    row_positions = pa.array(positions, mask=positions < 0)
+
+    outnames = frozenset((agg.outname for agg in window_aggregations))
+    retval = simple_table.select(
+        [colname for colname in simple_table.column_names if colname not in outnames]
+    )
+    for agg in window_aggregations:
+        if agg.operation == WindowOperation.ROW_NUMBER:
+            sorted_array = pa.nulls(n_sorted)
+            metadata = {"format": "{:,d}"}
+        else:
+            sorted_array = simple_table[agg.colname].chunks[0].take(sorted_indices)
+            if agg.operation == WindowOperation.CUMCOUNT:
+                metadata = {"format": "{:,d}"}
+            else:
+                metadata = simple_table.schema.field(agg.colname).metadata
+        array = window_sorted(agg.operation, sorted_array, offsets).take(row_positions)
+        if pa.types.is_dictionary(sorted_array.type) and agg.operation in {
+            WindowOperation.CUMMIN,
+            WindowOperation.CUMMAX,
+        }:
+            array = array.cast(pa.utf8()).dictionary_encode()
+        retval = retval.append_column(
+            pa.field(agg.outname, array.type, metadata=metadata), array
         )
+    return retval
 
-    if table.columns[0].num_chunks == 1:
-        return table
 
-    return table.combine_chunks()
+def time_window_units(array_type: pa.DataType, window: datetime.timedelta) -> int:
+    """Convert `window` to the units of a timestamp or date array."""
+    if pa.types.is_timestamp(array_type):
+        if array_type.unit == "ns":
+            # timedelta can't express nanoseconds; it has microsecond precision
+            return (window // datetime.timedelta(microseconds=1)) * 1000
+        unit = {
+            "s": datetime.timedelta(seconds=1),
+            "ms": datetime.timedelta(milliseconds=1),
+            "us": datetime.timedelta(microseconds=1),
+        }[array_type.unit]
+        return window // unit
+    elif pa.types.is_date32(array_type):
+        return window // datetime.timedelta(days=1)
+    elif pa.types.is_date64(array_type):
+        return window // datetime.timedelta(milliseconds=1)
+    else:
+        raise ValueError("sliding windows need a timestamp or date column")
 
 
-def groupby(
-    table: pa.Table, groups: List[Group], aggregations: List[Aggregation]
+def groupby_sliding_window(
+    table: pa.Table,
+    groups: List[Group],
+    time_colname: str,
+    window: datetime.timedelta,
+    aggregations: List[Aggregation],
+    *,
+    engine: Optional[Engine] = None,
 ) -> pa.Table:
+    """Append each row's trailing-window aggregations to every input row.
+
+    A row's window holds the rows in its group whose `time_colname` value `t`
+    is in `(row_t - window, row_t]`. Supported operations are SIZE, SUM and
+    MEAN. Output has the same rows as `table`, in the same order; rows with a
+    null group or null time get null results.
+
+    We sort rows by group and time once; then find every window's bounds with
+    a vectorized search and subtract prefix sums: O(n log n), no matter how
+    wide the window is.
+    """
+    if engine == Engine.SORT:
+        raise ValueError("sliding windows cannot use Engine.SORT")
+    for agg in aggregations:
+        if agg.operation not in {Operation.SIZE, Operation.SUM, Operation.MEAN}:
+            raise ValueError("sliding windows cannot compute %s" % agg.operation.name)
+
     simple_table = make_table_one_chunk(table)
-    # Pick the "last" of each aggregation for each outname. There will only be
-    # one output column with each name.
-    aggregations: List[Aggregation] = list(
-        reversed({agg.outname: agg for agg in reversed(aggregations)}.values())
-    )
-    agg_outnames = frozenset((agg.outname for agg in aggregations))
-    needed_columns = frozenset((agg.colname for agg in aggregations if agg.colname))
+    aggregations = unique_aggregations(aggregations)
+    time_array = simple_table[time_colname].chunks[0]
+    window_units = time_window_units(time_array.type, window)
+    if window_units <= 0:
+        raise ValueError("window must be positive")
+
     sorting_table = make_sorting_table(simple_table, groups)
+    group_ids = find_group_ids(sorting_table, simple_table.num_rows, engine).group_ids
+    rows = np.flatnonzero(valid_row_mask(time_array, group_ids))
+    int_type = pa.int64() if time_array.type.bit_width == 64 else pa.int32()
+    times = (
+        pa.compute.fill_null(time_array.view(int_type), pa.scalar(0, int_type))
+        .to_numpy(zero_copy_only=False)[rows]
+        .astype(np.int64)
+    )
+    ids = group_ids[rows]
+    # Sort by (group, time) with one integer key. Raw times could overflow the
+    # key; their ranks among distinct times can't. Every search below looks up
+    # sorted queries, which keeps numpy's binary searches cache-friendly.
+    time_order = np.argsort(times)
+    times_in_order = times[time_order]
+    is_new_time = np.empty(len(times), np.bool_)
+    is_new_time[:1] = True
+    np.not_equal(times_in_order[1:], times_in_order[:-1], out=is_new_time[1:])
+    unique_times = times_in_order[is_new_time]
+    time_ranks = np.empty(len(times), np.int64)
+    time_ranks[time_order] = np.cumsum(is_new_time)  # 1, 2, ...
+    # A window starts after its group's rows with time <= row_t - window
+    n_before_window = np.empty(len(times), np.int64)
+    n_before_window[time_order] = np.searchsorted(
+        unique_times,
+        np.maximum(times_in_order, np.iinfo(np.int64).min + window_units)
+        - window_units,
+        side="right",
+    )
 
-    sorted_groups, sorted_input_table, group_splits = make_sorted_groups(
-        sorting_table, simple_table.select(needed_columns)
+    radix = len(unique_times) + 1
+    keys = ids * radix + time_ranks
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    sorted_rows = rows[order]
+    starts = np.searchsorted(
+        sorted_keys, (ids * radix + n_before_window)[order], side="right"
     )
+    ends = np.searchsorted(sorted_keys, sorted_keys, side="right")
+    # A window never crosses its group's start, `group_starts`
+    positions = np.arange(len(sorted_keys))
+    sorted_ids = ids[order]
+    is_group_start = np.empty(len(sorted_ids), np.bool_)
+    is_group_start[:1] = True
+    np.not_equal(sorted_ids[1:], sorted_ids[:-1], out=is_group_start[1:])
+    group_starts = np.maximum.accumulate(np.where(is_group_start, positions, 0))
 
-    retval = sorted_groups.select(
-        (
+    def window_totals(values: np.array) -> np.array:
+        if values.dtype.kind != "f":
+            # Integer sums are exact (modulo 2**64): one global prefix sum
+            prefix_sums = np.concatenate([np.zeros(1, values.dtype), np.cumsum(values)])
+            return prefix_sums[ends] - prefix_sums[starts]
+        # Float prefix sums restart at each group, so one group's large values
+        # can't swamp a later group's small ones
+        prefix_sums = segmented_scan(np.add, values, positions - group_starts)
+        before = np.where(
+            starts > group_starts, prefix_sums[np.maximum(starts - 1, 0)], 0
+        )
+        return prefix_sums[ends - 1] - before
+
+    def matches(agg: Aggregation) -> np.array:
+        """Test `agg.where` on `sorted_rows`."""
+        array = simple_table[agg.where.colname].chunks[0]
+        return agg.where.comparison.compare(array, agg.where.value)[sorted_rows]
+
+    def expand(
+        values: np.array, array_type: pa.DataType, empty: Optional[np.array] = None
+    ) -> pa.Array:
+        """Build an input-length Array from `values` (one per `sorted_rows`).
+
+        Other rows -- and rows where `empty` is True -- are null.
+        """
+        result = np.zeros(simple_table.num_rows, values.dtype)
+        result[sorted_rows] = values
+        mask = np.ones(simple_table.num_rows, np.bool_)
+        mask[sorted_rows] = False if empty is None else empty
+        return pa.array(result, array_type, mask=mask)
+
+    agg_outnames = frozenset((agg.outname for agg in aggregations))
+    retval = simple_table.select(
+        [
             colname
-            for colname in sorted_groups.column_names
+            for colname in simple_table.column_names
             if colname not in agg_outnames
-        )
+        ]
     )
     for agg in aggregations:
-        if len(retval) == 0:
-            if agg.operation in {Operation.SIZE, Operation.NUNIQUE}:
-                field = pa.field(agg.outname, pa.int64(), metadata={"format": "{:,d}"})
-            elif agg.operation in {Operation.MEAN, Operation.MEDIAN}:
-                field = pa.field(agg.outname, pa.float64(), metadata={"format": "{:,}"})
+        if agg.operation == Operation.SIZE:
+            if agg.where is None:
+                array = expand(ends - starts, pa.int64())
             else:
-                input_field = sorted_input_table.schema.field(agg.colname)
-                field = pa.field(
-                    agg.outname, input_field.type, metadata=input_field.metadata
-                )
-            retval = retval.append_column(field, pa.array([], field.type))
+                array = expand(window_totals(matches(agg).astype(np.int64)), pa.int64())
+            metadata = {"format": "{:,d}"}
         else:
-            if agg.operation == Operation.SIZE:
-                array = size(
-                    num_rows=sorted_input_table.num_rows, group_splits=group_splits
-                )
-                field = pa.field(agg.outname, array.type, metadata={"format": "{:,d}"})
-            elif agg.operation == Operation.NUNIQUE:
-                array = nunique(
-                    array=sorted_input_table[agg.colname].chunks[0],
-                    group_splits=group_splits,
-                )
-                field = pa.field(agg.outname, array.type, metadata={"format": "{:,d}"})
-            else:
-                ufunc = dict(
-                    sum=sum,
-                    first=first,
-                    mean=mean,
-                    median=median,
-                    min=min,
-                    max=max,
-                )[agg.operation.value]
-                array = sorted_input_table[agg.colname].chunks[0]
-                if pa.types.is_dictionary(sorted_input_table[agg.colname].type):
-                    array = array.cast(pa.utf8())
-                array = ufunc(array=array, group_splits=group_splits)
-                if pa.types.is_dictionary(sorted_input_table[agg.colname].type):
-                    array = array.cast(pa.utf8()).dictionary_encode()
-                input_field = sorted_input_table.schema.field(agg.colname)
-                if pa.types.is_null(array.type):
-                    # Zero-length table => this is how we choose the type
-                    array = array.cast(input_field.type)
-                if (
-                    agg.operation
-                    in {
-                        Operation.MEAN,
-                        Operation.MEDIAN,
-                    }
-                    and not pa.types.is_floating(input_field.type)
-                ):
-                    metadata = {"format": "{:,}"}  # float default
+            input_field = simple_table.schema.field(agg.colname)
+            array = simple_table[agg.colname].chunks[0]
+            valid = array.is_valid().to_numpy(zero_copy_only=False)[sorted_rows]
+            values = pa.compute.fill_null(array, pa.scalar(0, array.type))
+            values = values.to_numpy(zero_copy_only=False)[sorted_rows]
+            if agg.where is not None:
+                valid &= matches(agg)
+                values = np.where(valid, values, 0).astype(values.dtype)
+            if pa.types.is_integer(array.type):
+                values = values.astype(np.int64)  # wraps, but differences are exact
+            sums = window_totals(values)
+            if agg.operation == Operation.SUM:
+                if pa.types.is_integer(array.type):
+                    array = expand(sums, pa.int64())
                 else:
+                    array = expand(sums.astype(values.dtype), array.type)
+                metadata = input_field.metadata
+            else:
+                counts = window_totals(valid.astype(np.int64))
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    means = sums / counts
+                array = expand(means, pa.float64(), empty=counts == 0)
+                if pa.types.is_floating(input_field.type):
                     metadata = input_field.metadata
-                field = pa.field(agg.outname, array.type, metadata=metadata)
-            retval = retval.append_column(field, array)
+                else:
+                    metadata = {"format": "{:,}"}  # float default
+        retval = retval.append_column(
+            pa.field(agg.outname, array.type, metadata=metadata), array
+        )
+    return retval
+
+
+MAX_PIVOT_COLUMNS = 1000
+"""Largest number of aggregation columns `groupby_pivot()` will output."""
+
+
+def pivot_column_name(value: Any) -> str:
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def groupby_pivot(
+    table: pa.Table,
+    groups: List[Group],
+    pivot: Group,
+    aggregations: List[Aggregation],
+    *,
+    engine: Optional[Engine] = None,
+    max_columns: int = MAX_PIVOT_COLUMNS,
+    checkpoint: Checkpoint = Checkpoint(),
+) -> pa.Table:
+    """Compute one row per group, with one column per pivot value.
+
+    Output has one column per group and one column per (aggregation, pivot
+    value) pair. With one aggregation, a column is named after its pivot
+    value; with several, it is named "{outname} {value}". Null means, "no
+    input rows have this group and pivot value." Rows with null `pivot` are
+    ignored.
+
+    We group once, by `groups` and then `pivot`. Each (group, pivot value)
+    pair gets a cell in the wide table; we scatter aggregation results there.
+
+    Raise `ValueError` if there would be more than `max_columns` aggregation
+    columns. We check before grouping.
+    """
+    aggregations = unique_aggregations(aggregations)
+    simple_table = make_table_one_chunk(table)
+    pivot_values = pa.compute.unique(
+        make_groupable_array(
+            simple_table[pivot.colname].chunks[0], pivot.date_granularity
+        )
+    )
+    n_columns = (len(pivot_values) - pivot_values.null_count) * len(aggregations)
+    if n_columns > max_columns:
+        raise ValueError(
+            "Pivot would create %d columns; the limit is %d" % (n_columns, max_columns)
+        )
+
+    long_table = groupby(
+        simple_table,
+        groups + [pivot],
+        aggregations,
+        engine=engine,
+        cancel=checkpoint.cancel,
+        deadline=checkpoint.deadline,
+        progress=checkpoint.progress,
+    )
+    n_long = long_table.num_rows
+    # long_table is sorted by groups, then pivot: rows with equal groups are
+    # adjacent, so group boundaries come without another sort
+    row_sorting_table = make_sorting_table(
+        long_table, [Group(group.colname, None) for group in groups]
+    )
+    if row_sorting_table.num_columns and n_long:
+        row_splits = find_group_splits(row_sorting_table)
+    else:
+        row_splits = np.array([], np.int64)
+    is_row_start = np.zeros(n_long, np.int64)
+    is_row_start[row_splits] = 1
+    row_ids = np.cumsum(is_row_start)
+    row_starts = np.insert(row_splits, 0, 0) if n_long else row_splits
+    n_rows = len(row_starts)
+    # Pivot values are few (see `max_columns`): rank them, not the long table
+    pivot_array = long_table[pivot.colname].chunks[0]
+    if not pa.types.is_dictionary(pivot_array.type):
+        pivot_array = pivot_array.dictionary_encode()
+    ranks, n_pivots = dictionary_ranks(pivot_array.dictionary)
+    column_ids = ranks[pivot_array.indices.to_numpy(zero_copy_only=False)]
+    rank_indices = np.empty(n_pivots, np.int64)
+    rank_indices[ranks] = np.arange(len(ranks))
+    cells = np.full((n_pivots, n_rows), -1, np.int64)
+    cells[column_ids, row_ids] = np.arange(n_long)
 
+    retval = make_groups_table(row_sorting_table, row_starts)
+    pivot_names = [
+        pivot_column_name(value)
+        for value in pivot_array.dictionary.take(pa.array(rank_indices)).to_pylist()
+    ]
+    for agg in aggregations:
+        field = long_table.schema.field(agg.outname)
+        values = long_table[agg.outname].chunks[0]
+        for pivot_name, long_rows in zip(pivot_names, cells):
+            if len(aggregations) == 1:
+                name = pivot_name
+            else:
+                name = "%s %s" % (agg.outname, pivot_name)
+            if name in retval.column_names:
+                raise ValueError("Pivot column %r would be duplicated" % name)
+            array = values.take(pa.array(long_rows, mask=long_rows < 0))
+            retval = retval.append_column(field.with_name(name), array)
     return retval
 
 
@@ -741,6 +3578,7 @@ def _timestamp_is_rounded(
     ).as_py()
 
 
+@timed(Stage.DATE_GRANULARITY_CHECK)
 def _warn_if_using_deprecated_date_granularity(
     table: pa.Table, groups: List[Group]
 ) -> List[RenderError]:
@@ -905,9 +3743,50 @@ def _generate_group_dates_help_warning(
     )
 
 
-def render_arrow_v1(
-    table: pa.Table, params: Dict[str, Any], **kwargs
-) -> ArrowRenderResult:
+class RenderPlan(NamedTuple):
+    """What `render_arrow_v1()` computes: parsed and validated params."""
+
+    groups: List[Group]
+    aggregations: List[Aggregation]
+    errors: List[RenderError]
+    """Warnings to show with the result."""
+
+
+PREVIEW_SAMPLE_ROWS = 200_000
+"""Rows to aggregate in a preview render: fast enough to keep up with typing."""
+
+
+def sample_table(table: pa.Table, n_rows: int) -> pa.Table:
+    """Pick `n_rows` rows at random -- the same ones each time -- in order."""
+    rows = np.random.default_rng(0).choice(table.num_rows, n_rows, replace=False)
+    rows.sort()
+    return table.take(pa.array(rows))
+
+
+def scale_estimates(
+    table: pa.Table, aggregations: List[Aggregation], scale: float
+) -> pa.Table:
+    """Multiply SIZE and SUM columns by `scale`, to estimate from a sample."""
+    for agg in unique_aggregations(aggregations):
+        if agg.operation not in {Operation.SIZE, Operation.SUM}:
+            continue
+        index = table.schema.get_field_index(agg.outname)
+        field = table.schema.field(index)
+        values = table[agg.outname].to_numpy() * scale
+        if pa.types.is_integer(field.type):
+            values = np.rint(values)
+        table = table.set_column(index, field, pa.array(values, field.type))
+    return table
+
+
+def make_render_plan(
+    table: pa.Table, params: Dict[str, Any]
+) -> Union[RenderPlan, ArrowRenderResult]:
+    """Parse and validate `params`; or return a result that needs no groupby.
+
+    The plan can be executed twice on the same table: as a preview and then
+    exactly. See `render_arrow_v1()`.
+    """
     colnames = table.column_names
     date_colnames = frozenset(
         colname for colname in colnames if pa.types.is_timestamp(table[colname].type)
@@ -994,5 +3873,415 @@ def render_arrow_v1(
             )
         ]
 
-    result_table = groupby(table, groups, aggregations)
-    return ArrowRenderResult(result_table, errors=errors)
+    return RenderPlan(groups, aggregations, errors)
+
+
+def cancelled_result(err: Cancelled) -> ArrowRenderResult:
+    """Report that `groupby()` stopped early. (Its intermediates are gone.)"""
+    if isinstance(err, DeadlineExceeded):
+        message = i18n.trans(
+            "deadline_exceeded.error", "This step took too long, so we stopped it."
+        )
+    else:
+        message = i18n.trans("cancelled.error", "This step was cancelled.")
+    return ArrowRenderResult(pa.table({}), errors=[RenderError(message)])
+
+
+PROFILE_DIR_ENV = "GROUPBY_PROFILE_DIR"
+PROFILE_THRESHOLD_ENV = "GROUPBY_PROFILE_THRESHOLD"
+PROFILE_INTERVAL_ENV = "GROUPBY_PROFILE_INTERVAL"
+
+
+class ProfileConfig(NamedTuple):
+    """Where and when `render_arrow_v1()` writes profiles of slow renders."""
+
+    directory: Path
+    threshold: float = 1.0
+    """Seconds: we only write profiles of renders that take at least this long."""
+
+    interval: float = 0.005
+    """Seconds between stack samples."""
+
+
+def profile_config_from_environ() -> Optional[ProfileConfig]:
+    """Read `ProfileConfig` from environment variables; `None` if not set.
+
+    GROUPBY_PROFILE_DIR enables profiling. GROUPBY_PROFILE_THRESHOLD and
+    GROUPBY_PROFILE_INTERVAL are in seconds.
+    """
+    directory = os.environ.get(PROFILE_DIR_ENV)
+    if not directory:
+        return None
+    config = ProfileConfig(Path(directory))
+    if PROFILE_THRESHOLD_ENV in os.environ:
+        config = config._replace(threshold=float(os.environ[PROFILE_THRESHOLD_ENV]))
+    if PROFILE_INTERVAL_ENV in os.environ:
+        config = config._replace(interval=float(os.environ[PROFILE_INTERVAL_ENV]))
+    return config
+
+
+def collapse_stack(frame) -> str:
+    """Format `frame` and its callers as "file:function;file:function;..."."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+@contextlib.contextmanager
+def sample_stacks(interval: float) -> Iterator[collections.Counter]:
+    """Count the calling thread's stacks, sampled every `interval` seconds.
+
+    A helper thread reads the stack with `sys._current_frames()`, so the
+    profiled code runs unmodified (and nearly at full speed).
+    """
+    thread_id = threading.get_ident()
+    counts = collections.Counter()
+    done = threading.Event()
+
+    def sample() -> None:
+        while not done.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                counts[collapse_stack(frame)] += 1
+
+    sampler = threading.Thread(target=sample, name="groupby-profiler", daemon=True)
+    sampler.start()
+    try:
+        yield counts
+    finally:
+        done.set()
+        sampler.join()
+
+
+def params_digest(params: Dict[str, Any]) -> str:
+    """Identify `params` without revealing them (e.g., column names)."""
+    data = json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def write_profile(
+    config: ProfileConfig,
+    counts: collections.Counter,
+    params: Dict[str, Any],
+    table: pa.Table,
+    seconds: float,
+) -> Path:
+    """Write `counts` in "collapsed stack" format, as flamegraph.pl reads.
+
+    The filename holds the params digest, the table shape and the duration.
+    """
+    config.directory.mkdir(parents=True, exist_ok=True)
+    path = config.directory / (
+        "render-%s-%dx%d-%dms-%d.collapsed"
+        % (
+            params_digest(params),
+            table.num_rows,
+            table.num_columns,
+            seconds * 1000,
+            time.time_ns(),
+        )
+    )
+    path.write_text("".join("%s %d\n" % item for item in sorted(counts.items())))
+    return path
+
+
+CAPTURE_DIR_ENV = "GROUPBY_CAPTURE_DIR"
+CAPTURE_DATA_ENV = "GROUPBY_CAPTURE_DATA"
+
+
+class CaptureConfig(NamedTuple):
+    """Where `render_arrow_v1()` records workloads, for `benchmarks/replay.py`."""
+
+    directory: Path
+    data: bool = False
+    """Also write the table, with every value hashed."""
+
+
+def capture_config_from_environ() -> Optional[CaptureConfig]:
+    """Read `CaptureConfig` from environment variables; `None` if not set.
+
+    GROUPBY_CAPTURE_DIR enables capture. GROUPBY_CAPTURE_DATA=1 adds data.
+    """
+    directory = os.environ.get(CAPTURE_DIR_ENV)
+    if not directory:
+        return None
+    return CaptureConfig(Path(directory), os.environ.get(CAPTURE_DATA_ENV) == "1")
+
+
+def anonymize_params(params: Dict[str, Any], colnames: List[str]) -> Dict[str, Any]:
+    """Rename columns in `params` to "c0", "c1", ...; and outnames to "out0", ...
+
+    Operations, percentiles and date granularities are kept: they're what we replay.
+    """
+    names = {colname: "c%d" % i for i, colname in enumerate(colnames)}
+
+    def rename(colname: str) -> str:
+        return names.get(colname, "missing") if colname else ""
+
+    groups = params["groups"]
+    return {
+        "groups": {
+            "colnames": [rename(colname) for colname in groups["colnames"]],
+            "group_dates": groups["group_dates"],
+            "date_granularities": {
+                rename(colname): granularity
+                for colname, granularity in groups["date_granularities"].items()
+            },
+        },
+        "aggregations": [
+            {
+                **aggregation,
+                "colname": rename(aggregation["colname"]),
+                "outname": "out%d" % i if aggregation["outname"] else "",
+            }
+            for i, aggregation in enumerate(params["aggregations"])
+        ],
+    }
+
+
+def anonymize_array(array: pa.Array, salt: np.uint64) -> pa.Array:
+    """Replace each value with a salted hash, keeping type, nulls and equality.
+
+    Numbers, timestamps and dates stay within the column's min-max range (so
+    `Engine.DIRECT` sees the same range): integers are numbered in hash order
+    and spread over it. Text becomes hex digits. Booleans may swap. Without
+    `salt`, nobody can reverse the hashes by guessing values.
+    """
+    if array.null_count:
+        mask = array.is_null().to_numpy(zero_copy_only=False)
+    else:
+        mask = None
+    if pa.types.is_boolean(array.type):
+        # Two values: hashing can't hide them, but we can swap them
+        values = pa.compute.fill_null(array, False).to_numpy(zero_copy_only=False)
+        return pa.array(values ^ bool(salt & np.uint64(1)), mask=mask)
+    elif pa.types.is_timestamp(array.type) or pa.types.is_date(array.type):
+        int_type = pa.int64() if array.type.bit_width == 64 else pa.int32()
+        return anonymize_array(array.view(int_type), salt).view(array.type)
+    elif not (
+        pa.types.is_string(array.type)
+        or pa.types.is_dictionary(array.type)
+        or pa.types.is_integer(array.type)
+        or pa.types.is_floating(array.type)
+    ):
+        return pa.nulls(len(array), array.type)
+
+    hashes = splitmix64(hash_values(array) ^ salt)
+    if pa.types.is_floating(array.type):
+        min_max = pa.compute.min_max(array).as_py()
+        if min_max["min"] is None:
+            return array
+        low, high = min_max["min"], min_max["max"]
+        fractions = (hashes >> np.uint64(11)) * (1.0 / (1 << 53))
+        return pa.array(low + fractions * (high - low), mask=mask).cast(array.type)
+
+    # Number distinct values in (salted, so random) hash order. Null rows'
+    # hashes are garbage: leave them out.
+    if mask is None:
+        unique_hashes, ranks = np.unique(hashes, return_inverse=True)
+    else:
+        unique_hashes, valid_ranks = np.unique(hashes[~mask], return_inverse=True)
+        ranks = np.zeros(len(array), np.int64)
+        ranks[~mask] = valid_ranks
+    if pa.types.is_integer(array.type):
+        min_max = pa.compute.min_max(array).as_py()
+        if min_max["min"] is None:
+            return array
+        low, high = min_max["min"], min_max["max"]
+        # Spread ranks evenly over [low, high]. There are at most
+        # `high - low + 1` distinct values, so no two get the same number.
+        n_steps = len(unique_hashes) - 1 or 1
+        step, remainder = divmod(high - low, n_steps)
+        ranks = ranks.astype(np.uint64)
+        offsets = ranks * np.uint64(step) + ranks * np.uint64(remainder) // np.uint64(
+            n_steps
+        )
+        values = offsets + np.uint64(low % (1 << 64))  # wraps, like int64
+        if pa.types.is_signed_integer(array.type):
+            values = values.view(np.int64)
+        return pa.array(values, mask=mask).cast(array.type)
+    else:
+        dictionary = pa.array(["%016x" % h for h in unique_hashes.tolist()])
+        result = pa.DictionaryArray.from_arrays(
+            pa.array(ranks.astype(np.int32), mask=mask), dictionary
+        )
+        if pa.types.is_string(array.type):
+            result = result.cast(pa.utf8())
+        return result
+
+
+CAPTURE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="groupby-capture"
+)
+"""Runs `capture_workload()` after `render_arrow_v1()` returns, one at a time."""
+
+
+def wait_for_captures() -> None:
+    """Block until every workload captured so far is written."""
+    CAPTURE_EXECUTOR.submit(lambda: None).result()
+
+
+def capture_workload(
+    config: CaptureConfig, table: pa.Table, params: Dict[str, Any], seconds: float
+) -> Path:
+    """Record `table`'s shape and stats and `params`, without revealing them.
+
+    Write "workload-<params digest>-<n>.json"; with `config.data`, also a
+    ".arrow" file of `anonymize_array()` columns.
+    """
+    config.directory.mkdir(parents=True, exist_ok=True)
+    name = "workload-%s-%d" % (params_digest(params), time.time_ns())
+    simple_table = make_table_one_chunk(table) if table.num_columns else table
+    fields = [field.with_name("c%d" % i) for i, field in enumerate(simple_table.schema)]
+    columns = []
+    for field, column in zip(fields, simple_table.columns):
+        column_table = pa.table({field.name: column})
+        columns.append(
+            {
+                "name": field.name,
+                "null_count": column.null_count,
+                "n_distinct": estimate_n_groups(column_table),
+                "max_codes": gather_key_stats(column.chunks[0]).max_codes,
+                "is_sorted": is_sorted_table(column_table),
+            }
+        )
+    record = {
+        "params_digest": params_digest(params),
+        "params": anonymize_params(params, table.column_names),
+        "schema": base64.b64encode(pa.schema(fields).serialize().to_pybytes()).decode(
+            "ascii"
+        ),
+        "n_rows": table.num_rows,
+        "n_chunks": table.columns[0].num_chunks if table.num_columns else 0,
+        "columns": columns,
+        "seconds": seconds,
+        "data": None,
+    }
+    if config.data and table.num_columns:
+        salt = np.random.default_rng().integers(0, 1 << 63, dtype=np.uint64)
+        data_table = pa.Table.from_arrays(
+            [
+                anonymize_array(column.chunks[0], salt)
+                for column in simple_table.columns
+            ],
+            schema=pa.schema(fields),
+        )
+        record["data"] = name + ".arrow"
+        with pa.OSFile(str(config.directory / record["data"]), "wb") as f:
+            with pa.ipc.new_file(f, data_table.schema) as writer:
+                writer.write_table(data_table)
+    path = config.directory / (name + ".json")
+    path.write_text(json.dumps(record, indent=2))
+    return path
+
+
+def render_arrow_v1(
+    table: pa.Table,
+    params: Dict[str, Any],
+    *,
+    preview: bool = False,
+    plan: Optional[RenderPlan] = None,
+    cancel: Optional[threading.Event] = None,
+    deadline: Optional[float] = None,
+    progress: Optional[Callable[[Progress], None]] = None,
+    profile: Optional[ProfileConfig] = None,
+    capture: Optional[CaptureConfig] = None,
+    **kwargs,
+) -> ArrowRenderResult:
+    """Group `table` according to `params`.
+
+    With `preview=True`, aggregate a sample of PREVIEW_SAMPLE_ROWS rows; scale
+    SIZE and SUM; and warn that the result is approximate. Other aggregations
+    are the sample's own (MIN and MAX, say, may be less extreme).
+
+    To follow a preview with the exact result, call `make_render_plan()` once
+    and pass its plan to both renders.
+
+    If `cancel` is set or `deadline` passes mid-render, return an empty table
+    with a "cancelled.error" or "deadline_exceeded.error" error. `progress` is
+    passed to `groupby()`.
+
+    With `profile` (or GROUPBY_PROFILE_DIR in the environment), sample the
+    render's stacks; if it's slower than `profile.threshold`, write them to
+    `profile.directory`. See `write_profile()`.
+
+    With `capture` (or GROUPBY_CAPTURE_DIR in the environment), record an
+    anonymized workload for `benchmarks/replay.py`. See `capture_workload()`.
+    """
+    if profile is None:
+        profile = profile_config_from_environ()
+    if capture is None:
+        capture = capture_config_from_environ()
+    if profile is None and capture is None:
+        return render_groupby(table, params, preview, plan, cancel, deadline, progress)
+
+    if profile is None:
+        sampling = contextlib.nullcontext()
+    else:
+        sampling = sample_stacks(profile.interval)
+    with sampling as counts:
+        start = time.perf_counter()
+        result = render_groupby(
+            table, params, preview, plan, cancel, deadline, progress
+        )
+        seconds = time.perf_counter() - start
+    if profile is not None and seconds >= profile.threshold:
+        write_profile(profile, counts, params, table, seconds)
+    if capture is not None:
+        # Gathering stats and hashing data take time: don't make users wait
+        CAPTURE_EXECUTOR.submit(capture_workload, capture, table, params, seconds)
+    return result
+
+
+def render_groupby(
+    table: pa.Table,
+    params: Dict[str, Any],
+    preview: bool,
+    plan: Optional[RenderPlan],
+    cancel: Optional[threading.Event],
+    deadline: Optional[float],
+    progress: Optional[Callable[[Progress], None]],
+) -> ArrowRenderResult:
+    """Do the work of `render_arrow_v1()`."""
+    if plan is None:
+        plan = make_render_plan(table, params)
+        if isinstance(plan, ArrowRenderResult):
+            return plan
+
+    try:
+        if preview and table.num_rows > PREVIEW_SAMPLE_ROWS:
+            result_table = groupby(
+                sample_table(table, PREVIEW_SAMPLE_ROWS),
+                plan.groups,
+                plan.aggregations,
+                cancel=cancel,
+                deadline=deadline,
+                progress=progress,
+            )
+            result_table = scale_estimates(
+                result_table, plan.aggregations, table.num_rows / PREVIEW_SAMPLE_ROWS
+            )
+            warning = RenderError(
+                i18n.trans(
+                    "preview.approximate",
+                    "Preview: these numbers are estimates from {n_sample_rows} of "
+                    "{n_rows} rows. The exact result is on its way.",
+                    {"n_sample_rows": PREVIEW_SAMPLE_ROWS, "n_rows": table.num_rows},
+                )
+            )
+            return ArrowRenderResult(result_table, errors=[warning, *plan.errors])
+
+        result_table = groupby(
+            table,
+            plan.groups,
+            plan.aggregations,
+            cancel=cancel,
+            deadline=deadline,
+            progress=progress,
+        )
+    except Cancelled as err:
+        return cancelled_result(err)
+    return ArrowRenderResult(result_table, errors=plan.errors)
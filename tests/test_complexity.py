@@ -0,0 +1,100 @@
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from groupby import Aggregation, Operation, aggregate_by_id, aggregate_sorted
+
+# Timing tests are slow, and a loaded machine can still skew them: run them
+# on purpose, with GROUPBY_COMPLEXITY_TESTS=1.
+pytestmark = pytest.mark.skipif(
+    os.environ.get("GROUPBY_COMPLEXITY_TESTS") != "1",
+    reason="set GROUPBY_COMPLEXITY_TESTS=1 to run timing tests",
+)
+
+# Kernels must scale with rows, not with groups. A kernel that loops over
+# groups in Python costs several microseconds per group; one that scatters
+# or uses `reduceat()` costs a small fraction of that.
+MAX_ROWS_EXPONENT = 1.4
+"""Fitted `time ~ rows ** exponent`: ~1 is linear; n*log(n) is a bit more."""
+
+MAX_SECONDS_PER_GROUP = 3e-6
+"""Fitted `time ~ a + b * groups` at fixed rows: the most `b` may be."""
+
+N_ROWS = 100_000
+N_GROUPS = 1_000
+
+
+def make_input(n_rows: int) -> pa.Table:
+    rng = np.random.default_rng(0)
+    return pa.table(
+        {
+            "v": pa.array(
+                rng.integers(0, 1000, n_rows) / 4, mask=rng.random(n_rows) < 0.1
+            ),
+            "t": pa.array(["a", "bb", "c", "dd", "e"]).take(
+                pa.array(rng.integers(0, 5, n_rows))
+            ),
+        }
+    )
+
+
+def make_aggregation(operation: Operation) -> Aggregation:
+    if operation == Operation.SIZE:
+        colname = ""
+    elif operation in {Operation.FIRST, Operation.MOST_FREQUENT}:
+        colname = "t"
+    else:
+        colname = "v"
+    percentile = 90.0 if operation == Operation.APPROX_PERCENTILE else None
+    return Aggregation(operation, colname, "X", percentile=percentile)
+
+
+def time_kernel(kernel: str, agg: Aggregation, n_rows: int, n_groups: int) -> float:
+    """Time `agg` on `n_rows` rows in `n_groups` groups; return the best of 5.
+
+    We measure CPU time, not wall time: other processes competing for the CPU
+    don't count against us.
+    """
+    table = make_input(n_rows)
+    group_ids = np.sort(np.arange(n_rows) % n_groups)  # sorted, as SORT needs
+    group_splits = np.flatnonzero(np.diff(group_ids)) + 1
+    if kernel == "sorted":
+        run = lambda: aggregate_sorted(agg, table, group_splits)
+    else:
+        run = lambda: aggregate_by_id(agg, table, group_ids, n_groups)
+    run()  # warm up
+    best = float("inf")
+    for _ in range(5):
+        start = time.process_time()
+        run()
+        best = np.minimum(best, time.process_time() - start)
+    return best
+
+
+KERNELS = [
+    *(("sorted", op) for op in Operation if op.has_sorted_kernel()),
+    *(("by_id", op) for op in Operation),
+]
+
+
+@pytest.mark.parametrize("kernel,operation", KERNELS)
+def test_kernel_is_linear_in_rows(kernel, operation):
+    agg = make_aggregation(operation)
+    rows = [25_000, 50_000, 100_000, 200_000]
+    seconds = [time_kernel(kernel, agg, n_rows, N_GROUPS) for n_rows in rows]
+    # Skip kernels too fast to measure (e.g., SIZE of sorted groups)
+    if seconds[-1] > 1e-3:
+        exponent = np.polyfit(np.log(rows), np.log(seconds), 1)[0]
+        assert exponent <= MAX_ROWS_EXPONENT
+
+
+@pytest.mark.parametrize("kernel,operation", KERNELS)
+def test_kernel_per_group_overhead(kernel, operation):
+    agg = make_aggregation(operation)
+    groups = [100, 1_000, 10_000, 100_000]
+    seconds = [time_kernel(kernel, agg, N_ROWS, n_groups) for n_groups in groups]
+    seconds_per_group = np.polyfit(groups, seconds, 1)[0]
+    assert seconds_per_group <= MAX_SECONDS_PER_GROUP
@@ -1,9 +1,53 @@
+import datetime
+import json
+import threading
+import time
 from datetime import datetime as dt
 
+import numpy as np
 import pyarrow as pa
+import pytest
 from cjwmodule.arrow.testing import assert_arrow_table_equals, make_column, make_table
 
-from groupby import Aggregation, DateGranularity, Group, Operation, groupby
+import groupby as groupby_module
+from groupby import (
+    MAX_DIRECT_SLOTS,
+    Aggregation,
+    Cancelled,
+    Comparison,
+    DateGranularity,
+    DeadlineExceeded,
+    Engine,
+    Group,
+    Having,
+    HyperLogLogPartial,
+    InputStats,
+    KeyStats,
+    MostFrequentPartial,
+    Operation,
+    Predicate,
+    Progress,
+    Stage,
+    TDigestPartial,
+    TopN,
+    WindowAggregation,
+    WindowOperation,
+    add_timing_sink,
+    choose_engine,
+    cube,
+    estimate_n_groups,
+    explain_groupby,
+    gather_input_stats,
+    groupby,
+    groupby_date_granularities,
+    groupby_pivot,
+    groupby_sliding_window,
+    groupby_window,
+    make_groupable_array,
+    make_sorting_table,
+    remove_timing_sink,
+    rollup,
+)
 
 
 def test_no_colnames():
@@ -671,3 +715,1188 @@ def test_zero_chunks_functions():
             make_column("sum", [0], pa.int64(), format="{:,.2f}"),
         ),
     )
+
+
+def test_direct_engine_matches_sort_engine():
+    table = make_table(
+        make_column("A", ["b", "a", None, "b", "a", "c"], dictionary=True),
+        make_column("B", [True, False, True, None, False, True]),
+        make_column("C", [3, -2, 3, 3, 5, 3], pa.int8()),
+        make_column("D", [1.5, None, 2.0, 4.0, -1.0, 0.5]),
+        make_column("E", [1, 2, 3, 4, 5, None], pa.uint64()),
+    )
+    groups = [Group("A", None), Group("B", None), Group("C", None)]
+    aggregations = [
+        Aggregation(Operation.SIZE, "", "size"),
+        Aggregation(Operation.SUM, "D", "sum"),
+        Aggregation(Operation.MEAN, "E", "mean"),
+        Aggregation(Operation.MIN, "D", "min"),
+        Aggregation(Operation.MAX, "E", "max"),
+    ]
+    assert_arrow_table_equals(
+        groupby(table, groups, aggregations, engine=Engine.DIRECT),
+        groupby(table, groups, aggregations, engine=Engine.SORT),
+    )
+
+
+def test_direct_engine_output_is_sorted():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", ["z", "y", "x", "y"], dictionary=True),
+                make_column("B", [2, 1, 2, 2]),
+            ),
+            [Group("A", None)],
+            [Aggregation(Operation.SUM, "B", "X")],
+            engine=Engine.DIRECT,
+        ),
+        make_table(
+            make_column("A", ["x", "y", "z"]),
+            make_column("X", [2, 3, 2]),
+        ),
+    )
+
+
+def test_direct_engine_sum_int64_is_exact():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", [1, 1]),
+                make_column("B", [2**53, 1]),
+            ),
+            [Group("A", None)],
+            [Aggregation(Operation.SUM, "B", "X")],
+            engine=Engine.DIRECT,
+        ),
+        make_table(make_column("A", [1]), make_column("X", [2**53 + 1])),
+    )
+
+
+def test_direct_engine_all_null_keys():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(make_column("A", [None, None], pa.int32())),
+            [Group("A", None)],
+            [Aggregation(Operation.SIZE, "", "size")],
+            engine=Engine.DIRECT,
+        ),
+        make_table(
+            make_column("A", [], pa.int32()),
+            make_column("size", [], pa.int64(), format="{:,d}"),
+        ),
+    )
+
+
+def test_direct_engine_refuses_wide_integer_range():
+    with pytest.raises(ValueError):
+        groupby(
+            make_table(make_column("A", [0, MAX_DIRECT_SLOTS])),
+            [Group("A", None)],
+            [Aggregation(Operation.SIZE, "", "size")],
+            engine=Engine.DIRECT,
+        )
+
+
+def test_direct_engine_text_min_max():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", [1, 2, 1, 1]),
+                make_column("B", ["b", "c", None, "a"]),
+                make_column("C", ["y", "x", "z", None], dictionary=True),
+            ),
+            [Group("A", None)],
+            [
+                Aggregation(Operation.MIN, "B", "min"),
+                Aggregation(Operation.MAX, "C", "max"),
+            ],
+            engine=Engine.DIRECT,
+        ),
+        make_table(
+            make_column("A", [1, 2]),
+            make_column("min", ["a", "c"]),
+            make_column("max", ["z", "x"], dictionary=True),
+        ),
+    )
+
+
+def test_group_id_engine_matches_sort_engine():
+    table = make_table(
+        make_column("A", ["b", "a", None, "b", "a", "c", "a"]),
+        make_column("B", [1.5, 2.5, 1.5, 1.5, 2.5, 1.5, -3.0]),
+        make_column("C", [3, None, 3, 3, 5, 3, 4], pa.int16(), format="{:d}"),
+        make_column("D", ["x", None, "y", "x", "z", "y", "w"], dictionary=True),
+        make_column(
+            "E",
+            [
+                dt(2021, 1, 1),
+                None,
+                dt(2020, 1, 1),
+                dt(2019, 1, 1),
+                dt(2022, 1, 1),
+                None,
+                dt(2018, 1, 1),
+            ],
+        ),
+    )
+    groups = [Group("A", None), Group("B", None)]
+    aggregations = [
+        Aggregation(Operation.SIZE, "", "size"),
+        Aggregation(Operation.NUNIQUE, "D", "nunique"),
+        Aggregation(Operation.SUM, "C", "sum"),
+        Aggregation(Operation.MEAN, "C", "mean"),
+        Aggregation(Operation.MEDIAN, "C", "median"),
+        Aggregation(Operation.MIN, "E", "min"),
+        Aggregation(Operation.MAX, "D", "max"),
+        Aggregation(Operation.FIRST, "D", "first"),
+        Aggregation(Operation.FIRST, "E", "first-timestamp"),
+    ]
+    assert_arrow_table_equals(
+        groupby(table, groups, aggregations, engine=Engine.GROUP_ID),
+        groupby(table, groups, aggregations, engine=Engine.SORT),
+    )
+
+
+def test_group_id_engine_median_even_and_odd():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", ["a", "b", "a", "b", "a", "b", "b", "b"]),
+                make_column("B", [5, 1, 3, 4, 1, 3, None, 8]),
+            ),
+            [Group("A", None)],
+            [Aggregation(Operation.MEDIAN, "B", "median")],
+            engine=Engine.GROUP_ID,
+        ),
+        make_table(
+            make_column("A", ["a", "b"]),
+            make_column("median", [3.0, 3.5]),
+        ),
+    )
+
+
+def test_group_id_engine_sum_int64_is_exact():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", ["a", "a", "b"]),
+                make_column("B", [2**62, -(2**62) + 1, 2**53]),
+            ),
+            [Group("A", None)],
+            [Aggregation(Operation.SUM, "B", "sum")],
+            engine=Engine.GROUP_ID,
+        ),
+        make_table(make_column("A", ["a", "b"]), make_column("sum", [1, 2**53])),
+    )
+
+
+def test_aggregate_timestamp_before_1970_by_month_DEPRECATED():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", [dt(1969, 12, 31, 23), None, dt(1969, 12, 1)]),
+            ),
+            [Group("A", DateGranularity.MONTH)],
+            [Aggregation(Operation.SIZE, "", "size")],
+        ),
+        make_table(
+            make_column("A", [dt(1969, 12, 1)]),
+            make_column("size", [2], format="{:,d}"),
+        ),
+    )
+
+
+def test_make_groupable_array_sliced_with_nulls():
+    array = pa.array(
+        [dt(2018, 1, 1), None, dt(2018, 3, 4, 5), None, dt(1960, 5, 6)] * 3,
+        pa.timestamp("ns"),
+    ).slice(5)
+    assert (
+        make_groupable_array(array, DateGranularity.YEAR).to_pylist()
+        == [
+            dt(2018, 1, 1),
+            None,
+            dt(2018, 1, 1),
+            None,
+            dt(1960, 1, 1),
+        ]
+        * 2
+    )
+    assert make_groupable_array(array.slice(3), DateGranularity.DAY).to_pylist() == [
+        None,
+        dt(1960, 5, 6),
+        dt(2018, 1, 1),
+        None,
+        dt(2018, 3, 4),
+        None,
+        dt(1960, 5, 6),
+    ]
+
+
+def test_groupby_date_granularities_matches_groupby():
+    table = make_table(
+        make_column(
+            "A",
+            [
+                dt(2021, 3, 31, 23, 59),
+                dt(2021, 4, 1),
+                None,
+                dt(2021, 3, 29, 1),
+                dt(2020, 12, 31, 12),
+                dt(2021, 1, 3),
+                dt(2021, 4, 1, 6),
+            ],
+        ),
+        make_column("B", ["x", "y", "x", "x", "y", "x", "y"], dictionary=True),
+        make_column("C", [3, None, 3, 1, 5, 2, 4], pa.int16(), format="{:d}"),
+        make_column("D", ["p", "q", None, "r", "p", "s", None]),
+    )
+    groups = [Group("A", DateGranularity.DAY), Group("B", None)]
+    aggregations = [
+        Aggregation(Operation.SIZE, "", "size"),
+        Aggregation(Operation.NUNIQUE, "D", "nunique"),
+        Aggregation(Operation.SUM, "C", "sum"),
+        Aggregation(Operation.MEAN, "C", "mean"),
+        Aggregation(Operation.MEDIAN, "C", "median"),
+        Aggregation(Operation.MIN, "D", "min"),
+        Aggregation(Operation.MAX, "C", "max"),
+        Aggregation(Operation.FIRST, "D", "first"),
+        Aggregation(Operation.FIRST, "B", "first-category"),
+    ]
+    granularities = [
+        DateGranularity.YEAR,
+        DateGranularity.DAY,
+        DateGranularity.WEEK,
+        DateGranularity.MONTH,
+        DateGranularity.QUARTER,
+    ]
+    results = groupby_date_granularities(table, groups, aggregations, granularities)
+    assert len(results) == len(granularities)
+    for granularity, result in zip(granularities, results):
+        assert_arrow_table_equals(
+            result,
+            groupby(
+                table,
+                [Group("A", granularity), Group("B", None)],
+                aggregations,
+                engine=Engine.SORT,
+            ),
+        )
+
+
+def test_groupby_date_granularities_zero_rows():
+    table = make_table(
+        make_column("A", [], pa.timestamp("ns")), make_column("B", [], pa.int32())
+    )
+    groups = [Group("A", DateGranularity.DAY)]
+    aggregations = [Aggregation(Operation.SUM, "B", "sum")]
+    for granularity, result in zip(
+        [DateGranularity.HOUR, DateGranularity.YEAR],
+        groupby_date_granularities(
+            table, groups, aggregations, [DateGranularity.HOUR, DateGranularity.YEAR]
+        ),
+    ):
+        assert_arrow_table_equals(
+            result, groupby(table, [Group("A", granularity)], aggregations)
+        )
+
+
+def test_groupby_date_granularities_no_granularities():
+    assert (
+        groupby_date_granularities(
+            make_table(make_column("A", [1])), [Group("A", None)], [], []
+        )
+        == []
+    )
+
+
+def test_grouping_sets_rollup():
+    table = make_table(
+        make_column("A", ["a", "a", "b", "a", None]),
+        make_column("B", ["x", "y", "x", "x", "y"], dictionary=True),
+        make_column("C", [1, 2, 3, 4, 5]),
+    )
+    groups = [Group("A", None), Group("B", None)]
+    assert_arrow_table_equals(
+        groupby(
+            table,
+            groups,
+            [
+                Aggregation(Operation.SUM, "C", "sum"),
+                Aggregation(Operation.FIRST, "B", "first"),
+            ],
+            grouping_sets=rollup(groups),
+        ),
+        make_table(
+            make_column("A", ["a", "a", "b", "a", "b", None]),
+            make_column("B", ["x", "y", "x", None, None, None], dictionary=True),
+            make_column("sum", [5, 2, 3, 7, 3, 15]),
+            make_column("first", ["x", "y", "x", "x", "x", "x"], dictionary=True),
+        ),
+    )
+
+
+def test_grouping_sets_cube_matches_groupby():
+    table = make_table(
+        make_column("A", ["a", "a", "b", "a", None, "b"]),
+        make_column("B", [1, 2, 1, 1, 2, None]),
+        make_column(
+            "C",
+            [
+                dt(2021, 1, 2),
+                dt(2021, 1, 3),
+                None,
+                dt(2020, 1, 2),
+                dt(2021, 4, 5),
+                dt(2019, 1, 1),
+            ],
+        ),
+    )
+    groups = [Group("A", None), Group("B", None), Group("C", DateGranularity.YEAR)]
+    aggregations = [
+        Aggregation(Operation.SIZE, "", "size"),
+        Aggregation(Operation.MEDIAN, "B", "median"),
+        Aggregation(Operation.MIN, "A", "min"),
+    ]
+    result = groupby(table, groups, aggregations, grouping_sets=cube(groups))
+    offset = 0
+    for grouping_set in cube(groups):
+        expected = groupby(table, grouping_set, aggregations)
+        block = result.slice(offset, expected.num_rows)
+        offset += expected.num_rows
+        assert_arrow_table_equals(block.select(expected.column_names), expected)
+        for colname in result.column_names:
+            if colname not in expected.column_names:
+                assert block[colname].null_count == expected.num_rows
+    assert offset == result.num_rows
+
+
+def test_grouping_sets_must_be_subsets_of_groups():
+    with pytest.raises(ValueError):
+        groupby(
+            make_table(make_column("A", [1]), make_column("B", [1])),
+            [Group("A", None)],
+            [],
+            grouping_sets=[[Group("B", None)]],
+        )
+
+
+def test_pivot():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", ["a", "a", "b", "c", None, "a"]),
+                make_column("B", ["x", "y", "x", None, "y", "x"], dictionary=True),
+                make_column("C", [1, 2, 3, 4, 5, 6], format="{:d}"),
+            ),
+            [Group("A", None)],
+            [Aggregation(Operation.SUM, "C", "sum")],
+            pivot=Group("B", None),
+        ),
+        make_table(
+            make_column("A", ["a", "b"]),
+            make_column("x", [7, 3], format="{:d}"),
+            make_column("y", [2, None], format="{:d}"),
+        ),
+    )
+
+
+def test_pivot_sorts_once():
+    table = make_table(
+        make_column("A", ["a", "a", "b", "c", None, "a"]),
+        make_column("B", ["x", "y", "x", None, "y", "x"]),
+        make_column("C", [1, 2, 3, 4, 5, 6]),
+    )
+    timings = []
+    add_timing_sink(timings.append)
+    try:
+        groupby(
+            table,
+            [Group("A", None)],
+            [Aggregation(Operation.SUM, "C", "sum")],
+            pivot=Group("B", None),
+            engine=Engine.SORT,
+        )
+    finally:
+        remove_timing_sink(timings.append)
+    # The (groups, pivot) groupby sorts; reshaping its sorted output doesn't
+    assert [t.stage for t in timings].count(Stage.SORT) == 1
+
+
+def test_pivot_several_aggregations_by_date():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", [1, 2, 1]),
+                make_column("B", [dt(2021, 1, 2), dt(2021, 1, 3), dt(2022, 3, 4)]),
+            ),
+            [Group("A", None)],
+            [
+                Aggregation(Operation.SIZE, "", "size"),
+                Aggregation(Operation.MAX, "B", "max"),
+            ],
+            pivot=Group("B", DateGranularity.YEAR),
+        ),
+        make_table(
+            make_column("A", [1, 2]),
+            make_column("size 2021-01-01T00:00:00", [1, 1], format="{:,d}"),
+            make_column("size 2022-01-01T00:00:00", [1, None], format="{:,d}"),
+            make_column("max 2021-01-01T00:00:00", [dt(2021, 1, 2), dt(2021, 1, 3)]),
+            make_column("max 2022-01-01T00:00:00", [dt(2022, 3, 4), None]),
+        ),
+    )
+
+
+def test_pivot_too_many_columns():
+    with pytest.raises(ValueError, match="Pivot would create 4 columns"):
+        groupby_pivot(
+            make_table(make_column("A", [1, 2]), make_column("B", [1, 2])),
+            [Group("A", None)],
+            Group("B", None),
+            [
+                Aggregation(Operation.SIZE, "", "size"),
+                Aggregation(Operation.SUM, "A", "sum"),
+            ],
+            max_columns=3,
+        )
+
+
+def test_transform():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", ["a", "b", None, "a"]),
+                make_column("B", [1, 2, 3, 4], format="{:d}"),
+                make_column("C", ["x", "y", "z", "w"], dictionary=True),
+            ),
+            [Group("A", None)],
+            [
+                Aggregation(Operation.SUM, "B", "sum"),
+                Aggregation(Operation.MEAN, "B", "mean"),
+                Aggregation(Operation.FIRST, "C", "C"),
+            ],
+            transform=True,
+        ),
+        make_table(
+            make_column("A", ["a", "b", None, "a"]),
+            make_column("B", [1, 2, 3, 4], format="{:d}"),
+            make_column("sum", [5, 2, None, 5], format="{:d}"),
+            make_column("mean", [2.5, 2.0, None, 2.5], format="{:,}"),
+            make_column("C", ["x", "y", None, "x"], dictionary=True),
+        ),
+    )
+
+
+def test_transform_zero_rows():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(make_column("A", [], pa.utf8())),
+            [Group("A", None)],
+            [Aggregation(Operation.SIZE, "", "size")],
+            transform=True,
+        ),
+        make_table(
+            make_column("A", [], pa.utf8()),
+            make_column("size", [], pa.int64(), format="{:,d}"),
+        ),
+    )
+
+
+def test_window():
+    assert_arrow_table_equals(
+        groupby_window(
+            make_table(
+                make_column("A", ["a", "b", "a", None, "a", "b"]),
+                make_column("B", [1, 2, None, 4, 5, 6], format="{:d}"),
+                make_column("C", [1.5, None, 2.5, 1.0, 1.0, 1.0]),
+                make_column("D", ["q", "b", None, "z", "a", "c"], dictionary=True),
+            ),
+            [Group("A", None)],
+            [
+                WindowAggregation(WindowOperation.ROW_NUMBER, "", "row"),
+                WindowAggregation(WindowOperation.CUMCOUNT, "B", "count"),
+                WindowAggregation(WindowOperation.CUMSUM, "B", "sum"),
+                WindowAggregation(WindowOperation.CUMSUM, "C", "float-sum"),
+                WindowAggregation(WindowOperation.CUMMIN, "C", "min"),
+                WindowAggregation(WindowOperation.CUMMAX, "D", "max"),
+            ],
+        ),
+        make_table(
+            make_column("A", ["a", "b", "a", None, "a", "b"]),
+            make_column("B", [1, 2, None, 4, 5, 6], format="{:d}"),
+            make_column("C", [1.5, None, 2.5, 1.0, 1.0, 1.0]),
+            make_column("D", ["q", "b", None, "z", "a", "c"], dictionary=True),
+            make_column("row", [1, 1, 2, None, 3, 2], format="{:,d}"),
+            make_column("count", [1, 1, 1, None, 2, 2], format="{:,d}"),
+            make_column("sum", [1, 2, None, None, 6, 8], format="{:d}"),
+            make_column("float-sum", [1.5, None, 4.0, None, 5.0, 1.0]),
+            make_column("min", [1.5, None, 1.5, None, 1.0, 1.0]),
+            make_column("max", ["q", "b", None, None, "q", "c"], dictionary=True),
+        ),
+    )
+
+
+def test_window_no_groups_timestamp():
+    assert_arrow_table_equals(
+        groupby_window(
+            make_table(
+                make_column("A", [dt(2021, 1, 2), None, dt(2020, 1, 1), dt(2022, 1, 1)])
+            ),
+            [],
+            [WindowAggregation(WindowOperation.CUMMIN, "A", "min")],
+        ),
+        make_table(
+            make_column("A", [dt(2021, 1, 2), None, dt(2020, 1, 1), dt(2022, 1, 1)]),
+            make_column("min", [dt(2021, 1, 2), None, dt(2020, 1, 1), dt(2020, 1, 1)]),
+        ),
+    )
+
+
+def test_sliding_window():
+    assert_arrow_table_equals(
+        groupby_sliding_window(
+            make_table(
+                make_column("A", ["a", "a", "b", "a", None, "a"]),
+                make_column(
+                    "T",
+                    [
+                        dt(2021, 1, 8),
+                        dt(2021, 1, 1),
+                        dt(2021, 1, 2),
+                        dt(2021, 1, 7, 23),
+                        dt(2021, 1, 3),
+                        None,
+                    ],
+                ),
+                make_column("B", [1, 2, 3, None, 5, 6], format="{:d}"),
+            ),
+            [Group("A", None)],
+            "T",
+            datetime.timedelta(days=7),
+            [
+                Aggregation(Operation.SIZE, "", "size"),
+                Aggregation(Operation.SUM, "B", "sum"),
+                Aggregation(Operation.MEAN, "B", "mean"),
+            ],
+        ),
+        make_table(
+            make_column("A", ["a", "a", "b", "a", None, "a"]),
+            make_column(
+                "T",
+                [
+                    dt(2021, 1, 8),
+                    dt(2021, 1, 1),
+                    dt(2021, 1, 2),
+                    dt(2021, 1, 7, 23),
+                    dt(2021, 1, 3),
+                    None,
+                ],
+            ),
+            make_column("B", [1, 2, 3, None, 5, 6], format="{:d}"),
+            make_column("size", [2, 1, 1, 2, None, None], format="{:,d}"),
+            make_column("sum", [1, 2, 3, 2, None, None], format="{:d}"),
+            make_column("mean", [1.0, 2.0, 3.0, 2.0, None, None], format="{:,}"),
+        ),
+    )
+
+
+def test_sliding_window_date():
+    result = groupby_sliding_window(
+        make_table(
+            make_column(
+                "T",
+                [datetime.date(2021, 1, 1), datetime.date(2021, 1, 2)],
+                pa.date32(),
+            ),
+            make_column("B", [1.5, 2.0]),
+        ),
+        [],
+        "T",
+        datetime.timedelta(days=2),
+        [Aggregation(Operation.SUM, "B", "sum")],
+    )
+    assert result["sum"].to_pylist() == [1.5, 3.5]
+
+
+def test_sliding_window_float_sums_restart_per_group():
+    # A global prefix sum would lose group "b"'s small values to group "a"
+    result = groupby_sliding_window(
+        make_table(
+            make_column("A", ["a", "a", "b", "b"]),
+            make_column("T", [dt(2021, 1, 1), dt(2021, 1, 2)] * 2),
+            make_column("B", [1e17, 1e17, 0.1, 0.2]),
+        ),
+        [Group("A", None)],
+        "T",
+        datetime.timedelta(days=7),
+        [
+            Aggregation(Operation.SUM, "B", "sum"),
+            Aggregation(Operation.MEAN, "B", "mean"),
+        ],
+    )
+    assert result["sum"].to_pylist() == [1e17, 2e17, 0.1, 0.1 + 0.2]
+    assert result["mean"].to_pylist() == [1e17, 1e17, 0.1, (0.1 + 0.2) / 2]
+
+
+def test_sliding_window_refuses_median():
+    with pytest.raises(ValueError, match="cannot compute MEDIAN"):
+        groupby_sliding_window(
+            make_table(make_column("T", [dt(2021, 1, 1)])),
+            [],
+            "T",
+            datetime.timedelta(days=1),
+            [Aggregation(Operation.MEDIAN, "T", "median")],
+        )
+
+
+@pytest.mark.parametrize("engine", [Engine.DIRECT, Engine.GROUP_ID, Engine.SORT])
+def test_having(engine):
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", [1, 2, 1, 3, 1, 2]),
+                make_column("B", [1.0, 2.0, 3.0, 4.0, None, 6.0]),
+            ),
+            [Group("A", None)],
+            [
+                Aggregation(Operation.SIZE, "", "size"),
+                Aggregation(Operation.MEAN, "B", "mean"),
+                Aggregation(Operation.MEDIAN, "B", "median"),
+            ],
+            engine=engine,
+            having=Having("size", Comparison.GE, 2),
+        ),
+        make_table(
+            make_column("A", [1, 2]),
+            make_column("size", [3, 2], format="{:,d}"),
+            make_column("mean", [2.0, 4.0]),
+            make_column("median", [2.0, 4.0]),
+        ),
+    )
+
+
+def test_having_text_and_no_survivors():
+    table = make_table(
+        make_column("A", ["a", "b", "a"]),
+        make_column("B", ["x", "y", "z"], dictionary=True),
+    )
+    assert_arrow_table_equals(
+        groupby(
+            table,
+            [Group("A", None)],
+            [Aggregation(Operation.MIN, "B", "min")],
+            having=Having("min", Comparison.NE, "x"),
+        ),
+        make_table(make_column("A", ["b"]), make_column("min", ["y"], dictionary=True)),
+    )
+    assert_arrow_table_equals(
+        groupby(
+            table,
+            [Group("A", None)],
+            [Aggregation(Operation.SIZE, "", "size")],
+            having=Having("size", Comparison.GT, 2.5),
+        ),
+        make_table(
+            make_column("A", [], pa.utf8()),
+            make_column("size", [], pa.int64(), format="{:,d}"),
+        ),
+    )
+
+
+@pytest.mark.parametrize("engine", [Engine.DIRECT, Engine.GROUP_ID, Engine.SORT])
+def test_top_n(engine):
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", [1, 2, 3, 4, 5, 2, 6]),
+                make_column("B", [5, 1, 7, None, 5, 1, 1]),
+                make_column("C", ["a", "b", "c", "d", "e", "f", "g"]),
+            ),
+            [Group("A", None)],
+            [
+                Aggregation(Operation.FIRST, "C", "first"),
+                Aggregation(Operation.MAX, "B", "max"),
+            ],
+            engine=engine,
+            top_n=TopN("max", 3),
+        ),
+        make_table(
+            make_column("A", [3, 1, 5]),
+            make_column("first", ["c", "a", "e"]),
+            make_column("max", [7, 5, 5]),
+        ),
+    )
+
+
+def test_top_n_ascending_nulls_last():
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", ["a", "b", "c", "d"]),
+                make_column("B", [None, "y", None, "x"], dictionary=True),
+            ),
+            [Group("A", None)],
+            [Aggregation(Operation.MIN, "B", "min")],
+            top_n=TopN("min", 3, descending=False),
+        ),
+        make_table(
+            make_column("A", ["d", "b", "a"]),
+            make_column("min", ["x", "y", None], dictionary=True),
+        ),
+    )
+
+
+@pytest.mark.parametrize("engine", [Engine.DIRECT, Engine.GROUP_ID, Engine.SORT])
+def test_conditional_aggregations(engine):
+    paid = Predicate("status", Comparison.EQ, "paid")
+    assert_arrow_table_equals(
+        groupby(
+            make_table(
+                make_column("A", [1, 1, 2, 1, 2, 3]),
+                make_column(
+                    "status",
+                    ["paid", "refunded", "paid", "paid", None, "refunded"],
+                    dictionary=True,
+                ),
+                make_column("amount", [1, 2, 4, 8, 16, 32], format="{:d}"),
+            ),
+            [Group("A", None)],
+            [
+                Aggregation(Operation.SIZE, "", "paid", paid),
+                Aggregation(Operation.SUM, "amount", "paid-amount", paid),
+                Aggregation(
+                    Operation.SUM,
+                    "amount",
+                    "refunded-amount",
+                    Predicate("status", Comparison.EQ, "refunded"),
+                ),
+                Aggregation(
+                    Operation.MEAN,
+                    "amount",
+                    "big-mean",
+                    Predicate("amount", Comparison.GE, 4),
+                ),
+            ],
+            engine=engine,
+        ),
+        make_table(
+            make_column("A", [1, 2, 3]),
+            make_column("paid", [2, 1, 0], format="{:,d}"),
+            make_column("paid-amount", [9, 4, 0], format="{:d}"),
+            make_column("refunded-amount", [2, 0, 32], format="{:d}"),
+            make_column("big-mean", [8.0, 10.0, 32.0], format="{:,}"),
+        ),
+    )
+
+
+@pytest.mark.parametrize("engine", [Engine.GROUP_ID, Engine.SORT])
+def test_approx_nunique_small_groups(engine):
+    table = make_table(
+        make_column("A", [1, 1, 1, 2, 2, 3]),
+        make_column("B", ["x", "y", "x", "", None, None]),
+        make_column("C", ["x", "y", "x", "", None, None], dictionary=True),
+        make_column("D", [1.0, -0.0, 0.0, 2.5, None, 3.0]),
+        make_column(
+            "E", [dt(2021, 1, 1), dt(2021, 1, 1), None, dt(2020, 1, 1), None, None]
+        ),
+    )
+    assert_arrow_table_equals(
+        groupby(
+            table,
+            [Group("A", None)],
+            [
+                Aggregation(Operation.APPROX_NUNIQUE, colname, colname)
+                for colname in "BCDE"
+            ],
+            engine=engine,
+        ),
+        make_table(
+            make_column("A", [1, 2, 3]),
+            make_column("B", [2, 1, 0], format="{:,d}"),
+            make_column("C", [2, 1, 0], format="{:,d}"),
+            make_column("D", [2, 1, 1], format="{:,d}"),
+            make_column("E", [1, 1, 0], format="{:,d}"),
+        ),
+    )
+
+
+def test_approx_nunique_large_and_mergeable():
+    values = pa.array([str(i) for i in range(200000)] * 2)
+    group_ids = np.zeros(len(values), np.int64)
+    whole = HyperLogLogPartial.start(values, group_ids, 1)
+    estimate = whole.finish()[0].as_py()
+    assert abs(estimate - 200000) < 200000 * 0.03
+    first_half = HyperLogLogPartial.start(values[:250000], group_ids[:250000], 1)
+    second_half = HyperLogLogPartial.start(values[250000:], group_ids[250000:], 1)
+    assert first_half.union(second_half).finish()[0].as_py() == estimate
+
+
+@pytest.mark.parametrize("engine", [Engine.GROUP_ID, Engine.SORT])
+def test_approx_median_small_groups_are_exact(engine):
+    table = make_table(
+        make_column("A", [1, 1, 1, 1, 2, 3]),
+        make_column("B", [1, 2, 3, 10, None, 5], format="{:d}"),
+    )
+    assert_arrow_table_equals(
+        groupby(
+            table,
+            [Group("A", None)],
+            [
+                Aggregation(Operation.APPROX_MEDIAN, "B", "median"),
+                Aggregation(Operation.APPROX_PERCENTILE, "B", "p0", percentile=0),
+                Aggregation(Operation.APPROX_PERCENTILE, "B", "p100", percentile=100),
+            ],
+            engine=engine,
+        ),
+        make_table(
+            make_column("A", [1, 2, 3]),
+            make_column("median", [2.5, None, 5.0], format="{:,}"),
+            make_column("p0", [1.0, None, 5.0], format="{:,}"),
+            make_column("p100", [10.0, None, 5.0], format="{:,}"),
+        ),
+    )
+
+
+def test_approx_percentile_requires_percentile():
+    with pytest.raises(ValueError, match="percentile"):
+        groupby(
+            make_table(make_column("A", [1]), make_column("B", [1])),
+            [Group("A", None)],
+            [Aggregation(Operation.APPROX_PERCENTILE, "B", "X")],
+        )
+
+
+def test_approx_percentile_large_and_mergeable():
+    values = pa.array(np.random.default_rng(0).lognormal(size=400000))
+    group_ids = np.zeros(len(values), np.int64)
+    whole = TDigestPartial.start(values, group_ids, 1, 0.99)
+    exact = np.quantile(values.to_numpy(), 0.99)
+    assert abs(whole.finish()[0].as_py() - exact) < exact * 0.02
+    first_half = TDigestPartial.start(values[:250000], group_ids[:250000], 1, 0.99)
+    second_half = TDigestPartial.start(values[250000:], group_ids[250000:], 1, 0.99)
+    unioned = first_half.union(second_half)
+    assert len(unioned.means) <= 200
+    assert abs(unioned.finish()[0].as_py() - exact) < exact * 0.02
+
+
+def test_approx_median_rollup():
+    result = groupby(
+        make_table(make_column("A", ["a", "a", "b"]), make_column("B", [1, 2, 6])),
+        [Group("A", None)],
+        [Aggregation(Operation.APPROX_MEDIAN, "B", "X")],
+        grouping_sets=rollup([Group("A", None)]),
+    )
+    assert result["X"].to_pylist() == [1.5, 6.0, 2.0]
+
+
+@pytest.mark.parametrize("engine", [Engine.GROUP_ID, Engine.SORT])
+def test_most_frequent(engine):
+    values = ["x", "y", "y", "x", None, None, "z", "w", "w"]
+    table = make_table(
+        make_column("A", [1, 1, 1, 1, 2, 2, 3, 3, 3]),
+        make_column("B", values),
+        make_column("C", values, dictionary=True),
+        make_column("D", [1, 2, 2, 1, None, None, 3, 4, 4], format="{:d}"),
+    )
+    assert_arrow_table_equals(
+        groupby(
+            table,
+            [Group("A", None)],
+            [
+                Aggregation(Operation.MOST_FREQUENT, colname, colname)
+                for colname in "BCD"
+            ],
+            engine=engine,
+        ),
+        make_table(
+            make_column("A", [1, 2, 3]),
+            make_column("B", ["x", None, "w"]),  # tie: first value wins
+            make_column("C", ["x", None, "w"], dictionary=True),
+            make_column("D", [1, None, 4], format="{:d}"),
+        ),
+    )
+
+
+def test_most_frequent_sketch_keeps_heavy_hitters(monkeypatch):
+    monkeypatch.setattr(groupby_module, "MOST_FREQUENT_COUNTERS", 4)
+    monkeypatch.setattr(groupby_module, "MOST_FREQUENT_BATCH_SIZE", 10)
+    values = pa.array([str(i) if i % 3 else "hot" for i in range(100)])
+    group_ids = np.array([0, 1] * 50)
+    partial = MostFrequentPartial.start(values, group_ids, 2)
+    assert len(partial.ids) <= 8
+    assert partial.finish().to_pylist() == ["hot", "hot"]
+    merged = partial.merge(np.array([0, 0]), 1)
+    assert len(merged.ids) <= 4
+    assert merged.finish().to_pylist() == ["hot"]
+
+
+def test_most_frequent_dictionary_is_exact():
+    rng = np.random.default_rng(0)
+    codes = rng.integers(0, 5, 1000)
+    group_ids = rng.integers(-1, 20, 1000)  # -1: not in a group
+    values = pa.DictionaryArray.from_arrays(
+        pa.array(codes.astype(np.int32)), pa.array(list("abcde"))
+    )
+    expected = []
+    for group_id in range(20):
+        rows = np.flatnonzero(group_ids == group_id)
+        counts = np.bincount(codes[rows], minlength=5)
+        # Most frequent; ties go to the value whose first row comes first
+        best = [code for code in codes[rows] if counts[code] == counts.max()][0]
+        expected.append("abcde"[best])
+    partial = MostFrequentPartial.start(values, group_ids, 20)
+    assert partial.finish().dictionary_decode().to_pylist() == expected
+
+
+def test_most_frequent_rollup():
+    result = groupby(
+        make_table(
+            make_column("A", ["a", "a", "b", "b", "b", "b"]),
+            make_column("B", ["x", "x", "y", "y", "y", "z"]),
+        ),
+        [Group("A", None)],
+        [Aggregation(Operation.MOST_FREQUENT, "B", "X")],
+        grouping_sets=rollup([Group("A", None)]),
+    )
+    assert result["X"].to_pylist() == ["x", "y", "y"]
+
+
+@pytest.mark.parametrize("engine", [Engine.GROUP_ID, Engine.SORT, Engine.DIRECT])
+def test_cancel(engine):
+    table = make_table(make_column("A", [1, 2, 1]), make_column("B", [1, 2, 3]))
+    cancel = threading.Event()
+    args = ([Group("A", None)], [Aggregation(Operation.SUM, "B", "X")])
+    assert groupby(table, *args, engine=engine, cancel=cancel).num_rows == 2
+    cancel.set()
+    with pytest.raises(Cancelled, match="after sorting_table"):
+        groupby(table, *args, engine=engine, cancel=cancel)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{}, {"transform": True}, {"pivot": Group("B", None)}, {"grouping_sets": [[]]}],
+)
+def test_deadline(kwargs):
+    table = make_table(make_column("A", [1, 2, 1]), make_column("B", [1, 2, 3]))
+    with pytest.raises(DeadlineExceeded):
+        groupby(
+            table,
+            [Group("A", None)],
+            [Aggregation(Operation.SIZE, "", "X")],
+            deadline=time.monotonic() - 1,
+            **kwargs,
+        )
+
+
+def test_progress():
+    table = make_table(make_column("A", ["x", "y", "x"]), make_column("B", [1, 2, 3]))
+    reports = []
+    groupby(
+        table,
+        [Group("A", None)],
+        [Aggregation(Operation.SUM, "B", "X"), Aggregation(Operation.SIZE, "", "Y")],
+        engine=Engine.GROUP_ID,
+        progress=reports.append,
+    )
+    assert reports == [
+        Progress(Stage.SORTING_TABLE, 3, 0, 2),
+        Progress(
+            Stage.PLAN,
+            3,
+            0,
+            2,
+            {"engine": "group_id", "planned": False, "estimated_n_groups": None},
+        ),
+        Progress(Stage.SORT, 3, 0, 2),
+        Progress(Stage.NULL_FILTER, 3, 0, 2, {"n_rows_dropped": 0}),
+        Progress(Stage.DEDUP, 3, 0, 2, {"n_groups": 2}),
+        Progress(Stage.AGGREGATE, 3, 1, 2, {"outname": "X"}),
+        Progress(Stage.AGGREGATE, 3, 2, 2, {"outname": "Y"}),
+    ]
+
+
+def test_timing_sinks():
+    table = make_table(make_column("A", ["x", "y", "x"]), make_column("B", [1, 2, 3]))
+    timings = []
+    add_timing_sink(timings.append)
+    try:
+        groupby(
+            table,
+            [Group("A", None)],
+            [Aggregation(Operation.SUM, "B", "X")],
+            engine=Engine.SORT,
+        )
+    finally:
+        remove_timing_sink(timings.append)
+    assert [(t.stage, t.details) for t in timings] == [
+        (Stage.ONE_CHUNK, None),
+        (Stage.SORTING_TABLE, None),
+        (Stage.SORT, None),
+        (Stage.NULL_FILTER, None),
+        (Stage.DEDUP, None),
+        (Stage.REENCODE_DICTIONARIES, None),
+        (Stage.AGGREGATE, {"outname": "X"}),
+    ]
+    assert all(t.seconds >= 0 for t in timings)
+
+    timings.clear()
+    groupby(table, [Group("A", None)], [Aggregation(Operation.SUM, "B", "X")])
+    assert timings == []
+
+
+def test_timing_sinks_skip_planner_sample():
+    table = make_table(make_column("A", ["x", "y", "x"]), make_column("B", [1, 2, 3]))
+    timings = []
+    add_timing_sink(timings.append)
+    try:
+        groupby(table, [Group("A", None)], [Aggregation(Operation.SUM, "B", "X")])
+    finally:
+        remove_timing_sink(timings.append)
+    # The planner sorts a sample, but Stage.PLAN covers that
+    assert [t.stage for t in timings] == [
+        Stage.ONE_CHUNK,
+        Stage.SORTING_TABLE,
+        Stage.PLAN,
+        Stage.SORT,
+        Stage.NULL_FILTER,
+        Stage.DEDUP,
+        Stage.REENCODE_DICTIONARIES,
+        Stage.AGGREGATE,
+    ]
+
+
+def test_explain_groupby():
+    table = make_table(
+        make_column("A", ["x", "y", None, "x"]), make_column("B", [1, 2, 3, 4])
+    )
+    result, explanation = explain_groupby(
+        table,
+        [Group("A", None)],
+        [Aggregation(Operation.SUM, "B", "X"), Aggregation(Operation.MEDIAN, "B", "Y")],
+        engine=Engine.GROUP_ID,
+    )
+    assert_arrow_table_equals(
+        result,
+        groupby(
+            table,
+            [Group("A", None)],
+            [
+                Aggregation(Operation.SUM, "B", "X"),
+                Aggregation(Operation.MEDIAN, "B", "Y"),
+            ],
+        ),
+    )
+    assert explanation.engine == Engine.GROUP_ID
+    assert not explanation.planned
+    assert explanation.kernels == {"X": "by_id:SumPartial", "Y": "by_id:MedianPartial"}
+    assert explanation.estimated_n_groups is None
+    assert explanation.n_groups == 2
+    assert explanation.n_output_rows == 2
+    assert explanation.n_rows_dropped == 1
+    assert [s.stage for s in explanation.stages][-2:] == [Stage.AGGREGATE] * 2
+    assert all(s.seconds >= 0 for s in explanation.stages)
+    assert json.loads(json.dumps(explanation.to_json()))["engine"] == "group_id"
+
+
+def test_explain_groupby_memory_peaks():
+    values = np.random.default_rng(0).random(200_000)
+    table = pa.table({"A": np.arange(200_000) % 3, "B": values})
+    _, explanation = explain_groupby(
+        table,
+        [Group("A", None)],
+        [Aggregation(Operation.MEDIAN, "B", "X")],
+        engine=Engine.GROUP_ID,
+    )
+    aggregate = explanation.stages[-1]
+    assert aggregate.stage == Stage.AGGREGATE
+    # MEDIAN frees its sorted copy of values before the stage ends
+    assert aggregate.traced_peak_bytes >= values.nbytes
+    assert all(stage.arrow_peak_bytes >= 0 for stage in explanation.stages)
+
+
+def test_explain_groupby_planned_sort():
+    table = make_table(make_column("A", ["x", "y", "x"]), make_column("B", [1, 2, 3]))
+    _, explanation = explain_groupby(
+        table, [Group("A", None)], [Aggregation(Operation.SUM, "B", "X")]
+    )
+    assert explanation.engine == Engine.SORT
+    assert explanation.planned
+    assert explanation.kernels == {"X": "sorted:sum"}
+    assert explanation.estimated_n_groups == 2
+    assert explanation.n_groups == 2
+
+
+def test_explain_groupby_planned_selection():
+    # SORT would aggregate every group; GROUP_ID aggregates only selected ones
+    table = make_table(make_column("A", ["x", "y", "x"]), make_column("B", [1, 2, 3]))
+    result, explanation = explain_groupby(
+        table,
+        [Group("A", None)],
+        [Aggregation(Operation.SUM, "B", "X"), Aggregation(Operation.MEAN, "B", "Y")],
+        top_n=TopN("X", 1),
+    )
+    assert explanation.engine == Engine.GROUP_ID
+    assert explanation.kernels == {"X": "by_id:SumPartial", "Y": "by_id:MeanPartial"}
+    assert Stage.SELECT_GROUPS in [stage.stage for stage in explanation.stages]
+    assert result["A"].to_pylist() == ["x"]
+
+
+def test_estimate_n_groups_high_cardinality():
+    codes = np.random.default_rng(0).integers(0, 200_000, 1_000_000)
+    sorting_table = make_sorting_table(
+        pa.table({"A": pa.array(codes)}), [Group("A", None)]
+    )
+    n_groups = len(np.unique(codes))
+    assert 0.8 * n_groups < estimate_n_groups(sorting_table) < 1.2 * n_groups
+
+
+def test_gather_input_stats():
+    table = make_table(
+        make_column("A", [1, 1, 3, None]),
+        make_column("B", ["x", "y", "y", "z"], dictionary=True),
+        make_column("C", ["b", "a", "a", "c"]),
+    )
+    groups = [Group("A", None), Group("B", None), Group("C", None)]
+    assert gather_input_stats(make_sorting_table(table, groups), 4) == InputStats(
+        4,
+        [
+            KeyStats(pa.int64(), 1, 3),
+            KeyStats(pa.dictionary(pa.int32(), pa.utf8()), 0, 3),
+            KeyStats(pa.utf8(), 0, None),
+        ],
+        3,
+        True,
+    )
+    assert not gather_input_stats(make_sorting_table(table, groups[2:]), 4).is_sorted
+
+
+def test_choose_engine():
+    def choose(keys, n_groups=10, is_sorted=False, **kwargs):
+        return choose_engine(InputStats(100, keys, n_groups, is_sorted), **kwargs)
+
+    text = KeyStats(pa.utf8(), 0, None)
+    assert choose([]) == Engine.GROUP_ID
+    assert choose([KeyStats(pa.int64(), 1, 100), KeyStats(pa.bool_(), 0, 2)]) == (
+        Engine.DIRECT
+    )
+    assert choose([KeyStats(pa.int64(), 0, MAX_DIRECT_SLOTS + 1)]) == Engine.SORT
+    assert choose([text], is_sorted=True) == Engine.PRESORTED
+    assert choose([text]) == Engine.SORT
+    assert choose([text], allow_sort=False) == Engine.GROUP_ID
+    assert choose([text], n_groups=1000000) == Engine.GROUP_ID
+
+
+def test_presorted_engine():
+    table = make_table(
+        make_column("A", ["a", "a", "b", "b", None]),
+        make_column("B", [1, None, 1, 2, 1]),
+        make_column("C", [1, 2, 3, 4, 5]),
+    )
+    groups = [Group("A", None), Group("B", None)]
+    aggregations = [Aggregation(Operation.SUM, "C", "X")]
+    assert_arrow_table_equals(
+        groupby(table, groups, aggregations, engine=Engine.PRESORTED),
+        groupby(table, groups, aggregations, engine=Engine.GROUP_ID),
+    )
+    with pytest.raises(ValueError, match="PRESORTED"):
+        groupby(table, groups[1:], aggregations, engine=Engine.PRESORTED)
@@ -44,7 +44,9 @@ def test_migrate_v1_default():
             "group_dates": False,
             "date_granularities": {},
         },
-        aggregations=[{"operation": "size", "colname": "", "outname": ""}],
+        aggregations=[
+            {"operation": "size", "colname": "", "outname": "", "percentile": 50.0}
+        ],
     )
 
 
@@ -86,7 +88,9 @@ def test_migrate_v1_aggregation():
                 "outputname|operation|0": "C",
             }
         )["aggregations"]
-        == [{"operation": "max", "colname": "c", "outname": "C"}]
+        == [
+            {"operation": "max", "colname": "c", "outname": "C", "percentile": 50.0}
+        ]
     )
 
 
@@ -105,7 +109,9 @@ def test_migrate_v1_only_active_aggregations():
                 "outputname|operation|1": "D",
             }
         )["aggregations"]
-        == [{"operation": "max", "colname": "c", "outname": "C"}]
+        == [
+            {"operation": "max", "colname": "c", "outname": "C", "percentile": 50.0}
+        ]
     )
 
 
@@ -139,11 +145,11 @@ def test_migrate_v1_many_aggregations():
             "outputname|operation|4": "E",
         }
     )["aggregations"] == [
-        {"operation": "size", "colname": "", "outname": "A"},
-        {"operation": "nunique", "colname": "", "outname": "B"},
-        {"operation": "sum", "colname": "c", "outname": "C"},
-        {"operation": "mean", "colname": "d", "outname": "D"},
-        {"operation": "min", "colname": "e", "outname": "E"},
+        {"operation": "size", "colname": "", "outname": "A", "percentile": 50.0},
+        {"operation": "nunique", "colname": "", "outname": "B", "percentile": 50.0},
+        {"operation": "sum", "colname": "c", "outname": "C", "percentile": 50.0},
+        {"operation": "mean", "colname": "d", "outname": "D", "percentile": 50.0},
+        {"operation": "min", "colname": "e", "outname": "E", "percentile": 50.0},
     ]
 
 
@@ -163,7 +169,9 @@ def test_migrate_v1_omit_aggregation_missing_colname():
                 "outputname|operation|1": "B",
             }
         )["aggregations"]
-        == [{"operation": "nunique", "colname": "", "outname": "B"}]
+        == [
+            {"operation": "nunique", "colname": "", "outname": "B", "percentile": 50.0}
+        ]
     )
 
 
@@ -208,6 +216,28 @@ def test_migrate_v2():
 
 
 def test_migrate_v3():
+    assert migrate_params(
+        {
+            "groups": {
+                "colnames": ["A", "B"],
+                "group_dates": False,
+                "date_granularities": {},
+            },
+            "aggregations": [{"operation": "sum", "colname": "C", "outname": ""}],
+        }
+    ) == P(
+        groups={
+            "colnames": ["A", "B"],
+            "group_dates": False,
+            "date_granularities": {},
+        },
+        aggregations=[
+            {"operation": "sum", "colname": "C", "outname": "", "percentile": 50.0}
+        ],
+    )
+
+
+def test_migrate_v4():
     assert migrate_params(
         {
             "groups": {
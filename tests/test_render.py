@@ -1,17 +1,32 @@
 import datetime
+import json
+import threading
+import time
 from pathlib import Path
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
 from cjwmodule.arrow.testing import assert_result_equals, make_column, make_table
 from cjwmodule.arrow.types import ArrowRenderResult
 from cjwmodule.spec.testing import param_factory
 from cjwmodule.testing.i18n import i18n_message
 from cjwmodule.types import QuickFix, QuickFixAction, RenderError
 
+import groupby
+from groupby import make_render_plan
 from groupby import render_arrow_v1 as render
 
 P = param_factory(Path(__file__).parent.parent / "groupby.yaml")
 
 
+def agg(*, operation: str, colname: str, outname: str, percentile: float = 50.0):
+    """Build an aggregation param. (`P()` only fills in top-level defaults.)"""
+    return dict(
+        operation=operation, colname=colname, outname=outname, percentile=percentile
+    )
+
+
 # def test_defaults_count():
 #    table = pd.DataFrame({'A': [1, 2]})
 #    result = render(table, {
@@ -69,14 +84,14 @@ def test_default_outnames():
             P(
                 groups=dict(colnames=["A"], group_dates=False, date_granularities={}),
                 aggregations=[
-                    dict(operation="size", colname="", outname=""),
-                    dict(operation="nunique", colname="B", outname=""),
-                    dict(operation="sum", colname="B", outname=""),
-                    dict(operation="mean", colname="B", outname=""),
-                    dict(operation="median", colname="B", outname=""),
-                    dict(operation="min", colname="B", outname=""),
-                    dict(operation="max", colname="B", outname=""),
-                    dict(operation="first", colname="B", outname=""),
+                    agg(operation="size", colname="", outname=""),
+                    agg(operation="nunique", colname="B", outname=""),
+                    agg(operation="sum", colname="B", outname=""),
+                    agg(operation="mean", colname="B", outname=""),
+                    agg(operation="median", colname="B", outname=""),
+                    agg(operation="min", colname="B", outname=""),
+                    agg(operation="max", colname="B", outname=""),
+                    agg(operation="first", colname="B", outname=""),
                 ],
             ),
         ),
@@ -96,6 +111,39 @@ def test_default_outnames():
     )
 
 
+def test_default_outnames_approximate():
+    assert_result_equals(
+        render(
+            make_table(
+                make_column("A", ["x", "x"]), make_column("B", [1, 2], format="{:d}")
+            ),
+            P(
+                groups=dict(colnames=["A"], group_dates=False, date_granularities={}),
+                aggregations=[
+                    agg(operation="approx_nunique", colname="B", outname=""),
+                    agg(operation="approx_median", colname="B", outname=""),
+                    agg(
+                        operation="approx_percentile",
+                        colname="B",
+                        outname="",
+                        percentile=100.0,
+                    ),
+                    agg(operation="most_frequent", colname="B", outname=""),
+                ],
+            ),
+        ),
+        ArrowRenderResult(
+            make_table(
+                make_column("A", ["x"]),
+                make_column("Approximate unique count of B", [2], format="{:,d}"),
+                make_column("Approximate median of B", [1.5], format="{:,}"),
+                make_column("Approximate percentile 100 of B", [2.0], format="{:,}"),
+                make_column("Most frequent of B", [1], format="{:d}"),
+            )
+        ),
+    )
+
+
 def test_quickfix_convert_value_strings_to_numbers():
     assert_result_equals(
         render(
@@ -107,8 +155,8 @@ def test_quickfix_convert_value_strings_to_numbers():
             P(
                 groups=dict(colnames=["A"], group_dates=False, date_granularities={}),
                 aggregations=[
-                    dict(operation="mean", colname="B", outname="mean"),
-                    dict(operation="sum", colname="C", outname="sum"),
+                    agg(operation="mean", colname="B", outname="mean"),
+                    agg(operation="sum", colname="C", outname="sum"),
                 ],
             ),
         ),
@@ -146,8 +194,8 @@ def test_ignore_aggregation_with_empty_colname():
             P(
                 groups=dict(colnames=[], group_dates=False, date_granularities={}),
                 aggregations=[
-                    dict(operation="size", colname="", outname="size"),
-                    dict(operation="sum", colname="", outname="sum"),
+                    agg(operation="size", colname="", outname="size"),
+                    agg(operation="sum", colname="", outname="sum"),
                 ],
             ),
         ),
@@ -175,7 +223,7 @@ def test_ignore_non_date_timestamps():
                 groups=dict(
                     colnames=["A"], group_dates=True, date_granularities={"A": "T"}
                 ),
-                aggregations=[dict(operation="size", colname="", outname="size")],
+                aggregations=[agg(operation="size", colname="", outname="size")],
             ),
         ),
         ArrowRenderResult(
@@ -191,7 +239,7 @@ def test_group_dates_prompt_select_date_column():
             make_table(make_column("A", [1])),
             P(
                 groups=dict(colnames=["A"], group_dates=True, date_granularities={}),
-                aggregations=[dict(operation="size", colname="", outname="size")],
+                aggregations=[agg(operation="size", colname="", outname="size")],
             ),
         ),
         ArrowRenderResult(
@@ -207,7 +255,7 @@ def test_group_date_prompt_when_nothing_selected():
             make_table(make_column("A", [1])),
             P(
                 groups=dict(colnames=[], group_dates=True, date_granularities={}),
-                aggregations=[dict(operation="sum", colname="A", outname="sum")],
+                aggregations=[agg(operation="sum", colname="A", outname="sum")],
             ),
         ),
         ArrowRenderResult(
@@ -228,7 +276,7 @@ def test_group_date_prompt_all_is_well_when_date_column_present():
                 groups=dict(
                     colnames=["A", "B"], group_dates=True, date_granularities={}
                 ),
-                aggregations=[dict(operation="size", colname="", outname="size")],
+                aggregations=[agg(operation="size", colname="", outname="size")],
             ),
         ),
         ArrowRenderResult(
@@ -255,7 +303,7 @@ def test_group_date_prompt_convert_timestamp_to_date():
             make_table(make_column("A", [datetime.datetime(2021, 5, 5)])),
             P(
                 groups=dict(colnames=["A"], group_dates=True, date_granularities={}),
-                aggregations=[dict(operation="size", colname="", outname="size")],
+                aggregations=[agg(operation="size", colname="", outname="size")],
             ),
         ),
         ArrowRenderResult(
@@ -295,7 +343,7 @@ def test_group_date_prompt_convert_text_to_date():
                 groups=dict(
                     colnames=["A", "B"], group_dates=True, date_granularities={}
                 ),
-                aggregations=[dict(operation="size", colname="", outname="size")],
+                aggregations=[agg(operation="size", colname="", outname="size")],
             ),
         ),
         ArrowRenderResult(
@@ -339,7 +387,7 @@ def test_group_date_prompt_upgrade_timestamp_to_date():
                 groups=dict(
                     colnames=["A"], group_dates=True, date_granularities={"A": "Y"}
                 ),
-                aggregations=[dict(operation="size", colname="", outname="size")],
+                aggregations=[agg(operation="size", colname="", outname="size")],
             ),
         ),
         ArrowRenderResult(
@@ -375,7 +423,7 @@ def test_group_date_prompt_upgrade_timestampmath():
                 groups=dict(
                     colnames=["A"], group_dates=True, date_granularities={"A": "S"}
                 ),
-                aggregations=[dict(operation="size", colname="", outname="size")],
+                aggregations=[agg(operation="size", colname="", outname="size")],
             ),
         ),
         ArrowRenderResult(
@@ -405,3 +453,148 @@ def test_group_date_prompt_upgrade_timestampmath():
             ],
         ),
     )
+
+
+def test_preview_scales_size_and_sum(monkeypatch):
+    monkeypatch.setattr(groupby, "PREVIEW_SAMPLE_ROWS", 2)
+    table = make_table(
+        make_column("A", ["x", "x", "x", "x"]),
+        make_column("B", [3, 3, 3, 3], format="{:d}"),
+    )
+    params = P(
+        groups=dict(colnames=["A"], group_dates=False, date_granularities={}),
+        aggregations=[
+            agg(operation="size", colname="", outname="size"),
+            agg(operation="sum", colname="B", outname="sum"),
+            agg(operation="max", colname="B", outname="max"),
+        ],
+    )
+    plan = make_render_plan(table, params)
+    assert_result_equals(
+        render(table, params, preview=True, plan=plan),
+        ArrowRenderResult(
+            make_table(
+                make_column("A", ["x"]),
+                make_column("size", [4], format="{:,d}"),
+                make_column("sum", [12], format="{:d}"),
+                make_column("max", [3], format="{:d}"),
+            ),
+            [
+                RenderError(
+                    i18n_message(
+                        "preview.approximate", {"n_sample_rows": 2, "n_rows": 4}
+                    )
+                )
+            ],
+        ),
+    )
+    # The exact render reuses the plan, and gives the same result as without
+    assert_result_equals(render(table, params, plan=plan), render(table, params))
+
+
+def test_preview_small_table_is_exact():
+    table = make_table(make_column("A", ["x", "y"]))
+    params = P(
+        groups=dict(colnames=["A"], group_dates=False, date_granularities={}),
+        aggregations=[agg(operation="size", colname="", outname="size")],
+    )
+    assert_result_equals(render(table, params, preview=True), render(table, params))
+
+
+def test_cancelled():
+    cancel = threading.Event()
+    cancel.set()
+    assert_result_equals(
+        render(
+            make_table(make_column("A", [1, 2])),
+            P(
+                groups=dict(colnames=["A"], group_dates=False, date_granularities={}),
+                aggregations=[agg(operation="size", colname="", outname="size")],
+            ),
+            cancel=cancel,
+        ),
+        ArrowRenderResult(make_table(), [RenderError(i18n_message("cancelled.error"))]),
+    )
+
+
+def test_profile_slow_render(tmp_path):
+    table = make_table(make_column("A", [1, 2]))
+    params = P(
+        groups=dict(colnames=["A"], group_dates=False, date_granularities={}),
+        aggregations=[agg(operation="size", colname="", outname="size")],
+    )
+    result = render(
+        table,
+        params,
+        profile=groupby.ProfileConfig(tmp_path, threshold=0.0, interval=0.001),
+        progress=lambda _: time.sleep(0.01),  # slow enough to sample
+    )
+    assert_result_equals(result, render(table, params))
+    (path,) = tmp_path.iterdir()
+    assert path.name.startswith("render-%s-2x1-" % groupby.params_digest(params))
+    lines = path.read_text().splitlines()
+    assert any("groupby.py:render_groupby;" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+
+def test_profile_skips_fast_render(tmp_path, monkeypatch):
+    monkeypatch.setenv("GROUPBY_PROFILE_DIR", str(tmp_path))
+    monkeypatch.setenv("GROUPBY_PROFILE_THRESHOLD", "60")
+    render(
+        make_table(make_column("A", [1, 2])),
+        P(
+            groups=dict(colnames=["A"], group_dates=False, date_granularities={}),
+            aggregations=[agg(operation="size", colname="", outname="size")],
+        ),
+    )
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_capture_workload(tmp_path):
+    table = make_table(
+        make_column("Name", ["alice", "bob", "alice", None]),
+        make_column("Salary", [100, 200, 300, 400]),
+    )
+    params = P(
+        groups=dict(colnames=["Name"], group_dates=False, date_granularities={}),
+        aggregations=[agg(operation="size", colname="", outname="Headcount")],
+    )
+    result = render(table, params, capture=groupby.CaptureConfig(tmp_path, data=True))
+    assert_result_equals(result, render(table, params))
+    groupby.wait_for_captures()  # we capture after returning
+    (json_path,) = tmp_path.glob("*.json")
+    text = json_path.read_text()
+    for secret in ["Name", "Salary", "Headcount", "alice"]:
+        assert secret not in text
+    workload = json.loads(text)
+    assert workload["params"]["groups"]["colnames"] == ["c0"]
+    assert workload["n_rows"] == 4
+    assert [c["null_count"] for c in workload["columns"]] == [1, 0]
+    # Replaying on hashed data gives the same groups
+    with pa.OSFile(str(tmp_path / workload["data"])) as f:
+        data = pa.ipc.open_file(f).read_all()
+    assert "alice" not in str(data.to_pydict())
+    replayed = render(data, workload["params"])
+    assert sorted(replayed.table["out0"].to_pylist()) == [1, 2]
+
+
+def test_anonymize_array_keeps_equality():
+    salt = np.uint64(12345)
+    for array in [
+        pa.array([5, 6, 7, 8, 9, 10, 5, None], pa.int8()),
+        pa.array([0, 2**63 - 1, -(2**63), 0]),
+        pa.array(["a", "b", None, "a"]),
+        pa.array(["a", "b", None, "a"]).dictionary_encode(),
+        pa.array([True, False, None, True]),
+    ]:
+        result = groupby.anonymize_array(array, salt)
+        assert result.type == array.type
+        before = array.to_pylist()
+        after = result.to_pylist()
+        assert [v is None for v in after] == [v is None for v in before]
+        # Equal values stay equal; distinct values stay distinct
+        pairs = set(zip(before, after))
+        assert len(pairs) == len(set(before)) == len(set(after))
+        if pa.types.is_integer(array.type):
+            assert min(before[:-1]) <= min(v for v in after if v is not None)
+            assert max(v for v in after if v is not None) <= max(before[:-1])